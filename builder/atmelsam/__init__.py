@@ -0,0 +1,23 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers shared by the Atmel SAM build and upload scripts"""
+
+
+def is_enabled(value):
+    # board options may come either from JSON manifests (booleans) or from
+    # "board_*" options in "platformio.ini" (strings)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "yes", "true", "y", "on")
+    return bool(value)
@@ -0,0 +1,325 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SWD/JTAG adapter speed autotuning ("debug_speed = auto")
+
+The adapter speed is stepped up while a block of flash read at the slowest
+speed reads back identically and a RAM test pattern survives a write/read
+cycle. The fastest speed that passed is remembered per probe (USB serial
+number) and board, so only the first upload or debug session with a new
+combination pays for the tuning.
+
+The module depends only on the standard library, it is shared by the build
+script and by the platform class (debug sessions).
+"""
+
+import json
+import os
+import re
+import sys
+import time
+
+AUTO = "auto"
+
+# kHz, probes clamp a request to their own maximum
+SPEEDS = (400, 1000, 2000, 4000, 6000, 8000, 12000, 16000, 24000, 33000, 50000)
+
+VERIFY_ADDRESS = 0x0
+VERIFY_WORDS = 256
+VERIFY_REPEAT = 3
+RAM_ADDRESS = 0x20000000
+RAM_PATTERNS = (0x55AA55AA, 0xA55AA55A)
+
+# USB IDs used to find the serial number of a probe, a product ID of None
+# matches any product of the vendor
+PROBE_HWIDS = {
+    "atmel-ice": [(0x03EB, 0x2141)],
+    "cmsis-dap": [(0x03EB, 0x2111), (0x03EB, 0x2175), (0x0D28, 0x0204)],
+    "jlink": [(0x1366, None)],
+    "stlink": [
+        (0x0483, 0x3748), (0x0483, 0x374B), (0x0483, 0x374E),
+        (0x0483, 0x374F), (0x0483, 0x3752), (0x0483, 0x3753),
+    ],
+}
+
+# OpenOCD commands and J-Link options that select a probe explicitly
+OPENOCD_SERIAL_COMMANDS = ("adapter serial", "cmsis_dap_serial", "hla_serial")
+JLINK_SERIAL_FLAGS = ("-USB", "-SelectEmuBySN")
+
+
+class AutotuneError(Exception):
+    pass
+
+
+def is_auto(value):
+    return str(value or "").strip().lower() == AUTO
+
+
+def get_probe_type(protocol):
+    return "jlink" if protocol.startswith("jlink") else protocol
+
+
+#
+# Probe identity
+#
+
+
+def get_pinned_serial(arguments):
+    """Serial number of a probe selected in the tool arguments"""
+    for i, arg in enumerate(arguments):
+        if arg in JLINK_SERIAL_FLAGS and i + 1 < len(arguments):
+            return arguments[i + 1]
+        for command in OPENOCD_SERIAL_COMMANDS:
+            if arg.startswith(command + " "):
+                return arg[len(command):].strip().strip('"')
+    return None
+
+
+def list_usb_devices(sysfs_root="/sys"):
+    """(VID, PID, serial) of the connected USB devices (Linux only), unlike
+    the serial port listing this includes HID-only probes"""
+    devices_dir = os.path.join(sysfs_root, "bus", "usb", "devices")
+    if not sys.platform.startswith("linux") or not os.path.isdir(devices_dir):
+        return None
+    result = []
+    for name in sorted(os.listdir(devices_dir)):
+        path = os.path.join(devices_dir, name)
+        try:
+            with open(os.path.join(path, "idVendor")) as fp:
+                vid = int(fp.read().strip(), 16)
+            with open(os.path.join(path, "idProduct")) as fp:
+                pid = int(fp.read().strip(), 16)
+        except (OSError, ValueError):
+            continue  # USB interface or root hub without IDs
+        serial = None
+        if os.path.isfile(os.path.join(path, "serial")):
+            with open(os.path.join(path, "serial")) as fp:
+                serial = fp.read().strip() or None
+        result.append((vid, pid, serial))
+    return result
+
+
+def _parse_serial_ports(ports):
+    result = []
+    for item in ports or []:
+        hwid = item.get("hwid", "")
+        match = re.search(r"VID:PID=([0-9A-F]{4}):([0-9A-F]{4})", hwid, re.I)
+        if not match:
+            continue
+        serial = None
+        for token in hwid.split():
+            if token.startswith("SER=") and len(token) > 4:
+                serial = token[4:]
+        result.append((int(match.group(1), 16), int(match.group(2), 16), serial))
+    return result
+
+
+def find_probe_serial(protocol, arguments, ports=None, sysfs_root="/sys"):
+    """Serial number of the probe used by "protocol", "*" when it cannot be
+    told apart from other probes (the result is then cached per board only)"""
+    serial = get_pinned_serial(arguments)
+    if serial:
+        return serial
+    devices = list_usb_devices(sysfs_root)
+    if devices is None:
+        # probes that expose a virtual COM port (EDBG, J-Link OB, ST-Link)
+        devices = _parse_serial_ports(ports)
+    hwids = PROBE_HWIDS.get(get_probe_type(protocol), [])
+    serials = set(
+        serial for vid, pid, serial in devices
+        if serial and any(
+            vid == vid_ and pid_ in (None, pid) for vid_, pid_ in hwids)
+    )
+    return serials.pop() if len(serials) == 1 else "*"
+
+
+#
+# Cache
+#
+
+
+def get_cache_key(protocol, serial, board_id):
+    return "%s|%s|%s" % (get_probe_type(protocol), serial, board_id)
+
+
+class SpeedCache(object):
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        return (self._load().get(key) or {}).get("speed")
+
+    def items(self):
+        return sorted(self._load().items())
+
+    def set(self, key, speed):
+        data = self._load()
+        data[key] = dict(speed=speed, time=int(time.time()))
+        self._save(data)
+
+    def forget(self, key=None):
+        data = {} if key is None else {
+            k: v for k, v in self._load().items() if k != key}
+        self._save(data)
+
+
+#
+# OpenOCD
+#
+
+
+def get_openocd_script(speeds=SPEEDS, repeat=VERIFY_REPEAT):
+    """TCL that defines "pio_autotune", the procedure returns the fastest
+    verified speed in kHz (0 if none) and leaves it selected"""
+    return " ".join([
+        "proc pio_rdw {addr count} {"
+        " if {[llength [info commands read_memory]]} {"
+        " return [read_memory $addr 32 $count] };"
+        " mem2array pio_a 32 $addr $count; set r {};"
+        " for {set i 0} {$i < $count} {incr i} { lappend r $pio_a($i) };"
+        " return $r };",
+        # "adapter_khz" before OpenOCD 0.11, the actual speed may be lower
+        "proc pio_speed {khz} {"
+        " if {[catch {set r [adapter speed $khz]}]} { set r [adapter_khz $khz] };"
+        " if {[regexp {(\\d+) kHz} $r -> actual]} { return $actual };"
+        " return $khz };",
+        "proc pio_verify {ref} {"
+        " for {set i 0} {$i < %d} {incr i} {"
+        " if {[pio_rdw 0x%x %d] ne $ref} { error \"flash read mismatch\" } };"
+        " foreach p {%s} { mww 0x%x $p;"
+        " if {[pio_rdw 0x%x 1] != $p} { error \"RAM read mismatch\" } } };" % (
+            repeat, VERIFY_ADDRESS, VERIFY_WORDS,
+            " ".join("0x%08x" % p for p in RAM_PATTERNS),
+            RAM_ADDRESS, RAM_ADDRESS),
+        "proc pio_autotune {} {"
+        " pio_speed %d; reset halt; set ref [pio_rdw 0x%x %d]; set best 0;"
+        " foreach khz {%s} {"
+        " if {[catch {pio_speed $khz} actual] || $actual <= $best"
+        " || [catch {pio_verify $ref}]} break;"
+        " set best $actual };"
+        " if {$best} { pio_speed $best }; catch {reset run};"
+        " return $best }" % (
+            speeds[0], VERIFY_ADDRESS, VERIFY_WORDS,
+            " ".join(str(s) for s in speeds)),
+    ])
+
+
+def get_openocd_arguments(speeds=SPEEDS, repeat=VERIFY_REPEAT):
+    """Extra arguments of a one-shot OpenOCD run that tunes the speed"""
+    return [
+        "-c", get_openocd_script(speeds, repeat), "-c", "init",
+        "-c", 'echo "PIO_SPEED [pio_autotune]"', "-c", "shutdown"
+    ]
+
+
+def parse_openocd_output(text):
+    match = re.search(r"^PIO_SPEED (\d+)\s*$", text, re.M)
+    if not match:
+        raise AutotuneError("Unexpected OpenOCD output: %s" % text.strip())
+    speed = int(match.group(1))
+    if not speed:
+        raise AutotuneError("The target could not be read reliably")
+    return speed
+
+
+def tune_openocd(command, run):
+    """"run" executes a command and returns its combined output"""
+    return parse_openocd_output(run(command + get_openocd_arguments()))
+
+
+#
+# J-Link Commander (a run per speed, scripts cannot branch)
+#
+
+
+def get_jlink_script(repeat=VERIFY_REPEAT):
+    commands = ["h"]
+    commands.extend(
+        ["mem32 0x%08X, %d" % (VERIFY_ADDRESS, VERIFY_WORDS)] * repeat)
+    for pattern in RAM_PATTERNS:
+        commands.extend([
+            "w4 0x%08X, 0x%08X" % (RAM_ADDRESS, pattern),
+            "mem32 0x%08X, 1" % RAM_ADDRESS,
+        ])
+    commands.extend(["r", "g", "q"])
+    return commands
+
+
+def parse_jlink_output(text, repeat=VERIFY_REPEAT):
+    """Flash words of every read and the values read from the RAM address"""
+    flash = []
+    ram = []
+    for match in re.finditer(
+            r"^([0-9A-F]{8}) = ((?:[0-9A-F]{8} *)+)$", text, re.I | re.M):
+        address = int(match.group(1), 16)
+        words = [int(w, 16) for w in match.group(2).split()]
+        if address == RAM_ADDRESS:
+            ram.append(words[0])
+        else:
+            flash.extend(words)
+    if len(flash) != repeat * VERIFY_WORDS:
+        raise AutotuneError("Could not read the flash over J-Link")
+    reads = [
+        flash[i:i + VERIFY_WORDS] for i in range(0, len(flash), VERIFY_WORDS)]
+    return reads, ram
+
+
+def tune_jlink(command, run, script_path, speeds=SPEEDS):
+    """"command" is a J-Link Commander command line without "-speed" and
+    "-CommanderScript\""""
+    with open(script_path, "w") as fp:
+        fp.write("\n".join(get_jlink_script()))
+    best = 0
+    reference = None
+    for speed in speeds:
+        try:
+            reads, ram = parse_jlink_output(run(command + [
+                "-speed", str(speed), "-CommanderScript", script_path]))
+        except AutotuneError:
+            break
+        reference = reference or reads[0]
+        if any(item != reference for item in reads) or ram != list(
+                RAM_PATTERNS):
+            break
+        best = speed
+    if not best:
+        raise AutotuneError("The target could not be read reliably")
+    return best
+
+
+def strip_jlink_speed(arguments):
+    result = []
+    skip = False
+    for arg in arguments:
+        if skip:
+            skip = False
+        elif arg == "-speed":
+            skip = True
+        else:
+            result.append(arg)
+    return result
@@ -0,0 +1,279 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+High-throughput serial capture for native USB (CDC) boards
+
+Received data goes into a preallocated ring buffer and a writer thread
+drains it to disk in large batches, so a slow disk or terminal never stalls
+the port. When the ring is full the data is dropped and counted as an
+overrun instead of blocking the reader.
+
+A capture file holds either the raw stream or, with timestamps enabled,
+a sequence of chunk records (little-endian):
+
+    <float64 UNIX time of arrival> <uint32 length> <payload>
+"""
+
+import collections
+import os
+import re
+import struct
+import threading
+import time
+
+CHUNK_HEADER = struct.Struct("<dI")
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 256 * 1024
+READ_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.2
+DEFAULT_PATH = "capture-%Y%m%d-%H%M%S.bin"
+
+
+def parse_size(value, default=0):
+    """Bytes from "4194304", "512K" or "4M" """
+    match = re.match(r"^\s*(\d+)\s*([KM]?)i?B?\s*$", str(value or ""), re.I)
+    if not match:
+        return default
+    return int(match.group(1)) * {"": 1, "K": 1024, "M": 1024 * 1024}[
+        match.group(2).upper()]
+
+
+def get_capture_path(template, build_dir):
+    """"template" may contain strftime() fields, relative paths are placed
+    in the build directory of the environment"""
+    path = time.strftime(template or DEFAULT_PATH)
+    if not os.path.isabs(path):
+        path = os.path.join(build_dir, path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+
+def iter_chunks(fp):
+    """(timestamp, payload) records of a capture made with timestamps"""
+    while True:
+        header = fp.read(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            return
+        timestamp, length = CHUNK_HEADER.unpack(header)
+        yield timestamp, fp.read(length)
+
+
+class CaptureStats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.stopped = None
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.overruns = 0
+        self.chunks = 0
+        self.peak = 0
+
+    @property
+    def elapsed(self):
+        return (self.stopped or time.time()) - self.started
+
+    def format(self):
+        elapsed = max(self.elapsed, 1e-6)
+        return (
+            "%d bytes in %.2f s (%.2f MB/s), %d chunks, %d bytes written, "
+            "%d bytes dropped in %d overrun(s), ring buffer peak %d bytes" % (
+                self.received, elapsed, self.received / elapsed / 1e6,
+                self.chunks, self.written, self.dropped, self.overruns,
+                self.peak))
+
+
+class RingBuffer(object):
+    """Byte ring for a single producer and a single consumer that keeps the
+    boundaries and arrival times of the written chunks.
+
+    The indices are only accessed under the lock. The bytes between them
+    are copied outside of it, the producer owns the free space and the
+    consumer the committed chunks until it releases them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._view = memoryview(bytearray(size))
+        self._head = 0  # bytes committed since the start
+        self._tail = 0  # bytes released since the start
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+
+    @property
+    def used(self):
+        with self._cond:
+            return self._head - self._tail
+
+    def _span(self, start, length):
+        start %= self.size
+        first = min(length, self.size - start)
+        views = [self._view[start:start + first]]
+        if first < length:
+            views.append(self._view[:length - first])
+        return views
+
+    def reserve(self, limit):
+        """Contiguous free space for reading into, empty when full"""
+        with self._cond:
+            free = self.size - (self._head - self._tail)
+            start = self._head % self.size
+        return self._view[start:start + min(free, self.size - start, limit)]
+
+    def commit(self, length, timestamp):
+        with self._cond:
+            self._head += length
+            self._chunks.append((timestamp, length))
+            self._cond.notify()
+
+    def write(self, data, timestamp):
+        """Copy "data" as one chunk, returns the number of bytes that did
+        not fit"""
+        with self._cond:
+            length = min(len(data), self.size - (self._head - self._tail))
+            head = self._head
+        if not length:
+            return len(data)
+        offset = 0
+        for view in self._span(head, length):
+            view[:] = data[offset:offset + len(view)]
+            offset += len(view)
+        self.commit(length, timestamp)
+        return len(data) - length
+
+    def wait(self, length, timeout):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._head - self._tail >= length, timeout)
+
+    def peek(self, limit):
+        """Whole chunks from the oldest one on, at least one and up to
+        "limit" bytes in total: [(timestamp, [views])]"""
+        with self._cond:
+            tail = self._tail
+            chunks = list(self._chunks)
+        result = []
+        start = tail
+        for timestamp, length in chunks:
+            if result and start - tail + length > limit:
+                break
+            result.append((timestamp, self._span(start, length)))
+            start += length
+        return result
+
+    def release(self, count):
+        """Free the space of the "count" oldest chunks"""
+        with self._cond:
+            for _ in range(count):
+                self._tail += self._chunks.popleft()[1]
+
+
+class CaptureWriter(object):
+    def __init__(self, fp, buffer_size=DEFAULT_BUFFER_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, timestamps=False):
+        self.fp = fp
+        self.ring = RingBuffer(buffer_size)
+        self.batch_size = min(batch_size, buffer_size)
+        self.timestamps = timestamps
+        self.stats = CaptureStats()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.fp.flush()
+        self.stats.stopped = time.time()
+
+    def _account(self, length, dropped):
+        self.stats.received += length
+        if length - dropped:
+            self.stats.chunks += 1
+        if dropped:
+            self.stats.dropped += dropped
+            self.stats.overruns += 1
+        self.stats.peak = max(self.stats.peak, self.ring.used)
+
+    def feed(self, data):
+        """Queue received data, never blocks"""
+        if data:
+            self._account(len(data), self.ring.write(data, time.time()))
+
+    def read_from(self, port, scratch):
+        """Read from "port" straight into the ring, returns the byte count.
+        A full ring is still drained into "scratch" to count the overrun."""
+        view = self.ring.reserve(len(scratch))
+        if not len(view):
+            length = port.readinto(scratch)
+            self._account(length, length)
+            return length
+        length = port.readinto(view)
+        if length:
+            self.ring.commit(length, time.time())
+            self._account(length, 0)
+        return length
+
+    def _write_batch(self):
+        chunks = self.ring.peek(self.batch_size)
+        if not chunks:
+            return False
+        if self.timestamps:
+            parts = []
+            for timestamp, views in chunks:
+                parts.append(CHUNK_HEADER.pack(
+                    timestamp, sum(len(view) for view in views)))
+                parts.extend(views)
+            self.fp.write(b"".join(parts))
+        else:
+            for _, views in chunks:
+                for view in views:
+                    self.fp.write(view)
+        self.stats.written += sum(
+            len(view) for _, views in chunks for view in views)
+        self.ring.release(len(chunks))
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.ring.wait(self.batch_size, FLUSH_INTERVAL)
+            while self.ring.used and self._write_batch():
+                if self.ring.used < self.batch_size:
+                    break
+        while self._write_batch():
+            pass
+
+
+def capture_port(port, baudrate, writer, duration=0, progress=None):
+    """Stream "port" into "writer" until "duration" seconds have passed or
+    the user hits Ctrl+C, "progress" is called with the stats every second"""
+    from serial import Serial  # pylint: disable=C0415
+
+    scratch = bytearray(READ_SIZE)
+    deadline = time.time() + duration if duration else None
+    reported = time.time()
+    try:
+        with Serial(port, baudrate=baudrate, timeout=FLUSH_INTERVAL) as serial:
+            while not deadline or time.time() < deadline:
+                writer.read_from(serial, scratch)
+                if progress and time.time() - reported >= 1:
+                    reported = time.time()
+                    progress(writer.stats)
+    except KeyboardInterrupt:
+        pass
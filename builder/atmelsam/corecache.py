@@ -0,0 +1,128 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Machine-wide cache of prebuilt framework archives
+
+Package directories are immutable, so an archive compiled from a package
+(e.g. the Arduino core or a board variant) can be shared by every project
+that builds it with the same toolchain and flags. Archives are stored under
+a key derived from the package manifests, the compiler command line and the
+contents of headers that come from outside of the packages.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+HEADER_SUFFIXES = (".h", ".hh", ".hpp", ".hxx", ".inc", ".inl", ".tcc")
+
+_manifest_digests = {}
+
+
+def _is_subpath(path, parent):
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+def get_package_root(path):
+    path = os.path.realpath(path)
+    while True:
+        if os.path.isfile(os.path.join(path, "package.json")):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def get_manifest_digest(package_dir):
+    if package_dir not in _manifest_digests:
+        with open(os.path.join(package_dir, "package.json"), "rb") as fp:
+            _manifest_digests[package_dir] = hashlib.sha1(
+                fp.read()).hexdigest()
+    return _manifest_digests[package_dir]
+
+
+def get_headers_digest(path):
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.endswith(HEADER_SUFFIXES):
+                continue
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode("utf8"))
+            with open(file_path, "rb") as fp:
+                digest.update(hashlib.sha1(fp.read()).digest())
+    return digest.hexdigest()
+
+
+def describe_path(path, private_dirs=None):
+    """A location independent description of a source or include directory
+
+    Directories of packages are identified by their manifest, anything else
+    (project sources, build directory, custom paths) by the headers it holds.
+    """
+    path = os.path.realpath(path)
+    if not any(_is_subpath(path, d) for d in private_dirs or []):
+        package_dir = get_package_root(path)
+        if package_dir:
+            return [
+                "package",
+                get_manifest_digest(package_dir),
+                os.path.relpath(path, package_dir).replace(os.sep, "/"),
+            ]
+    if not os.path.isdir(path):
+        return ["missing"]
+    return ["headers", get_headers_digest(path)]
+
+
+def make_key(parts):
+    return hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class ArchiveCache(object):
+    """Concurrent ``pio run`` processes may share the cache directory.
+    Entries are never modified in place, they are written to a temporary
+    file and then atomically moved into place.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, key, name):
+        return os.path.join(self.cache_dir, key[:2], key, name)
+
+    def get(self, key, name):
+        path = self.get_path(key, name)
+        return path if os.path.isfile(path) else None
+
+    def put(self, key, name, archive_path, info=None):
+        path = self.get_path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if info:
+                with open(tmp_path, "w", encoding="utf8") as fp:
+                    json.dump(info, fp, indent=2, sort_keys=True)
+                os.replace(tmp_path, path + ".json")
+            shutil.copyfile(archive_path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
@@ -0,0 +1,128 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Changed-rows-only flashing for the SAM-BA bootloader
+
+The last image flashed to each device is kept in the platform cache. A new
+image is compared with it at erase row/block granularity and only the rows
+that differ are written with BOSSA's "--offset". Any doubt about the state
+of the device (no record, another board or offset, an interrupted upload)
+results in a full flash.
+"""
+
+import hashlib
+import json
+import os
+
+# smallest erasable unit of the NVM controller
+ERASE_SIZES = (
+    (("samd51", "same51", "same53", "same54"), 8192),
+    (("samd", "samc", "saml", "samr"), 256),
+)
+
+# above this share of changed bytes a single full write is faster than
+# several BOSSA sessions
+MAX_CHANGED_RATIO = 0.5
+MAX_RANGES = 8
+
+
+def get_erase_size(mcu):
+    for prefixes, size in ERASE_SIZES:
+        if mcu.startswith(prefixes):
+            return size
+    return None
+
+
+def get_changed_ranges(old, new, block_size):
+    ranges = []
+    for start in range(0, len(new), block_size):
+        end = min(start + block_size, len(new))
+        if old[start:end] == new[start:end]:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+
+    # every range costs a new BOSSA session, merge the closest ones
+    while len(ranges) > MAX_RANGES:
+        index = min(
+            range(len(ranges) - 1),
+            key=lambda i: ranges[i + 1][0] - ranges[i][1],
+        )
+        ranges[index][1] = ranges.pop(index + 1)[1]
+    return [tuple(item) for item in ranges]
+
+
+class FlashRecord(object):
+    def __init__(self, storage_dir, device):
+        self.device = device
+        name = hashlib.sha1(device.encode("utf8")).hexdigest()
+        if not os.path.isdir(storage_dir):
+            os.makedirs(storage_dir)
+        self.image_path = os.path.join(storage_dir, name + ".bin")
+        self.meta_path = os.path.join(storage_dir, name + ".json")
+
+    def load(self, board_id, offset):
+        try:
+            with open(self.meta_path, encoding="utf8") as fp:
+                meta = json.load(fp)
+            with open(self.image_path, "rb") as fp:
+                image = fp.read()
+        except (OSError, ValueError):
+            return None
+        if (
+            meta.get("device") != self.device
+            or meta.get("board") != board_id
+            or meta.get("offset") != offset
+            or meta.get("sha1") != hashlib.sha1(image).hexdigest()
+        ):
+            return None
+        return image
+
+    def invalidate(self):
+        # called before flashing, a failed or interrupted upload leaves
+        # the device in an unknown state
+        for path in (self.meta_path, self.image_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def save(self, board_id, offset, image):
+        tmp_path = "%s.%d.tmp" % (self.image_path, os.getpid())
+        with open(tmp_path, "wb") as fp:
+            fp.write(image)
+        os.replace(tmp_path, self.image_path)
+        meta = dict(
+            device=self.device,
+            board=board_id,
+            offset=offset,
+            size=len(image),
+            sha1=hashlib.sha1(image).hexdigest(),
+        )
+        tmp_path = "%s.%d.tmp" % (self.meta_path, os.getpid())
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            json.dump(meta, fp)
+        os.replace(tmp_path, self.meta_path)
+
+
+def plan_upload(old, new, block_size):
+    """Return a list of (start, end) ranges to write or None for full flash"""
+    if old is None or not block_size:
+        return None
+    ranges = get_changed_ranges(old, new, block_size)
+    if sum(end - start for start, end in ranges) > len(new) * MAX_CHANGED_RATIO:
+        return None
+    return ranges
@@ -0,0 +1,240 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Flash CRC32 computed by the Device Service Unit of SAM D/E devices
+
+The DSU calculates the IEEE 802.3 CRC32 of a memory range in hardware. The
+result register holds the CRC before the final inversion, so it matches
+"zlib.crc32()" of the same bytes after XOR with 0xFFFFFFFF. The same register
+sequence is expressed for the different access paths: OpenOCD TCL, J-Link
+Commander, GDB (BlackMagic) and the SAM-BA monitor of the bootloaders.
+"""
+
+import re
+import time
+import zlib
+from collections import namedtuple
+
+DSU_BASE = 0x41002000
+DSU_CTRL = DSU_BASE + 0x0
+DSU_STATUSA = DSU_BASE + 0x1
+DSU_ADDR = DSU_BASE + 0x4
+DSU_LENGTH = DSU_BASE + 0x8
+DSU_DATA = DSU_BASE + 0xC
+
+CTRL_CRC = 1 << 2
+STATUSA_DONE = 1 << 0
+STATUSA_BERR = 1 << 2
+STATUSA_FAIL = 1 << 3
+STATUSA_CLEAR = 0x1F
+
+# the DSU is write-protected by the Peripheral Access Controller after reset
+Write = namedtuple("Write", "address width value")
+PAC_UNLOCK = {
+    # PAC1->WPCLR = DSU
+    "samd": Write(0x41000000, 32, 1 << 1),
+    # PAC->WRCTRL = KEY_CLR | PERID(DSU)
+    "samd5x": Write(0x40000000, 32, (1 << 16) | 33),
+}
+
+
+class DsuError(Exception):
+    pass
+
+
+def get_family(mcu):
+    mcu = mcu.lower()
+    if mcu.startswith(("samd51", "same51", "same53", "same54")):
+        return "samd5x"
+    if mcu.startswith(("samd09", "samd10", "samd11", "samd20", "samd21",
+                       "samda1", "samr21")):
+        return "samd"
+    return None
+
+
+def get_image_crc(data):
+    """(length, crc) of the image padded to whole words with erased flash"""
+    if len(data) % 4:
+        data += b"\xff" * (4 - len(data) % 4)
+    return len(data), zlib.crc32(data) & 0xFFFFFFFF
+
+
+def get_writes(family, start, length):
+    return [
+        PAC_UNLOCK[family],
+        Write(DSU_STATUSA, 8, STATUSA_CLEAR),
+        Write(DSU_ADDR, 32, start),
+        Write(DSU_LENGTH, 32, length),
+        Write(DSU_DATA, 32, 0xFFFFFFFF),
+        Write(DSU_CTRL, 8, CTRL_CRC),
+    ]
+
+
+def decode_result(status, data):
+    if not status & STATUSA_DONE:
+        raise DsuError("CRC calculation did not finish")
+    if status & (STATUSA_BERR | STATUSA_FAIL):
+        # e.g. the range is outside of the flash or the device is protected
+        raise DsuError("CRC calculation failed (STATUSA 0x%02X)" % status)
+    return (data ^ 0xFFFFFFFF) & 0xFFFFFFFF
+
+
+#
+# OpenOCD
+#
+
+
+def get_openocd_script(family, start, length):
+    """TCL that defines "pio_dsu_crc", the procedure returns
+    "<STATUSA> <DATA>" and leaves the target running"""
+    read = (
+        "proc pio_rd {addr width} {"
+        " if {[llength [info commands read_memory]]} {"
+        " return [expr {[read_memory $addr $width 1]}] };"
+        " mem2array pio_v $width $addr 1; return $pio_v(0) }")
+    commands = ["reset halt"]
+    for item in get_writes(family, start, length):
+        commands.append("%s 0x%08x 0x%x" % (
+            {8: "mwb", 32: "mww"}[item.width], item.address, item.value))
+    commands.extend([
+        "set s 0",
+        "for {set i 0} {$i < 1000} {incr i} {"
+        " set s [pio_rd 0x%08x 8]; if {$s & 1} break; sleep 1 }"
+        % DSU_STATUSA,
+        "set d [pio_rd 0x%08x 32]" % DSU_DATA,
+        "reset run",
+        'return [format "%d %d" $s $d]',
+    ])
+    return "%s; proc pio_dsu_crc {} { %s }" % (read, "; ".join(commands))
+
+
+def parse_openocd_result(text):
+    # a one-shot OpenOCD run prints "PIO_DSU <STATUSA> <DATA>" among its log
+    match = re.search(r"^(?:PIO_DSU )?(\d+) (\d+)\s*$", text, re.M)
+    if not match:
+        raise DsuError("Unexpected OpenOCD response: %s" % text.strip())
+    return decode_result(int(match.group(1)), int(match.group(2)))
+
+
+#
+# J-Link Commander
+#
+
+
+def get_jlink_script(family, start, length, wait_ms=200):
+    commands = ["h"]
+    for item in get_writes(family, start, length):
+        commands.append("w%d 0x%08X, 0x%X" % (
+            item.width // 8, item.address, item.value))
+    commands.extend([
+        "Sleep %d" % wait_ms,
+        "mem8 0x%08X, 1" % DSU_STATUSA,
+        "mem32 0x%08X, 1" % DSU_DATA,
+        "r",
+        "g",
+        "q",
+    ])
+    return commands
+
+
+def parse_jlink_output(text):
+    status = re.search(r"%08X = ([0-9A-F]{2})" % DSU_STATUSA, text, re.I)
+    data = re.search(r"%08X = ([0-9A-F]{8})" % DSU_DATA, text, re.I)
+    if not status or not data:
+        raise DsuError("Could not read the DSU registers over J-Link")
+    return decode_result(int(status.group(1), 16), int(data.group(1), 16))
+
+
+#
+# GDB (BlackMagic)
+#
+
+
+def get_gdb_commands(family, start, length):
+    commands = []
+    for item in get_writes(family, start, length):
+        commands.append("set *(unsigned %s *)0x%08x = 0x%x" % (
+            {8: "char", 32: "int"}[item.width], item.address, item.value))
+    commands.extend([
+        "x/1xb 0x%08x" % DSU_STATUSA,
+        "x/1xw 0x%08x" % DSU_DATA,
+    ])
+    return commands
+
+
+def parse_gdb_output(text):
+    status = re.search(r"0x%08x[^:]*:\s+0x([0-9a-f]+)" % DSU_STATUSA, text)
+    data = re.search(r"0x%08x[^:]*:\s+0x([0-9a-f]+)" % DSU_DATA, text)
+    if not status or not data:
+        raise DsuError("Could not read the DSU registers over GDB")
+    return decode_result(int(status.group(1), 16), int(data.group(1), 16))
+
+
+#
+# SAM-BA monitor (bootloaders used with "bossac")
+#
+
+
+class SamBaMonitor(object):
+
+    def __init__(self, port, baudrate=115200, timeout=1):
+        from serial import Serial  # pylint: disable=C0415
+
+        self.serial = Serial(port, baudrate, timeout=timeout)
+        # switch the monitor to binary mode
+        self.serial.write(b"N#")
+        self.serial.read(2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.serial.close()
+
+    def write(self, address, width, value):
+        command = {8: "O%08X,%02X#", 32: "W%08X,%08X#"}[width]
+        self.serial.write((command % (address, value)).encode())
+
+    def read(self, address, width):
+        command = {8: "o%08X,1#", 32: "w%08X,4#"}[width]
+        self.serial.write((command % address).encode())
+        data = self.serial.read(width // 8)
+        if len(data) != width // 8:
+            raise DsuError("No response from the SAM-BA monitor")
+        return int.from_bytes(data, "little")
+
+    def reset(self):
+        # SCB->AIRCR = VECTKEY | SYSRESETREQ
+        self.write(0xE000ED0C, 32, 0x05FA0004)
+
+    def get_crc(self, family, start, length, timeout=2):
+        for item in get_writes(family, start, length):
+            self.write(*item)
+        deadline = time.time() + timeout
+        status = self.read(DSU_STATUSA, 8)
+        while not status & STATUSA_DONE and time.time() < deadline:
+            time.sleep(0.001)
+            status = self.read(DSU_STATUSA, 8)
+        return decode_result(status, self.read(DSU_DATA, 32))
+
+    def check_crc(self, family, start, length, crc):
+        """CRC32 of the range, the device is reset into the firmware only
+        if it matches "crc". Otherwise the bootloader is left running for
+        the upload that follows."""
+        device_crc = self.get_crc(family, start, length)
+        if device_crc == crc:
+            self.reset()
+        return device_crc
@@ -0,0 +1,308 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Minimal memory-mapped ELF reader
+
+Produces the same raw binary and Intel HEX images as GNU objcopy
+("-O binary" / "-O ihex") and the section table of "size -A" without
+spawning the toolchain.
+"""
+
+import mmap
+import struct
+from collections import namedtuple
+
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHT_RELA = 4
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_SYMTAB_SHNDX = 18
+SHF_WRITE = 0x1
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+PT_LOAD = 1
+
+Section = namedtuple(
+    "Section", "name type flags addr offset size link info entsize lma")
+Segment = namedtuple(
+    "Segment", "type offset vaddr paddr filesz memsz flags")
+Symbol = namedtuple("Symbol", "name value size type bind shndx")
+
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_FILE = 4
+STB_LOCAL = 0
+STB_GLOBAL = 1
+STB_WEAK = 2
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xFF00
+EM_ARM = 40
+
+
+class ElfError(Exception):
+    pass
+
+
+class ElfFile(object):
+    def __init__(self, path, data=None):
+        """Map "path" or, for archive members, parse "data" in memory"""
+        self.path = path
+        if data is None:
+            with open(path, "rb") as fp:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = data
+        try:
+            self._parse()
+        except (struct.error, IndexError, ValueError) as e:
+            self.close()
+            raise ElfError("%s: malformed ELF file (%s)" % (path, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+
+    def _parse(self):
+        data = self._data
+        if data[:4] != b"\x7fELF":
+            raise ElfError("%s: not an ELF file" % self.path)
+        if data[5] != 1:
+            raise ElfError("%s: big-endian ELF files are not supported" %
+                           self.path)
+        self.elfclass = 64 if data[4] == 2 else 32
+        if self.elfclass == 32:
+            header = struct.unpack_from("<HHIIIIIHHHHHH", data, 16)
+            ph_fmt, sh_fmt = "<IIIIIIII", "<IIIIIIIIII"
+        else:
+            header = struct.unpack_from("<HHIQQQIHHHHHH", data, 16)
+            ph_fmt, sh_fmt = "<IIQQQQQQ", "<IIQQQQIIQQ"
+        (self.type, self.machine, _, self.entry, phoff, shoff, _, _, phentsize,
+         phnum, shentsize, shnum, self.shstrndx) = header
+
+        self.segments = []
+        for index in range(phnum):
+            values = struct.unpack_from(ph_fmt, data, phoff + index * phentsize)
+            if self.elfclass == 32:
+                p_type, offset, vaddr, paddr, filesz, memsz, flags, _ = values
+            else:
+                p_type, flags, offset, vaddr, paddr, filesz, memsz, _ = values
+            self.segments.append(
+                Segment(p_type, offset, vaddr, paddr, filesz, memsz, flags))
+
+        headers = [
+            struct.unpack_from(sh_fmt, data, shoff + index * shentsize)
+            for index in range(shnum)
+        ]
+        strtab = headers[self.shstrndx] if headers else None
+        self.sections = []
+        for (name, sh_type, flags, addr, offset, size, link, info, _,
+             entsize) in headers[1:]:
+            self.sections.append(Section(
+                self._get_string(strtab[4], name), sh_type, flags, addr,
+                offset, size, link, info, entsize,
+                self._get_lma(sh_type, flags, addr, offset, size)))
+
+    def _get_string(self, offset, index):
+        end = self._data.find(b"\0", offset + index)
+        return self._data[offset + index:end].decode("utf8", "replace")
+
+    def _get_lma(self, sh_type, flags, addr, offset, size):
+        # the same rules as BFD's _bfd_elf_make_section_from_shdr
+        lma = addr
+        if not flags & SHF_ALLOC:
+            return lma
+        for segment in self.segments:
+            if segment.type != PT_LOAD:
+                continue
+            if sh_type != SHT_NOBITS and not (
+                    offset >= segment.offset and
+                    offset - segment.offset + size <= segment.filesz and
+                    (size == 0 or
+                     offset - segment.offset <= segment.filesz - 1)):
+                continue
+            if not (addr >= segment.vaddr and
+                    addr - segment.vaddr + size <= segment.memsz and
+                    (size == 0 or addr - segment.vaddr <= segment.memsz - 1)):
+                continue
+            if sh_type == SHT_NOBITS:
+                lma = segment.paddr + addr - segment.vaddr
+            else:
+                lma = segment.paddr + offset - segment.offset
+            if (addr >= segment.vaddr and
+                    addr + size <= segment.vaddr + segment.memsz):
+                break
+        return lma
+
+    def iter_symbols(self):
+        """Entries of ".symtab" in table order (STT_FILE symbols included)"""
+        for section in self.sections:
+            if section.type != SHT_SYMTAB:
+                continue
+            strtab = self.sections[section.link - 1]
+            if self.elfclass == 32:
+                fmt, entsize = "<IIIBBH", 16
+            else:
+                fmt, entsize = "<IBBHQQ", 24
+            for offset in range(
+                    section.offset + entsize,
+                    section.offset + section.size - entsize + 1, entsize):
+                values = struct.unpack_from(fmt, self._data, offset)
+                if self.elfclass == 32:
+                    name, value, size, info, _, shndx = values
+                else:
+                    name, info, _, shndx, value, size = values
+                yield Symbol(
+                    self._get_string(strtab.offset, name), value, size,
+                    info & 0xF, info >> 4, shndx)
+
+    def get_section_data(self, section):
+        if section.type == SHT_NOBITS:
+            return b""
+        return self._data[section.offset:section.offset + section.size]
+
+    def get_loadable_sections(self, exclude=None):
+        """Sections objcopy puts into binary/ihex images, in file order"""
+        return [
+            s for s in self.sections
+            if s.flags & SHF_ALLOC and s.type != SHT_NOBITS and s.size > 0 and
+            s.name not in (exclude or ())
+        ]
+
+
+def to_binary(elf, exclude=None):
+    sections = elf.get_loadable_sections(exclude)
+    if not sections:
+        return b""
+    base = min(s.lma for s in sections)
+    image = bytearray(max(s.lma + s.size for s in sections) - base)
+    for section in sections:
+        start = section.lma - base
+        image[start:start + section.size] = elf.get_section_data(section)
+    return bytes(image)
+
+
+def _ihex_record(count, addr, rec_type, data=b""):
+    checksum = count + (addr >> 8) + addr + rec_type + sum(data)
+    return ":%02X%04X%02X%s%02X\r\n" % (
+        count, addr & 0xFFFF, rec_type, data.hex().upper(),
+        -checksum & 0xFF)
+
+
+def to_ihex(elf, exclude=None):
+    """Intel HEX image, record by record identical to BFD's ihex writer"""
+    chunks = sorted(
+        elf.get_loadable_sections(exclude), key=lambda s: s.lma)
+    lines = []
+    segbase = 0
+    extbase = 0
+    for section in chunks:
+        data = elf.get_section_data(section)
+        where = section.lma
+        position = 0
+        while position < len(data):
+            now = min(len(data) - position, 16)
+            if where > segbase + extbase + 0xFFFF:
+                if extbase == 0 and where <= 0xFFFFF:
+                    segbase = where & 0xF0000
+                    lines.append(_ihex_record(
+                        2, 0, 2, struct.pack(">H", segbase >> 4)))
+                else:
+                    if segbase != 0:
+                        lines.append(_ihex_record(2, 0, 2, b"\0\0"))
+                        segbase = 0
+                    extbase = where & 0xFFFF0000
+                    if where > extbase + 0xFFFF:
+                        raise ElfError(
+                            "address 0x%x out of range for Intel Hex file" %
+                            where)
+                    lines.append(_ihex_record(
+                        2, 0, 4, struct.pack(">H", extbase >> 16)))
+            rec_addr = where - (extbase + segbase)
+            # records shouldn't cross 64K boundaries
+            if rec_addr + now > 0xFFFF:
+                now = 0x10000 - rec_addr
+            lines.append(_ihex_record(
+                now, rec_addr, 0, data[position:position + now]))
+            where += now
+            position += now
+    if elf.entry:
+        if elf.entry <= 0xFFFFF:
+            lines.append(_ihex_record(4, 0, 3, struct.pack(
+                ">HH", (elf.entry & 0xF0000) >> 4, elf.entry & 0xFFFF)))
+        else:
+            lines.append(_ihex_record(4, 0, 5, struct.pack(">I", elf.entry)))
+    lines.append(_ihex_record(0, 0, 1))
+    return "".join(lines)
+
+
+def get_section_sizes(elf):
+    """(name, size, addr) rows like "size -A -d" prints them"""
+    # BFD does not expose the symbol table, its string tables and the
+    # relocations against other sections as sections of their own
+    symtabs = [
+        index for index, s in enumerate(elf.sections, 1)
+        if s.type == SHT_SYMTAB
+    ]
+    hidden = set([elf.shstrndx])
+    hidden.update(elf.sections[index - 1].link for index in symtabs)
+    result = []
+    for index, section in enumerate(elf.sections, 1):
+        if index in hidden or section.type in (SHT_SYMTAB, SHT_SYMTAB_SHNDX):
+            continue
+        if (section.type in (SHT_REL, SHT_RELA) and section.info and
+                section.link in symtabs and not section.flags & SHF_ALLOC):
+            continue
+        result.append((section.name, section.size, section.addr))
+    return result
+
+
+def iter_archive_members(path):
+    """Yield (member name, data) of a GNU/BSD "ar" archive"""
+    with open(path, "rb") as fp:
+        data = fp.read()
+    if data[:8] != b"!<arch>\n":
+        raise ElfError("%s: not an archive" % path)
+    long_names = b""
+    offset = 8
+    while offset + 60 <= len(data):
+        header = data[offset:offset + 60]
+        name = header[:16].decode("utf8", "replace").rstrip()
+        size = int(header[48:58].decode().strip() or 0)
+        offset += 60
+        body = data[offset:offset + size]
+        offset += size + (size & 1)
+        if name == "//":
+            long_names = body
+            continue
+        if name in ("/", "/SYM64/", "__.SYMDEF", "__.SYMDEF SORTED"):
+            continue
+        if name.startswith("#1/"):
+            length = int(name[3:])
+            name, body = body[:length].rstrip(b"\0").decode("utf8"), body[length:]
+        elif name.startswith("/") and name[1:].isdigit():
+            start = int(name[1:])
+            name = long_names[start:long_names.index(b"/\n", start)].decode(
+                "utf8")
+        else:
+            name = name.rstrip("/")
+        yield name, body
@@ -0,0 +1,391 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Linker map footprint database
+
+Parses GNU ld map files into a SQLite database with one snapshot per
+build, so that placement of input sections and symbols can be compared
+between consecutive builds and checked against per-env budgets.
+"""
+
+import os
+import re
+import time
+
+OUTPUT_SECTION_RE = re.compile(
+    r"^(\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)"
+    r"(?:\s+load address 0x([0-9a-fA-F]+))?\s*$")
+INPUT_SECTION_RE = re.compile(
+    r"^ (\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*?)\s*$")
+SYMBOL_RE = re.compile(r"^\s+0x([0-9a-fA-F]+)\s+([A-Za-z_.$][\w.$]*)\s*$")
+MEMORY_RE = re.compile(
+    r"^(\S+)\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)(?:\s+(\S+))?\s*$")
+FILL_RE = re.compile(r"^ \*fill\*\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)")
+ARCHIVE_RE = re.compile(r"([^/\\]+)\.a\((.+)\)$")
+NOLOAD_SECTIONS = (".bss", ".noinit", ".heap", ".stack", ".dynbss")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    env TEXT NOT NULL,
+    time REAL NOT NULL,
+    flash INTEGER NOT NULL,
+    ram INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS placements (
+    build_id INTEGER NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+    output TEXT NOT NULL,
+    input TEXT NOT NULL,
+    address INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    object TEXT NOT NULL,
+    library TEXT NOT NULL,
+    flash INTEGER NOT NULL,
+    ram INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    build_id INTEGER NOT NULL REFERENCES builds(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    address INTEGER NOT NULL,
+    input TEXT NOT NULL,
+    object TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS builds_env ON builds(env, id);
+CREATE INDEX IF NOT EXISTS placements_build ON placements(build_id, library);
+CREATE INDEX IF NOT EXISTS symbols_build ON symbols(build_id, name);
+"""
+
+KEEP_BUILDS = 100
+# budgets of the whole build, any other name is a library
+BUILD_BUDGETS = ("flash", "ram", "growth")
+
+
+def get_library(obj, build_dir=None):
+    match = ARCHIVE_RE.search(obj)
+    if match:
+        name = match.group(1)
+        return name[3:] if name.startswith("lib") else name
+    if build_dir:
+        try:
+            relpath = os.path.relpath(obj, build_dir)
+        except ValueError:
+            relpath = obj
+        parts = relpath.replace("\\", "/").split("/")
+        if not relpath.startswith("..") and len(parts) > 1:
+            return parts[0]
+    return "(objects)"
+
+
+def _get_memory_kind(region):
+    name = region["name"].upper()
+    if "FLASH" in name or "ROM" in name:
+        return "flash"
+    if "RAM" in name:
+        return "ram"
+    return "flash" if "x" in region["attributes"] and \
+        "w" not in region["attributes"] else "ram"
+
+
+def parse_map(path, build_dir=None, section_usage=None):
+    """Parse a GNU ld map file.
+
+    "section_usage" maps output section names to (flash, ram) sizes taken
+    from the linked ELF file. Without it memory kinds are guessed from the
+    memory regions and well-known NOLOAD section names.
+    """
+    regions = []
+    outputs = []
+    placements = []
+    symbols = []
+    state = None
+    pending = None
+    output = None
+    last_input = None
+
+    with open(path, encoding="utf8", errors="replace") as fp:
+        for line in fp:
+            line = line.rstrip("\r\n")
+            if line.startswith("Memory Configuration"):
+                state = "memory"
+                continue
+            if line.startswith("Linker script and memory map"):
+                state = "map"
+                continue
+            if line.startswith(("Cross Reference Table", "OUTPUT(")):
+                state = None
+                continue
+            if state == "memory":
+                match = MEMORY_RE.match(line)
+                if match and match.group(1) not in ("Name", "*default*"):
+                    regions.append(dict(
+                        name=match.group(1),
+                        origin=int(match.group(2), 16),
+                        length=int(match.group(3), 16),
+                        attributes=match.group(4) or ""))
+                continue
+            if state != "map" or not line.strip():
+                continue
+
+            # long section names are followed by a line with the values
+            if pending is not None:
+                line = pending + line
+                pending = None
+            elif re.match(r"^ ?\S+$", line) and not line.strip().startswith(
+                    ("*", "LOAD", "START", "END", "OUTPUT")):
+                pending = line
+                continue
+
+            if not line.startswith(" "):
+                match = OUTPUT_SECTION_RE.match(line)
+                if match and match.group(1):
+                    output = dict(
+                        name=match.group(1),
+                        address=int(match.group(2), 16),
+                        size=int(match.group(3), 16),
+                        lma=int(match.group(4) or match.group(2), 16))
+                    outputs.append(output)
+                else:
+                    output = None
+                continue
+            if output is None:
+                continue
+            match = FILL_RE.match(line)
+            if match:
+                placements.append(dict(
+                    output=output["name"], input="*fill*",
+                    address=int(match.group(1), 16),
+                    size=int(match.group(2), 16), object="*fill*",
+                    library="*fill*"))
+                continue
+            match = INPUT_SECTION_RE.match(line)
+            if match and match.group(1) and not match.group(1).startswith("*("):
+                size = int(match.group(3), 16)
+                if size:
+                    last_input = dict(
+                        output=output["name"],
+                        input=match.group(1),
+                        address=int(match.group(2), 16),
+                        size=size,
+                        object=match.group(4),
+                        library=get_library(match.group(4), build_dir))
+                    placements.append(last_input)
+                continue
+            match = SYMBOL_RE.match(line)
+            if match and last_input and last_input["output"] == output["name"]:
+                symbols.append(dict(
+                    name=match.group(2),
+                    address=int(match.group(1), 16),
+                    input=last_input["input"],
+                    object=last_input["object"]))
+
+    _classify(regions, outputs, placements, section_usage)
+    return dict(regions=regions, outputs=outputs, placements=placements,
+                symbols=symbols)
+
+
+def _classify(regions, outputs, placements, section_usage=None):
+    def _kind(address):
+        for region in regions:
+            if region["origin"] <= address < region["origin"] + region["length"]:
+                return _get_memory_kind(region)
+        return None
+
+    kinds = {}
+    for output in outputs:
+        if section_usage and output["name"] in section_usage:
+            flash, ram = section_usage[output["name"]]
+            output["flash"], output["ram"] = bool(flash), bool(ram)
+        else:
+            vma_kind = _kind(output["address"])
+            output["ram"] = vma_kind == "ram"
+            output["flash"] = vma_kind == "flash" or (
+                _kind(output["lma"]) == "flash" and
+                not output["name"].startswith(NOLOAD_SECTIONS))
+        kinds[output["name"]] = output
+    for item in placements:
+        output = kinds[item["output"]]
+        item["flash"] = item["size"] if output["flash"] else 0
+        item["ram"] = item["size"] if output["ram"] else 0
+
+
+def get_library_usage(placements):
+    usage = {}
+    for item in placements:
+        library = usage.setdefault(item["library"], dict(flash=0, ram=0))
+        library["flash"] += item["flash"]
+        library["ram"] += item["ram"]
+    return usage
+
+
+class FootprintDatabase(object):
+    def __init__(self, path):
+        import sqlite3  # pylint: disable=C0415
+
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_snapshot(self, env, parsed):
+        placements = parsed["placements"]
+        with self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO builds (env, time, flash, ram) VALUES (?, ?, ?, ?)",
+                (env, time.time(), sum(p["flash"] for p in placements),
+                 sum(p["ram"] for p in placements)))
+            build_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO placements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(build_id, p["output"], p["input"], p["address"], p["size"],
+                  p["object"], p["library"], p["flash"], p["ram"])
+                 for p in placements])
+            self._conn.executemany(
+                "INSERT INTO symbols VALUES (?, ?, ?, ?, ?)",
+                [(build_id, s["name"], s["address"], s["input"], s["object"])
+                 for s in parsed["symbols"]])
+            self._conn.execute(
+                "DELETE FROM builds WHERE env = ? AND id NOT IN "
+                "(SELECT id FROM builds WHERE env = ? ORDER BY id DESC LIMIT ?)",
+                (env, env, KEEP_BUILDS))
+        return build_id
+
+    def reset(self, env):
+        """Drop the snapshots of "env", the next build becomes the
+        reference for the growth budget. Returns the number of dropped
+        snapshots"""
+        with self._conn:
+            return self._conn.execute(
+                "DELETE FROM builds WHERE env = ?", (env,)).rowcount
+
+    def get_builds(self, env, limit=10):
+        return [
+            dict(id=row[0], time=row[1], flash=row[2], ram=row[3])
+            for row in self._conn.execute(
+                "SELECT id, time, flash, ram FROM builds WHERE env = ? "
+                "ORDER BY id DESC LIMIT ?", (env, limit))
+        ]
+
+    def get_libraries(self, build_id):
+        return dict(
+            (row[0], dict(flash=row[1], ram=row[2]))
+            for row in self._conn.execute(
+                "SELECT library, SUM(flash), SUM(ram) FROM placements "
+                "WHERE build_id = ? GROUP BY library", (build_id,)))
+
+    def diff(self, old_id, new_id, limit=20):
+        """Libraries and input sections that changed between two builds"""
+        old_libs = self.get_libraries(old_id)
+        new_libs = self.get_libraries(new_id)
+        libraries = []
+        for name in sorted(set(old_libs) | set(new_libs)):
+            old = old_libs.get(name, dict(flash=0, ram=0))
+            new = new_libs.get(name, dict(flash=0, ram=0))
+            if old != new:
+                libraries.append(dict(
+                    name=name, flash=new["flash"] - old["flash"],
+                    ram=new["ram"] - old["ram"]))
+        sections = [
+            dict(input=row[0], object=row[1], flash=row[2], ram=row[3])
+            for row in self._conn.execute(
+                """
+                SELECT input, object, SUM(flash) AS flash, SUM(ram) AS ram
+                FROM (
+                    SELECT input, object, flash, ram FROM placements
+                    WHERE build_id = ?
+                    UNION ALL
+                    SELECT input, object, -flash, -ram FROM placements
+                    WHERE build_id = ?
+                )
+                GROUP BY input, object
+                HAVING SUM(flash) != 0 OR SUM(ram) != 0
+                ORDER BY ABS(SUM(flash)) + ABS(SUM(ram)) DESC
+                LIMIT ?
+                """, (new_id, old_id, limit))
+        ]
+        return dict(libraries=libraries, sections=sections)
+
+
+def parse_budgets(value):
+    """"flash: 200K, ram: 28000, FrameworkArduino: 40K, growth: 512" """
+    budgets = {}
+    if isinstance(value, dict):
+        items = [(key, str(limit), "%s: %s" % (key, limit))
+                 for key, limit in value.items()]
+    else:
+        items = []
+        for item in str(value or "").replace("\n", ",").split(","):
+            if not item.strip():
+                continue
+            if ":" not in item:
+                raise ValueError("Invalid footprint budget '%s', expected "
+                                 "'<name>: <bytes>'" % item.strip())
+            items.append(item.split(":", 1) + [item.strip()])
+    for key, limit, entry in items:
+        limit = str(limit).strip()
+        multiplier = 1
+        if limit[-1:] in ("k", "K"):
+            multiplier, limit = 1024, limit[:-1]
+        try:
+            budgets[key.strip()] = int(float(limit) * multiplier)
+        except ValueError:
+            raise ValueError("Invalid footprint budget '%s', expected "
+                             "'<name>: <bytes>'" % entry) from None
+    return budgets
+
+
+def check_budgets(budgets, build, libraries, previous=None):
+    """Return a list of violated budgets"""
+    errors = []
+    for key in ("flash", "ram"):
+        if key in budgets and build[key] > budgets[key]:
+            errors.append("%s usage %d bytes exceeds the budget of %d bytes" % (
+                key.upper() if key == "ram" else key.capitalize(),
+                build[key], budgets[key]))
+    if "growth" in budgets and previous:
+        growth = build["flash"] + build["ram"] - (
+            previous["flash"] + previous["ram"])
+        if growth > budgets["growth"]:
+            errors.append(
+                "Footprint grew by %d bytes since the previous build, "
+                "more than %d bytes allowed (run the `footprint_reset` "
+                "target to accept it)" % (growth, budgets["growth"]))
+    for name, limit in sorted(budgets.items()):
+        if name in BUILD_BUDGETS:
+            continue
+        usage = libraries.get(name)
+        if usage and usage["flash"] + usage["ram"] > limit:
+            errors.append(
+                "Library %s uses %d bytes (flash %d, RAM %d), budget is %d" % (
+                    name, usage["flash"] + usage["ram"], usage["flash"],
+                    usage["ram"], limit))
+    return errors
+
+
+def get_unknown_budgets(budgets, libraries):
+    """Library budgets that match no library of the build, e.g. a
+    misspelled name that would never be checked"""
+    return sorted(
+        name for name in budgets
+        if name not in BUILD_BUDGETS and name not in libraries)
@@ -0,0 +1,389 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ITM/DWT trace over SWO (Cortex-M3/M4)
+
+Target setup: the OpenOCD commands that route the TPIU output into a file and
+enable the ITM stimulus ports, DWT PC sampling and exception trace.
+
+Decoding: a generator pipeline over the raw SWO byte stream, it works the
+same on a growing file of a running capture and on a recorded one:
+
+    iter_packets(chunks) -> decode_events(packets) -> consumers
+    (StimulusStreams, PcHistogram with the ELF symbols of the firmware)
+"""
+
+import bisect
+import collections
+import os
+import time
+
+from atmelsam.elf import ElfFile
+
+STT_FUNC = 2
+
+# ARMv7-M debug registers
+DEMCR = 0xE000EDFC
+DEMCR_TRCENA = 1 << 24
+ITM_TER = 0xE0000E00
+ITM_TPR = 0xE0000E40
+ITM_TCR = 0xE0000E80
+ITM_LAR = 0xE0000FB0
+ITM_LAR_KEY = 0xC5ACCE55
+ITM_TCR_ITMENA = 1 << 0
+ITM_TCR_SYNCENA = 1 << 2
+ITM_TCR_TXENA = 1 << 3  # forward DWT packets
+ITM_TCR_TRACE_BUS_ID = 1 << 16
+DWT_CTRL = 0xE0001000
+DWT_CTRL_CYCCNTENA = 1 << 0
+DWT_CTRL_POSTPRESET_SHIFT = 1
+DWT_CTRL_CYCTAP = 1 << 9  # POSTCNT counts every 1024 cycles
+DWT_CTRL_PCSAMPLENA = 1 << 12
+DWT_CTRL_EXCTRCENA = 1 << 16
+TPIU_BASE = 0xE0040000
+
+# SWO is multiplexed with PB30 (peripheral function H) on SAMD51/SAME5x,
+# SAM3X routes TRACESWO to PB30 by default
+SAMD5X_PB30_PMUX = (0x410080BC, 0x07 << 24, 0x0F << 24)
+SAMD5X_PB30_PINCFG = (0x410080DC, 0x01 << 16, 0)
+
+EXCEPTION_NAMES = {
+    1: "Reset", 2: "NMI", 3: "HardFault", 4: "MemManage", 5: "BusFault",
+    6: "UsageFault", 11: "SVCall", 12: "DebugMonitor", 14: "PendSV",
+    15: "SysTick",
+}
+EXCEPTION_ACTIONS = {1: "enter", 2: "exit", 3: "return"}
+
+
+def is_supported(cpu):
+    # Cortex-M0+ has neither ITM nor SWO
+    return cpu in ("cortex-m3", "cortex-m4")
+
+
+def parse_ports(value):
+    """Stimulus port numbers from "0, 1, 31", all ports when empty"""
+    ports = sorted(set(
+        int(item) for item in str(value or "").replace(",", " ").split()))
+    if not ports:
+        return list(range(32))
+    if ports[0] < 0 or ports[-1] > 31:
+        raise ValueError("Stimulus ports are numbered from 0 to 31")
+    return ports
+
+
+#
+# Target setup (OpenOCD)
+#
+
+
+def get_dwt_ctrl(pc_sampling=True, exceptions=True, postpreset=15):
+    """PC sampling period is 1024 * (postpreset + 1) cycles"""
+    value = 0
+    if pc_sampling:
+        value |= (DWT_CTRL_CYCCNTENA | DWT_CTRL_CYCTAP | DWT_CTRL_PCSAMPLENA
+                  | postpreset << DWT_CTRL_POSTPRESET_SHIFT)
+    if exceptions:
+        value |= DWT_CTRL_EXCTRCENA
+    return value
+
+
+def get_openocd_config(output, traceclk, swo_freq):
+    """Commands that run before "init": a TPIU object on OpenOCD 0.12+,
+    remembered for the setup after "init" on older releases"""
+    return (
+        "set pio_tpiu 0; catch {"
+        " tpiu create pio.tpiu -dap [lindex [dap names] 0] -ap-num 0"
+        " -baseaddr 0x%08x;"
+        " pio.tpiu configure -protocol uart -output {%s} -traceclk %d"
+        " -pin-freq %d -formatter 0;"
+        " pio.tpiu enable; set pio_tpiu 1 }" % (
+            TPIU_BASE, output, traceclk, swo_freq))
+
+
+def get_openocd_setup(family, output, traceclk, swo_freq, ports=0xFFFFFFFF,
+                      pc_sampling=True, exceptions=True):
+    """Commands that run after "init", the target keeps running"""
+    commands = [
+        "reset halt",
+        "if {!$pio_tpiu} { tpiu config internal {%s} uart off %d %d }" % (
+            output, traceclk, swo_freq),
+        "mmw 0x%08x 0x%08x 0" % (DEMCR, DEMCR_TRCENA),
+    ]
+    if family == "samd5x":
+        for address, set_bits, clear_bits in (
+                SAMD5X_PB30_PMUX, SAMD5X_PB30_PINCFG):
+            commands.append(
+                "mmw 0x%08x 0x%08x 0x%08x" % (address, set_bits, clear_bits))
+    commands.extend([
+        "mww 0x%08x 0x%08x" % (ITM_LAR, ITM_LAR_KEY),
+        "mww 0x%08x 0x%08x" % (ITM_TCR, ITM_TCR_ITMENA | ITM_TCR_SYNCENA
+                               | ITM_TCR_TXENA | ITM_TCR_TRACE_BUS_ID),
+        "mww 0x%08x 0x%08x" % (ITM_TER, ports),
+        "mww 0x%08x 0" % ITM_TPR,
+        "mww 0x%08x 0x%08x" % (
+            DWT_CTRL, get_dwt_ctrl(pc_sampling, exceptions)),
+        "resume",
+    ])
+    return commands
+
+
+#
+# Decoding
+#
+
+Sync = collections.namedtuple("Sync", "")
+Overflow = collections.namedtuple("Overflow", "")
+Timestamp = collections.namedtuple("Timestamp", "delta relation")
+Extension = collections.namedtuple("Extension", "value hardware")
+Source = collections.namedtuple("Source", "hardware id size value")
+Garbage = collections.namedtuple("Garbage", "byte")
+
+Stimulus = collections.namedtuple("Stimulus", "port size value time")
+PcSample = collections.namedtuple("PcSample", "pc time")  # pc None: sleeping
+ExceptionTrace = collections.namedtuple(
+    "ExceptionTrace", "number name action time")
+EventCounter = collections.namedtuple("EventCounter", "mask time")
+DataTrace = collections.namedtuple(
+    "DataTrace", "comparator kind size value time")
+TraceOverflow = collections.namedtuple("TraceOverflow", "time")
+
+
+def iter_file(path, follow=None, interval=0.05, chunk_size=64 * 1024):
+    """Chunks of a trace file, "follow" keeps reading the growing file of
+    a running capture while it returns True"""
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if chunk:
+                yield chunk
+            elif follow and follow():
+                time.sleep(interval)
+            else:
+                return
+
+
+def _iter_bytes(chunks):
+    for chunk in chunks:
+        yield from chunk
+
+
+def _read_continuation(data, header, limit):
+    """7-bit groups of the bytes that follow a header with bit 7 set"""
+    value = 0
+    shift = 0
+    byte = header
+    while byte & 0x80 and shift < 7 * limit:
+        byte = next(data)
+        value |= (byte & 0x7F) << shift
+        shift += 7
+    return value
+
+
+def iter_packets(chunks):
+    """ITM protocol and source packets of a raw SWO byte stream, a packet
+    may span several chunks"""
+    data = _iter_bytes(chunks)
+    pending = None
+    while True:
+        try:
+            header = pending if pending is not None else next(data)
+            pending = None
+            if header == 0x00:
+                # synchronization: at least 47 zero bits and a one
+                zeros = 1
+                byte = next(data)
+                while byte == 0x00:
+                    zeros += 1
+                    byte = next(data)
+                if byte == 0x80 and zeros >= 5:
+                    yield Sync()
+                else:
+                    yield Garbage(0)
+                    pending = byte
+            elif header == 0x70:
+                yield Overflow()
+            elif header & 0x03:
+                size = {1: 1, 2: 2, 3: 4}[header & 0x03]
+                value = 0
+                for i in range(size):
+                    value |= next(data) << (8 * i)
+                yield Source(bool(header & 0x04), header >> 3, size, value)
+            elif header & 0x0F == 0:
+                if header & 0x80:
+                    yield Timestamp(
+                        _read_continuation(data, header, 4), header >> 4 & 0x03)
+                else:
+                    yield Timestamp(header >> 4 & 0x07, 0)
+            elif header in (0x94, 0xB4):
+                _read_continuation(data, header, 4)  # global timestamps
+            elif header & 0x0B == 0x08:
+                yield Extension(
+                    header >> 4 & 0x07 | _read_continuation(
+                        data, header, 4) << 3, bool(header & 0x04))
+            else:
+                yield Garbage(header)
+        except StopIteration:
+            return
+
+
+def decode_events(packets):
+    """Stimulus port writes and DWT events, "time" accumulates the local
+    timestamps (in timestamp prescaler units)"""
+    now = 0
+    for packet in packets:
+        kind = type(packet)
+        if kind is Timestamp:
+            now += packet.delta
+        elif kind is Overflow:
+            yield TraceOverflow(now)
+        elif kind is not Source:
+            continue
+        elif not packet.hardware:
+            yield Stimulus(packet.id, packet.size, packet.value, now)
+        elif packet.id == 0:
+            yield EventCounter(packet.value, now)
+        elif packet.id == 1:
+            number = packet.value & 0x1FF
+            yield ExceptionTrace(
+                number, get_exception_name(number),
+                EXCEPTION_ACTIONS.get(packet.value >> 12 & 0x03, "unknown"),
+                now)
+        elif packet.id == 2:
+            yield PcSample(packet.value if packet.size == 4 else None, now)
+        elif 8 <= packet.id <= 23:
+            if packet.id < 16:
+                kind = "address" if packet.id & 0x01 else "pc"
+            else:
+                kind = "write" if packet.id & 0x01 else "read"
+            yield DataTrace(
+                packet.id >> 1 & 0x03, kind, packet.size, packet.value, now)
+
+
+def get_exception_name(number):
+    if number >= 16:
+        return "IRQ%d" % (number - 16)
+    return EXCEPTION_NAMES.get(number, "Exception%d" % number)
+
+
+class StimulusStreams(object):
+    """Reassemble the characters written to stimulus ports into lines"""
+
+    def __init__(self, ports=None):
+        self.ports = ports
+        self._buffers = collections.defaultdict(bytearray)
+
+    def feed(self, event):
+        """Completed (port, line) pairs"""
+        if self.ports is not None and event.port not in self.ports:
+            return []
+        buffer = self._buffers[event.port]
+        buffer.extend(event.value.to_bytes(event.size, "little"))
+        lines = []
+        while b"\n" in buffer:
+            line, _, rest = bytes(buffer).partition(b"\n")
+            buffer[:] = rest
+            lines.append((event.port, line.decode("utf8", "replace").rstrip("\r")))
+        return lines
+
+
+class Symbolizer(object):
+    def __init__(self, elf_path):
+        functions = {}
+        with ElfFile(elf_path) as elf:
+            for symbol in elf.iter_symbols():
+                if symbol.type == STT_FUNC and symbol.size:
+                    functions[symbol.value & ~1] = (symbol.size, symbol.name)
+        self._starts = sorted(functions)
+        self._functions = [functions[start] for start in self._starts]
+
+    def lookup(self, pc):
+        index = bisect.bisect_right(self._starts, pc) - 1
+        if index >= 0:
+            size, name = self._functions[index]
+            if pc < self._starts[index] + size:
+                return name
+        return None
+
+
+class PcHistogram(object):
+    """Hot functions from DWT PC samples"""
+
+    def __init__(self, symbolizer=None):
+        self.symbolizer = symbolizer
+        self.counts = collections.Counter()
+        self.total = 0
+
+    def feed(self, event):
+        if event.pc is None:
+            name = "<sleep>"
+        else:
+            name = (self.symbolizer.lookup(event.pc)
+                    if self.symbolizer else None) or "0x%08x" % event.pc
+        self.counts[name] += 1
+        self.total += 1
+
+    def format(self, limit=20):
+        """Rows in the profile listing format understood by
+        "board_build.ramfuncs_profile" (hottest first)"""
+        return [
+            "%8d  %5.1f%%  %s" % (count, 100.0 * count / self.total, name)
+            for name, count in self.counts.most_common(limit or None)
+        ]
+
+
+def write_profile(histogram, path):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w", encoding="utf8") as fp:
+        fp.write("# %d PC samples\n" % histogram.total)
+        for row in histogram.format(limit=0):
+            # sleep and samples outside of any function are kept as comments
+            fp.write(("# " if row.endswith(">") or " 0x" in row else "")
+                     + row + "\n")
+    os.replace(tmp_path, path)
+
+
+class TraceSummary(object):
+    """Console view of the decoded events: stimulus lines as they complete,
+    exception and overflow counts and the hot function histogram"""
+
+    def __init__(self, symbolizer=None, ports=None):
+        self.streams = StimulusStreams(ports)
+        self.histogram = PcHistogram(symbolizer)
+        self.exceptions = collections.Counter()
+        self.overflows = 0
+
+    def feed(self, event):
+        """Lines to print right away"""
+        kind = type(event)
+        if kind is Stimulus:
+            return ["[%d] %s" % item for item in self.streams.feed(event)]
+        if kind is PcSample:
+            self.histogram.feed(event)
+        elif kind is ExceptionTrace and event.action == "enter":
+            self.exceptions[event.name] += 1
+        elif kind is TraceOverflow:
+            self.overflows += 1
+        return []
+
+    def format(self, limit=10):
+        lines = ["Hot functions (%d PC samples):" % self.histogram.total]
+        lines.extend(self.histogram.format(limit))
+        if self.exceptions:
+            lines.append("Exceptions entered: %s" % ", ".join(
+                "%s %d" % item for item in self.exceptions.most_common()))
+        if self.overflows:
+            lines.append("ITM overflows: %d (lower the sampling rate or "
+                         "raise the SWO frequency)" % self.overflows)
+        return lines
@@ -0,0 +1,111 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Flash the same firmware to several boards at once"""
+
+import subprocess
+import time
+from os.path import basename
+
+from atmelsam.ports import (PortScanner, find_board_ports, flush_port,
+                            touch_port)
+
+PORT_PLACEHOLDER = "__ATMELSAM_UPLOAD_PORT__"
+
+
+def resolve_ports(value, hwids):
+    if isinstance(value, str):
+        value = [item.strip() for item in value.replace("\n", ",").split(",")]
+    value = [item for item in value or [] if item]
+    if value == ["hwids"]:
+        return find_board_ports(hwids)
+    return value
+
+
+class DeviceUpload(object):
+    def __init__(self, port, command, env_vars, upload_options, scanner,
+                 short_port_name):
+        self.port = port
+        self.upload_port = port
+        self.command = command
+        self.env_vars = env_vars
+        self.upload_options = upload_options
+        self.scanner = scanner
+        self.short_port_name = short_port_name
+        self.returncode = None
+        self.output = ""
+        self.duration = 0
+
+    def _is_enabled(self, name):
+        return bool(self.upload_options.get(name, False))
+
+    def run(self):
+        start = time.time()
+        before = self.scanner.find(self.port) or dict(port=self.port)
+        if not self._is_enabled("disable_flushing"):
+            flush_port(self.port)
+        if self._is_enabled("use_1200bps_touch"):
+            touch_port(self.port, 1200)
+        if self._is_enabled("wait_for_upload_port"):
+            self.upload_port = (
+                self.scanner.wait_for_reenumeration(before) or self.port)
+        port = self.upload_port
+        if self.short_port_name and "/" in port:
+            port = basename(port)
+        result = subprocess.run(
+            self.command.replace(PORT_PLACEHOLDER, port),
+            shell=True,
+            env=self.env_vars,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        self.returncode = result.returncode
+        self.output = result.stdout.decode("utf8", "replace")
+        self.duration = time.time() - start
+        return self
+
+
+def upload_to_ports(ports, command, env_vars, upload_options,
+                    short_port_name=False, jobs=None, verbose=False):
+    """Run touch/re-enumeration/flash pipelines concurrently.
+
+    "command" is the upload command with PORT_PLACEHOLDER in place of the
+    port. Returns a list of finished DeviceUpload objects.
+    """
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=C0415
+
+    scanner = PortScanner()
+    scanner.get_ports()
+    uploads = [
+        DeviceUpload(port, command, env_vars, upload_options, scanner,
+                     short_port_name)
+        for port in ports
+    ]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs or len(uploads) or 1) as executor:
+        for item in executor.map(DeviceUpload.run, uploads):
+            if verbose or item.returncode:
+                print("==> %s" % item.port)
+                print(item.output)
+    elapsed = time.time() - start
+
+    print("")
+    print("%-24s %-24s %-8s %s" % ("Port", "Upload port", "Status", "Time"))
+    for item in uploads:
+        print("%-24s %-24s %-8s %.2fs" % (
+            item.port, item.upload_port,
+            "SUCCESS" if item.returncode == 0 else "FAILED", item.duration))
+    print("%d device(s) in %.2fs" % (len(uploads), elapsed))
+    return uploads
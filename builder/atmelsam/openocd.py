@@ -0,0 +1,219 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Persistent OpenOCD servers driven over the TCL RPC port
+
+A server is started once per probe configuration (interface and target
+scripts, adapter speed) and left running in the background. Uploads then
+only send "program" over the TCL RPC port, without loading the scripts and
+probing the chip again. Servers are tracked in a JSON state file and are
+recognized by a key stored in a TCL variable of the server itself, so a
+stale entry or a foreign OpenOCD on the same port is never reused.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+DEFAULT_TCL_PORT = 6666
+TERMINATOR = b"\x1a"
+KEY_VARIABLE = "pio_server_key"
+
+
+class TclRpcError(Exception):
+    pass
+
+
+class TclRpcClient(object):
+    """OpenOCD TCL RPC: commands and responses end with 0x1A"""
+
+    def __init__(self, port=DEFAULT_TCL_PORT, host="127.0.0.1", timeout=60):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self._buffer = b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, command):
+        self.sock.sendall(command.encode("utf8") + TERMINATOR)
+        while TERMINATOR not in self._buffer:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise TclRpcError("Connection closed by OpenOCD")
+            self._buffer += chunk
+        response, self._buffer = self._buffer.split(TERMINATOR, 1)
+        return response.decode("utf8", errors="replace")
+
+    def call(self, command):
+        """Run a command and raise TclRpcError if it fails. The server
+        returns the same kind of response for results and errors, so the
+        command is wrapped with "catch"."""
+        status = self.send("catch {%s} pio_result" % command).strip()
+        result = self.send("set pio_result")
+        if status != "0":
+            raise TclRpcError(result.strip() or "'%s' failed" % command)
+        return result
+
+
+def quote(value):
+    # OpenOCD accepts forward slashes on every OS
+    return "{%s}" % str(value).replace("\\", "/")
+
+
+def program(client, image_path, offset=None):
+    return client.call(" ".join(
+        ["program", quote(image_path)]
+        + (["%s" % offset] if offset else []) + ["verify", "reset"]))
+
+
+def _is_port_free(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class OpenOcdServers(object):
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+
+    def _load(self):
+        try:
+            with open(self.state_path, encoding="utf8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        tmp_path = "%s.%d.tmp" % (self.state_path, os.getpid())
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def items(self):
+        return sorted(self._load().items())
+
+    @staticmethod
+    def _connect(key, port):
+        try:
+            client = TclRpcClient(port, timeout=5)
+        except OSError:
+            return None
+        try:
+            if client.send("set %s" % KEY_VARIABLE).strip() == key:
+                client.sock.settimeout(60)
+                return client
+        except (OSError, TclRpcError):
+            pass
+        client.close()
+        return None
+
+    def _allocate_port(self, data):
+        used = set(entry["port"] for entry in data.values())
+        port = DEFAULT_TCL_PORT
+        while port in used or not _is_port_free(port):
+            port += 1
+        return port
+
+    def connect(self, key, command, log_path, startup_timeout=10):
+        """Client of the server for "key", started with the OpenOCD
+        "command" line if it is not running yet"""
+        data = self._load()
+        entry = data.get(key)
+        if entry:
+            client = self._connect(key, entry["port"])
+            if client:
+                return client, False
+            del data[key]
+
+        port = self._allocate_port(data)
+        command = list(command) + [
+            "-c", "set %s %s" % (KEY_VARIABLE, key),
+            "-c", "tcl_port %d" % port,
+            "-c", "gdb_port disabled",
+            "-c", "telnet_port disabled",
+        ]
+        options = {}
+        if sys.platform.startswith("win"):
+            options["creationflags"] = (
+                subprocess.DETACHED_PROCESS
+                | subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            options["start_new_session"] = True
+        with open(log_path, "wb") as log:
+            process = subprocess.Popen(  # pylint: disable=R1732
+                command, stdin=subprocess.DEVNULL, stdout=log,
+                stderr=subprocess.STDOUT, **options)
+
+        deadline = time.time() + startup_timeout
+        client = None
+        while not client:
+            if process.poll() is not None:
+                raise TclRpcError(
+                    "OpenOCD exited with code %d, see %s" % (
+                        process.returncode, log_path))
+            if time.time() > deadline:
+                process.kill()
+                raise TclRpcError(
+                    "OpenOCD did not open the TCL port %d, see %s" % (
+                        port, log_path))
+            time.sleep(0.1)
+            client = self._connect(key, port)
+
+        data = self._load()
+        data[key] = dict(
+            port=port, pid=process.pid, command=command,
+            time=int(time.time()))
+        self._save(data)
+        return client, True
+
+    def forget(self, key):
+        data = self._load()
+        if data.pop(key, None):
+            self._save(data)
+
+    def stop(self, key=None):
+        """Shut down the server(s), returns the number of stopped servers"""
+        data = self._load()
+        stopped = 0
+        for entry_key, entry in list(data.items()):
+            if key is not None and entry_key != key:
+                continue
+            client = self._connect(entry_key, entry["port"])
+            if client:
+                with client:
+                    try:
+                        client.send("shutdown")
+                    except (OSError, TclRpcError):
+                        pass
+                stopped += 1
+            del data[entry_key]
+        self._save(data)
+        return stopped
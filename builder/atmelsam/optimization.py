@@ -0,0 +1,52 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Optimization profiles selected with "board_build.optimization"
+
+The flags end up in the global construction environment, so the framework
+core, libraries and project sources are all built the same way. LTO needs
+the "gcc-ar"/"gcc-ranlib" wrappers, which builder/main.py uses for archives.
+
+The profiles only select flags. How they change flash/RAM usage and build
+time depends on the project and can be measured with
+scripts/optimization_report.py, runtime speed is not measured at all.
+"""
+
+DEFAULT_PROFILE = "size"
+
+_SIZE = ["-Os", "--param", "max-inline-insns-single=500"]
+_SPEED = ["-O2"]
+_LTO = ["-flto"]
+
+PROFILES = {
+    "size": dict(CCFLAGS=_SIZE, LINKFLAGS=["-Os"]),
+    "speed": dict(CCFLAGS=_SPEED, LINKFLAGS=["-O2"]),
+    "lto": dict(
+        CCFLAGS=_SIZE + _LTO,
+        LINKFLAGS=["-Os"] + _LTO + ["-fuse-linker-plugin"]),
+    "speed+lto": dict(
+        CCFLAGS=_SPEED + _LTO,
+        LINKFLAGS=["-O2"] + _LTO + ["-fuse-linker-plugin"]),
+}
+
+
+def get_profile_flags(name):
+    name = (name or DEFAULT_PROFILE).strip().lower()
+    if name not in PROFILES:
+        raise ValueError(
+            "Unknown optimization profile '%s', use one of: %s" % (
+                name, ", ".join(sorted(PROFILES))))
+    return dict((key, list(value)) for key, value in PROFILES[name].items())
@@ -0,0 +1,135 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Upload port affinity cache
+
+Remembers the USB identity (VID/PID, serial number and bus location) of the
+device last used by a project environment. The next upload checks only that
+device through sysfs (Linux) or a single port listing instead of running
+the full auto-detection.
+"""
+
+import json
+import os
+import sys
+import time
+
+from platformio.public import list_serial_ports
+
+from atmelsam.ports import get_port_info, get_sysfs_usb_info, get_vid_pid
+
+TTY_PREFIXES = ("ttyACM", "ttyUSB")
+
+
+def _use_sysfs(sysfs_root):
+    return sys.platform.startswith("linux") and os.path.isdir(
+        os.path.join(sysfs_root, "class", "tty"))
+
+
+def _identity_from_hwid(hwid):
+    vid_pid = get_vid_pid(hwid)
+    if not vid_pid:
+        return None
+    return dict(
+        vid=vid_pid[0],
+        pid=vid_pid[1],
+        serial=get_port_info(hwid, "SER"),
+        location=get_port_info(hwid, "LOCATION"),
+    )
+
+
+def is_same_device(identity, other):
+    if not identity or not other:
+        return False
+    if (identity["vid"], identity["pid"]) != (other["vid"], other["pid"]):
+        return False
+    if identity.get("serial"):
+        # the board may have been moved to another USB port, but it must
+        # expose the same interface (e.g. GDB vs UART port of BlackMagic)
+        return identity["serial"] == other.get("serial") and (
+            identity.get("location") or ":").rsplit(":", 1)[1] == (
+                other.get("location") or ":").rsplit(":", 1)[1]
+    return bool(identity.get("location")) and (
+        identity["location"] == other.get("location"))
+
+
+def get_port_identity(port, sysfs_root="/sys"):
+    if _use_sysfs(sysfs_root):
+        info = get_sysfs_usb_info(
+            os.path.basename(os.path.realpath(port)), sysfs_root)
+        if info:
+            return info
+    for item in list_serial_ports():
+        if item["port"] == port:
+            return _identity_from_hwid(item.get("hwid"))
+    return None
+
+
+def find_port(identity, hint=None, sysfs_root="/sys", dev_dir="/dev"):
+    if _use_sysfs(sysfs_root):
+        names = []
+        if hint:
+            names.append(os.path.basename(os.path.realpath(hint)))
+        names.extend(
+            name for name in sorted(
+                os.listdir(os.path.join(sysfs_root, "class", "tty")))
+            if name.startswith(TTY_PREFIXES) and name not in names)
+        for name in names:
+            if is_same_device(
+                    identity, get_sysfs_usb_info(name, sysfs_root)):
+                # keep stable aliases such as "/dev/serial/by-id/..."
+                if hint and name == os.path.basename(os.path.realpath(hint)):
+                    return hint
+                return os.path.join(dev_dir, name)
+        return None
+    for item in list_serial_ports():
+        if is_same_device(identity, _identity_from_hwid(item.get("hwid"))):
+            return item["port"]
+    return None
+
+
+class PortCache(object):
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf8") as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        return self._load().get(key)
+
+    def items(self):
+        return sorted(self._load().items())
+
+    def set(self, key, port, identity):
+        data = self._load()
+        data[key] = dict(port=port, identity=identity, time=int(time.time()))
+        self._save(data)
+
+    def clear(self, key=None):
+        data = {} if key is None else {
+            k: v for k, v in self._load().items() if k != key}
+        self._save(data)
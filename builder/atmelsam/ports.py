@@ -0,0 +1,173 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Serial port helpers used by the upload pipelines"""
+
+import os
+import re
+import threading
+import time
+
+from platformio.public import list_serial_ports
+
+HWID_RE = re.compile(r"VID:PID=([0-9A-F]{4}):([0-9A-F]{4})", re.I)
+
+# SAM-BA in ROM, used by boards without a USB bootloader (Arduino Due)
+ROM_BOOTLOADER_HWID = (0x03EB, 0x6124)
+
+
+def get_port_info(hwid, key):
+    for token in (hwid or "").split():
+        if token.startswith(key + "=") and len(token) > len(key) + 1:
+            return token[len(key) + 1:]
+    return None
+
+
+def get_vid_pid(hwid):
+    match = HWID_RE.search(hwid or "")
+    if not match:
+        return None
+    return (int(match.group(1), 16), int(match.group(2), 16))
+
+
+def normalize_hwids(hwids):
+    return set(tuple(int(v, 16) for v in item) for item in hwids or [])
+
+
+def get_bootloader_hwids(hwids):
+    """IDs a board with the given "build.hwids" has in its bootloader.
+
+    The USB bootloaders of Arduino-style boards use the PID of the sketch
+    with bit 15 cleared, IDs with bit 15 set belong to the sketch.
+    """
+    result = set((vid, pid & 0x7FFF) for vid, pid in normalize_hwids(hwids))
+    result.add(ROM_BOOTLOADER_HWID)
+    return result
+
+
+def find_board_ports(hwids, ports=None):
+    hwids = normalize_hwids(hwids)
+    return [
+        item["port"]
+        for item in (list_serial_ports() if ports is None else ports)
+        if get_vid_pid(item.get("hwid")) in hwids
+    ]
+
+
+def get_sysfs_usb_info(name, sysfs_root="/sys"):
+    """Return USB identity of the device behind "/dev/<name>" (Linux only)"""
+    path = os.path.join(sysfs_root, "class", "tty", name, "device")
+    if not os.path.exists(path):
+        return None
+    path = os.path.realpath(path)
+    location = None
+    # walk up from the USB interface to the device that owns the IDs
+    while path.startswith(os.path.realpath(sysfs_root)) and len(path) > 1:
+        try:
+            with open(os.path.join(path, "idVendor")) as fp:
+                vid = int(fp.read().strip(), 16)
+            with open(os.path.join(path, "idProduct")) as fp:
+                pid = int(fp.read().strip(), 16)
+        except (OSError, ValueError):
+            # USB interfaces are named "<bus>-<port path>:<config>.<iface>"
+            if ":" in os.path.basename(path):
+                location = os.path.basename(path)
+            path = os.path.dirname(path)
+            continue
+        serial = None
+        if os.path.isfile(os.path.join(path, "serial")):
+            with open(os.path.join(path, "serial")) as fp:
+                serial = fp.read().strip() or None
+        return dict(
+            vid=vid,
+            pid=pid,
+            serial=serial,
+            location=location or os.path.basename(path),
+        )
+    return None
+
+
+def flush_port(port):
+    from serial import Serial  # pylint: disable=C0415
+
+    try:
+        s = Serial(port)
+        s.reset_input_buffer()
+        s.setDTR(False)
+        s.setRTS(False)
+        time.sleep(0.1)
+        s.setDTR(True)
+        s.setRTS(True)
+        s.close()
+    except:  # pylint: disable=bare-except
+        pass
+
+
+def touch_port(port, baudrate):
+    from serial import Serial  # pylint: disable=C0415
+
+    try:
+        s = Serial(port=port, baudrate=baudrate)
+        s.setDTR(False)
+        s.close()
+    except:  # pylint: disable=bare-except
+        pass
+
+
+class PortScanner(object):
+    """Thread-safe, rate limited view on the list of serial ports"""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._ports = None
+        self._time = 0
+
+    def get_ports(self):
+        with self._lock:
+            if self._ports is None or time.time() - self._time >= self.interval:
+                self._ports = list_serial_ports()
+                self._time = time.time()
+            return self._ports
+
+    def find(self, port):
+        for item in self.get_ports():
+            if item["port"] == port:
+                return item
+        return None
+
+    def wait_for_reenumeration(self, before, timeout=10.0):
+        """Return the port the device "before" shows up with after a reset.
+
+        Devices are paired by their USB location (the physical hub port),
+        which survives the switch between the application and the
+        bootloader, or by the USB serial number when the location is not
+        reported by the OS.
+        """
+        location = get_port_info(before.get("hwid"), "LOCATION")
+        serial = get_port_info(before.get("hwid"), "SER")
+        elapsed = 0
+        while elapsed < timeout:
+            for item in self.get_ports():
+                if item == before:
+                    continue
+                hwid = item.get("hwid")
+                if location and get_port_info(hwid, "LOCATION") == location:
+                    return item["port"]
+                if not location and serial and get_port_info(hwid, "SER") == serial:
+                    return item["port"]
+            time.sleep(self.interval)
+            elapsed += self.interval
+        return None
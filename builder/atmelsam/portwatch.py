@@ -0,0 +1,210 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Detection of the bootloader port that appears after a 1200bps touch
+
+On Linux the "/dev" directory is watched with inotify and a new node is
+matched against the bootloader IDs of the board via sysfs as soon as it shows
+up. The watch is installed before the touch, so a bootloader that enumerates
+while the touch is still in progress is not missed. Other systems (or a
+failing inotify) use a short-interval polling of the serial port list instead.
+"""
+
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from platformio.public import list_serial_ports
+
+from atmelsam.ports import (get_bootloader_hwids, get_sysfs_usb_info,
+                            get_vid_pid)
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+TTY_PREFIXES = ("ttyACM", "ttyUSB")
+
+# how long to keep waiting for a matching port once an unknown one appeared
+FALLBACK_GRACE = 0.5
+
+
+class Inotify(object):
+    def __init__(self, path, mask=IN_CREATE | IN_ATTRIB | IN_MOVED_TO):
+        import ctypes.util  # pylint: disable=C0415
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch")
+
+    def read(self, timeout):
+        """Return (name, mask) of entries created or changed within timeout"""
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(
+                (data[offset:offset + length].rstrip(b"\0").decode(), mask))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _is_ready(path):
+    # udev fixes permissions a moment after the node has been created
+    return os.access(path, os.R_OK | os.W_OK)
+
+
+def _watch_dev(watcher, before, hwids, timeout, dev_dir, sysfs_root):
+    fallback = None
+    deadline = time.time() + timeout
+    # a node that existed before the touch is new only once it has been
+    # created again, attribute changes of the old node do not count
+    created = set()
+    # the device may have shown up before the watch was installed
+    names = [
+        name for name in os.listdir(dev_dir)
+        if os.path.join(dev_dir, name) not in before
+    ]
+    initial = True
+    while True:
+        for name in names:
+            if not name.startswith(TTY_PREFIXES):
+                continue
+            path = os.path.join(dev_dir, name)
+            if path in before and name not in created:
+                continue
+            if not os.path.exists(path) or not _is_ready(path):
+                continue
+            info = get_sysfs_usb_info(name, sysfs_root)
+            if info and (info["vid"], info["pid"]) in hwids:
+                return path, True
+            if not initial and not fallback:
+                fallback = path
+                deadline = min(deadline, time.time() + FALLBACK_GRACE)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return fallback, False
+        events = watcher.read(remaining)
+        created.update(
+            name for name, mask in events if mask & (IN_CREATE | IN_MOVED_TO))
+        names = [name for name, _ in events]
+        initial = False
+
+
+def _poll_ports(before, hwids, timeout, interval):
+    fallback = None
+    deadline = time.time() + timeout
+    while True:
+        ports = list_serial_ports()
+        for item in ports:
+            if item["port"] in before:
+                continue
+            if get_vid_pid(item.get("hwid")) in hwids:
+                return item["port"], True
+            if not fallback:
+                fallback = item["port"]
+                deadline = min(deadline, time.time() + FALLBACK_GRACE)
+        # a port that goes away and comes back under the same name (the
+        # bootloader re-enumerating) is new as well
+        before = before & set(item["port"] for item in ports)
+        if time.time() >= deadline:
+            return fallback, False
+        time.sleep(interval)
+
+
+class PortWatcher(object):
+    """Watch for the bootloader port of a board that is about to be reset.
+
+    Create it before the 1200bps touch and call "wait" afterwards. "before"
+    are the ports seen before the touch, "hwids" the "build.hwids" of the
+    board, only their bootloader IDs are matched.
+    """
+
+    def __init__(self, before, hwids, interval=0.05, dev_dir="/dev",
+                 sysfs_root="/sys"):
+        self.before = set(
+            item["port"] if isinstance(item, dict) else item
+            for item in before)
+        self.hwids = get_bootloader_hwids(hwids)
+        self.interval = interval
+        self.dev_dir = dev_dir
+        self.sysfs_root = sysfs_root
+        self._inotify = None
+        if sys.platform.startswith("linux") and os.path.isdir(dev_dir):
+            try:
+                self._inotify = Inotify(dev_dir)
+            except OSError:
+                pass
+
+    def wait(self, timeout=5):
+        """Return (port, matched) where "matched" tells whether the port
+        has a bootloader ID. A new port with unknown IDs is returned when
+        no matching one shows up within FALLBACK_GRACE seconds."""
+        if self._inotify:
+            try:
+                return _watch_dev(self._inotify, self.before, self.hwids,
+                                  timeout, self.dev_dir, self.sysfs_root)
+            except OSError:
+                pass
+        return _poll_ports(self.before, self.hwids, timeout, self.interval)
+
+    def close(self):
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def wait_for_new_port(before, hwids, timeout=5, interval=0.05,
+                      dev_dir="/dev", sysfs_root="/sys"):
+    """Wait for a port that was not in "before", see PortWatcher"""
+    with PortWatcher(before, hwids, interval, dev_dir,
+                     sysfs_root) as watcher:
+        return watcher.wait(timeout)
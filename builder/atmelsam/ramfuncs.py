@@ -0,0 +1,112 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Placement of hot functions in RAM
+
+Sources are compiled with "-ffunction-sections", so every function has its
+own ".text.<name>" input section. Renaming the section of a selected function
+to ".data.ramfunc.<name>" lets the "*(.data*)" rule of the vendor linker
+scripts put it into RAM, and the startup code copies it there together with
+the initialized data. The linker adds long-branch veneers for calls between
+flash and RAM.
+"""
+
+import fnmatch
+import os
+import re
+
+from atmelsam.elf import SHF_WRITE, SHN_LORESERVE, STT_FUNC, ElfFile
+
+RAMFUNC_PREFIX = ".data.ramfunc."
+OBJECT_SUFFIXES = (".o", ".c", ".cpp", ".cc", ".cxx", ".S", ".s")
+
+
+def parse_ramfuncs(value):
+    """Function names, glob patterns of (mangled) names or source/object
+    file names separated by commas, spaces or new lines"""
+    return [item for item in re.split(r"[\s,]+", value or "") if item]
+
+
+def parse_profile(path, limit=0):
+    """Function names from a profile listing, one function per line with the
+    name in the last column (e.g. "1234  42.1%  SERCOM5_Handler"), hottest
+    first. Lines starting with "#" are ignored."""
+    names = []
+    with open(path, encoding="utf8") as fp:
+        for line in fp:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if fields[-1] not in names:
+                names.append(fields[-1])
+    return names[:limit] if limit else names
+
+
+def _match_object(obj_path, patterns):
+    name = os.path.basename(obj_path)
+    # PlatformIO names objects after their sources ("SERCOM.cpp.o")
+    source_name = name[:-2] if name.endswith(".o") else name
+    return any(
+        fnmatch.fnmatchcase(name, pattern)
+        or fnmatch.fnmatchcase(source_name, pattern)
+        for pattern in patterns if pattern.endswith(OBJECT_SUFFIXES))
+
+
+def get_section_renames(obj_path, patterns):
+    """(old, new) section names for functions of an object file that match
+    the patterns"""
+    with ElfFile(obj_path) as elf:
+        sections = elf.sections
+        selected = set()
+        if _match_object(obj_path, patterns):
+            selected.update(
+                index for index, section in enumerate(sections, 1)
+                if section.name.startswith(".text."))
+        function_patterns = [
+            pattern for pattern in patterns
+            if not pattern.endswith(OBJECT_SUFFIXES)]
+        for symbol in elf.iter_symbols():
+            if (symbol.type != STT_FUNC or not 0 < symbol.shndx < SHN_LORESERVE
+                    or not any(fnmatch.fnmatchcase(symbol.name, pattern)
+                               for pattern in function_patterns)):
+                continue
+            selected.add(symbol.shndx)
+    renames = []
+    for index in sorted(selected):
+        name = sections[index - 1].name
+        if name.startswith(".text."):
+            renames.append((name, RAMFUNC_PREFIX + name[len(".text."):]))
+    return renames
+
+
+def get_ram_functions(elf):
+    """(name, size) of functions that ended up in writable memory"""
+    ram_sections = set(
+        index for index, section in enumerate(elf.sections, 1)
+        if section.flags & SHF_WRITE)
+    return sorted(
+        set((symbol.name, symbol.size) for symbol in elf.iter_symbols()
+            if symbol.type == STT_FUNC and symbol.shndx in ram_sections),
+        key=lambda item: (-item[1], item[0]))
+
+
+def find_missing_functions(patterns, functions):
+    """Function patterns that did not select any of the RAM functions"""
+    return [
+        pattern for pattern in patterns
+        if not pattern.endswith(OBJECT_SUFFIXES) and not any(
+            fnmatch.fnmatchcase(name, pattern) for name, _ in functions)
+    ]
@@ -0,0 +1,214 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Firmware footprint report
+
+Attributes flash and RAM usage of a firmware ELF to its sections, to the
+object files and archive members of the build directory, and to symbols.
+"""
+
+import json
+import os
+
+from atmelsam.elf import (EM_ARM, SHF_ALLOC, SHF_WRITE, SHN_LORESERVE,
+                          SHN_UNDEF, SHT_NOBITS, STB_LOCAL, STB_WEAK,
+                          STT_FILE, STT_FUNC, STT_OBJECT, ElfError, ElfFile,
+                          iter_archive_members)
+
+REPORT_VERSION = 1
+UNKNOWN_OWNER = "(unknown)"
+
+
+def get_section_usage(section):
+    """(flash, ram) bytes occupied by an allocated section"""
+    if not section.flags & SHF_ALLOC:
+        return 0, 0
+    flash = 0 if section.type == SHT_NOBITS else section.size
+    ram = section.size if section.flags & SHF_WRITE else 0
+    return flash, ram
+
+
+def _index_object(elf, owner, strong, weak, files):
+    current_file = None
+    for symbol in elf.iter_symbols():
+        if symbol.type == STT_FILE:
+            current_file = symbol.name
+            if current_file:
+                files.setdefault(current_file, owner)
+            continue
+        if symbol.shndx == SHN_UNDEF or symbol.bind == STB_LOCAL:
+            continue
+        if symbol.type not in (STT_FUNC, STT_OBJECT):
+            continue
+        target = weak if symbol.bind == STB_WEAK else strong
+        target.setdefault(symbol.name, owner)
+
+
+def index_build_dir(build_dir):
+    """Map symbol and source file names to "obj.o" / "lib.a(member.o)" """
+    strong, weak, files = {}, {}, {}
+    for root, _, names in os.walk(build_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            owner = os.path.relpath(path, build_dir).replace(os.sep, "/")
+            try:
+                if name.endswith(".o"):
+                    with ElfFile(path) as elf:
+                        _index_object(elf, owner, strong, weak, files)
+                elif name.endswith(".a"):
+                    for member, data in iter_archive_members(path):
+                        if not data.startswith(b"\x7fELF"):
+                            continue
+                        _index_object(
+                            ElfFile(path, data), "%s(%s)" % (owner, member),
+                            strong, weak, files)
+            except (ElfError, OSError, ValueError):
+                continue
+    # a strong definition wins over a weak one at link time as well
+    weak.update(strong)
+    return weak, files
+
+
+def build_report(elf_path, build_dir=None, offset_address=0,
+                 maximum_size=0, maximum_ram_size=0):
+    symbols_index, files_index = (
+        index_build_dir(build_dir) if build_dir else ({}, {}))
+    with ElfFile(elf_path) as elf:
+        sections = []
+        flash_total = ram_total = 0
+        image_start = image_end = None
+        outside = []
+        for section in elf.sections:
+            flash, ram = get_section_usage(section)
+            if not flash and not ram:
+                continue
+            flash_total += flash
+            ram_total += ram
+            if flash and section.lma >= offset_address and (
+                    not maximum_size or
+                    section.lma < offset_address + maximum_size):
+                image_start = min(image_start, section.lma) \
+                    if image_start is not None else section.lma
+                image_end = max(image_end or 0, section.lma + section.size)
+            elif flash:
+                outside.append(section.name)
+            sections.append(dict(
+                name=section.name, address=section.addr, lma=section.lma,
+                size=section.size, flash=flash, ram=ram))
+
+        objects = {}
+        symbols = []
+        current_file = None
+        for symbol in elf.iter_symbols():
+            if symbol.type == STT_FILE:
+                current_file = symbol.name
+                continue
+            if (symbol.type not in (STT_FUNC, STT_OBJECT) or not symbol.size
+                    or symbol.shndx in (SHN_UNDEF,) or
+                    symbol.shndx >= SHN_LORESERVE):
+                continue
+            section = elf.sections[symbol.shndx - 1]
+            flash, ram = get_section_usage(section)
+            if not flash and not ram:
+                continue
+            flash = symbol.size if flash else 0
+            ram = symbol.size if ram else 0
+            if symbol.bind == STB_LOCAL:
+                owner = files_index.get(current_file)
+            else:
+                owner = symbols_index.get(symbol.name)
+            owner = owner or (
+                "(%s)" % current_file if current_file and
+                symbol.bind == STB_LOCAL else UNKNOWN_OWNER)
+            address = symbol.value
+            if symbol.type == STT_FUNC and elf.machine == EM_ARM:
+                address &= ~1  # Thumb bit
+            symbols.append(dict(
+                name=symbol.name, address=address, size=symbol.size,
+                section=section.name, object=owner, flash=flash, ram=ram))
+            item = objects.setdefault(owner, dict(flash=0, ram=0, symbols=0))
+            item["flash"] += flash
+            item["ram"] += ram
+            item["symbols"] += 1
+
+    # on bootloader boards the application region starts at the upload
+    # offset, the space taken there includes alignment gaps between sections
+    flash_region = dict(
+        start=offset_address, size=maximum_size, used=flash_total,
+        image_start=image_start, image_end=image_end,
+        span=image_end - offset_address if image_end else 0,
+        outside_region=outside)
+    if maximum_size:
+        flash_region["free"] = maximum_size - flash_region["span"]
+
+    return dict(
+        version=REPORT_VERSION,
+        elf=elf_path,
+        flash=flash_region,
+        ram=dict(size=maximum_ram_size, used=ram_total, free=(
+            maximum_ram_size - ram_total if maximum_ram_size else None)),
+        sections=sections,
+        objects=[
+            dict(name=name, **values)
+            for name, values in sorted(
+                objects.items(), key=lambda item: -item[1]["flash"])
+        ],
+        symbols=sorted(symbols, key=lambda item: (-item["size"], item["name"])),
+    )
+
+
+def _growth(old_items, new_items, key, name_key=lambda item: item["name"]):
+    old = dict((name_key(item), item) for item in old_items)
+    new = dict((name_key(item), item) for item in new_items)
+    result = []
+    for name in sorted(set(old) | set(new)):
+        before = old.get(name, {}).get(key, 0)
+        after = new.get(name, {}).get(key, 0)
+        if before != after:
+            result.append(dict(name=name, before=before, after=after,
+                               delta=after - before))
+    return sorted(result, key=lambda item: (-abs(item["delta"]), item["name"]))
+
+
+def compare_reports(old, new):
+    """What grew (or shrank) between two reports"""
+    return dict(
+        flash=new["flash"]["used"] - old["flash"]["used"],
+        ram=new["ram"]["used"] - old["ram"]["used"],
+        sections=_growth(old["sections"], new["sections"], "size"),
+        objects_flash=_growth(old["objects"], new["objects"], "flash"),
+        objects_ram=_growth(old["objects"], new["objects"], "ram"),
+        # local symbols of different files may share a name
+        symbols=_growth(
+            old["symbols"], new["symbols"], "size",
+            lambda item: "%s:%s" % (item["object"], item["name"])),
+    )
+
+
+def load_report(path):
+    try:
+        with open(path, encoding="utf8") as fp:
+            report = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    return report if report.get("version") == REPORT_VERSION else None
+
+
+def save_report(path, report):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w", encoding="utf8") as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,138 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+SWO trace and serial data capture targets
+
+Both stream data from the device until the configured duration is over or
+Ctrl+C is pressed: the ITM/DWT trace through an OpenOCD based probe and the
+serial port of the board at full rate.
+"""
+
+import subprocess
+import sys
+import time
+from os.path import join
+
+from atmelsam import is_enabled
+from atmelsam.capture import (DEFAULT_BUFFER_SIZE, CaptureWriter,
+                              capture_port, get_capture_path, parse_size)
+from atmelsam.dsu import get_family as get_dsu_family
+from atmelsam.itm import (Symbolizer, TraceSummary, decode_events,
+                          get_openocd_config, get_openocd_setup, is_supported,
+                          iter_file, iter_packets, parse_ports, write_profile)
+from atmelsam.upload import get_openocd_command, release_probe
+
+
+def CaptureTrace(target, source, env):  # pylint: disable=W0613
+    board = env.BoardConfig()
+    if not is_supported(board.get("build.cpu", "")):
+        sys.stderr.write(
+            "Error: %s has no ITM/SWO trace (Cortex-M3/M4 only)\n" %
+            board.get("build.cpu", ""))
+        env.Exit(1)
+    if "OPENOCD_ARGS" not in env:
+        sys.stderr.write(
+            "Error: SWO trace needs an OpenOCD based upload protocol, "
+            "e.g. atmel-ice or cmsis-dap\n")
+        env.Exit(1)
+
+    trace_path = env.subst(board.get("debug.trace_file", "") or join(
+        "$BUILD_DIR", "trace.swo"))
+    with open(trace_path, "wb"):
+        pass
+    ports = parse_ports(board.get("debug.trace_ports", ""))
+    traceclk = int(str(board.get("build.f_cpu", "0")).rstrip("L"))
+    swo_freq = int(board.get("debug.trace_swo_freq", 2000000))
+    command = get_openocd_command(env)
+    release_probe(env)
+    command += [
+        "-c", get_openocd_config(trace_path, traceclk, swo_freq),
+        "-c", "init",
+        "-c", "; ".join(get_openocd_setup(
+            get_dsu_family(board.get("build.mcu", "")), trace_path, traceclk, swo_freq,
+            ports=sum(1 << port for port in ports),
+            pc_sampling=is_enabled(
+                board.get("debug.trace_pc_sampling", True)),
+            exceptions=is_enabled(
+                board.get("debug.trace_exceptions", True)))),
+    ]
+    log_path = env.subst(join("$BUILD_DIR", "trace-openocd.log"))
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(  # pylint: disable=R1732
+            command, stdout=log, stderr=subprocess.STDOUT, env=env["ENV"])
+
+    duration = float(board.get("debug.trace_duration", 0) or 0)
+    deadline = time.time() + duration if duration else None
+
+    def _follow():
+        return process.poll() is None and (
+            not deadline or time.time() < deadline)
+
+    summary = TraceSummary(Symbolizer(source[0].get_abspath()), ports)
+    reported = time.time()
+    print("Tracing to %s, press Ctrl+C to stop" % trace_path)
+    try:
+        for event in decode_events(iter_packets(iter_file(
+                trace_path, _follow))):
+            for line in summary.feed(event):
+                print(line)
+            if time.time() - reported >= 2:
+                reported = time.time()
+                print("\n".join(summary.format()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+    print("\n".join(summary.format(limit=20)))
+    if not summary.histogram.total and process.returncode:
+        sys.stderr.write(
+            "Error: OpenOCD exited with code %d, see %s\n" % (
+                process.returncode, log_path))
+        env.Exit(1)
+    if summary.histogram.total:
+        profile_path = env.subst(join("$BUILD_DIR", "trace-profile.txt"))
+        write_profile(summary.histogram, profile_path)
+        print("PC sample profile: %s" % profile_path)
+
+
+def CaptureSerialData(target, source, env):  # pylint: disable=W0613
+    board = env.BoardConfig()
+    port = env.GetProjectOption("monitor_port", "")
+    if not port:
+        env.AutodetectUploadPort()
+        port = env.subst("$UPLOAD_PORT")
+    path = get_capture_path(
+        board.get("monitor.capture_file", ""), env.subst("$BUILD_DIR"))
+    with open(path, "wb") as fp:
+        writer = CaptureWriter(
+            fp,
+            buffer_size=parse_size(
+                board.get("monitor.capture_buffer", ""), DEFAULT_BUFFER_SIZE),
+            timestamps=is_enabled(board.get("monitor.capture_timestamps", False)),
+        ).start()
+        print("Capturing %s to %s, press Ctrl+C to stop" % (port, path))
+        try:
+            capture_port(
+                port, int(env.GetProjectOption("monitor_speed", 9600)), writer,
+                duration=float(board.get("monitor.capture_duration", 0) or 0),
+                progress=lambda stats: sys.stderr.write(
+                    "\r%s " % stats.format()))
+        finally:
+            writer.close()
+    sys.stderr.write("\n")
+    print("Capture: %s" % writer.stats.format())
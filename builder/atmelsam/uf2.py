@@ -0,0 +1,131 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""UF2 images and mass-storage (MSC) bootloader drives"""
+
+import glob
+import os
+import shutil
+import string
+import struct
+import sys
+import time
+
+UF2_MAGIC_START0 = 0x0A324655
+UF2_MAGIC_START1 = 0x9E5D5157
+UF2_MAGIC_END = 0x0AB16F30
+UF2_FLAG_FAMILY_ID = 0x00002000
+UF2_PAYLOAD_SIZE = 256
+UF2_INFO_FILE = "INFO_UF2.TXT"
+
+FAMILY_IDS = (
+    (("samd51", "same51", "same53", "same54"), 0x55114460),
+    (("samd21", "samda1"), 0x68ED2B88),
+    (("saml21",), 0x1851780A),
+)
+
+
+def get_family_id(mcu):
+    for prefixes, family_id in FAMILY_IDS:
+        if mcu.lower().startswith(prefixes):
+            return family_id
+    return None
+
+
+def convert_to_uf2(data, base_address, family_id):
+    num_blocks = (len(data) + UF2_PAYLOAD_SIZE - 1) // UF2_PAYLOAD_SIZE
+    blocks = []
+    for block_no in range(num_blocks):
+        offset = block_no * UF2_PAYLOAD_SIZE
+        blocks.append(struct.pack(
+            "<IIIIIIII476sI",
+            UF2_MAGIC_START0,
+            UF2_MAGIC_START1,
+            UF2_FLAG_FAMILY_ID,
+            base_address + offset,
+            UF2_PAYLOAD_SIZE,
+            block_no,
+            num_blocks,
+            family_id,
+            data[offset:offset + UF2_PAYLOAD_SIZE],
+            UF2_MAGIC_END,
+        ))
+    return b"".join(blocks)
+
+
+def _get_mount_points():
+    if sys.platform.startswith("win"):
+        return ["%s:\\" % letter for letter in string.ascii_uppercase[2:]]
+    if sys.platform == "darwin":
+        return glob.glob("/Volumes/*")
+    mount_points = []
+    try:
+        with open("/proc/mounts") as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] in ("vfat", "msdos", "fuseblk"):
+                    mount_points.append(
+                        fields[1].replace("\\040", " ").replace("\\011", "\t"))
+    except OSError:
+        pass
+    for pattern in ("/media/*", "/media/*/*", "/run/media/*/*"):
+        mount_points.extend(
+            p for p in glob.glob(pattern) if p not in mount_points)
+    return mount_points
+
+
+def is_uf2_drive(path):
+    return os.path.isfile(os.path.join(path, UF2_INFO_FILE))
+
+
+def find_uf2_drives(pattern=None):
+    """UF2 drives matching "pattern" (a directory or a glob) or all of them"""
+    candidates = glob.glob(pattern) if pattern else _get_mount_points()
+    return sorted(set(path for path in candidates if is_uf2_drive(path)))
+
+
+def read_uf2_info(drive):
+    info = {}
+    with open(os.path.join(drive, UF2_INFO_FILE), errors="replace") as fp:
+        for line in fp:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                info[key.strip()] = value.strip()
+    return info
+
+
+def wait_for_uf2_drive(before, timeout=10.0, interval=0.1):
+    elapsed = 0
+    while elapsed < timeout:
+        drives = [d for d in find_uf2_drives() if d not in before]
+        if drives:
+            return drives[0]
+        time.sleep(interval)
+        elapsed += interval
+    return None
+
+
+def copy_to_drive(source, drive):
+    target = os.path.join(drive, "NEW.UF2")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        shutil.copyfileobj(src, dst, 64 * 1024)
+        dst.flush()
+        try:
+            os.fsync(dst.fileno())
+        except OSError:
+            # the bootloader may reset and drop the drive right after the
+            # last block has been written
+            pass
+    return target
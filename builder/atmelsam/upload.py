@@ -0,0 +1,573 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Upload actions and the probe/port state they share
+
+Port lookup with the upload port cache, bootloader detection, persistent
+OpenOCD servers, skipping identical firmware by the DSU CRC32, adapter speed
+autotuning, delta uploads over SAM-BA and UF2 drive copies. The heavier
+modules (pyserial, sockets, thread pools) are imported by the helpers only
+when an upload runs, so build-only runs do not load them.
+"""
+
+import json
+import subprocess
+import sys
+import time
+from os.path import basename, exists, isdir, join
+
+from platformio.public import list_serial_ports
+
+from atmelsam import is_enabled
+from atmelsam.adapterspeed import (AutotuneError, SpeedCache,
+                                   find_probe_serial, get_cache_key,
+                                   strip_jlink_speed, tune_jlink, tune_openocd)
+from atmelsam.corecache import make_key
+from atmelsam.delta import FlashRecord, get_erase_size, plan_upload
+from atmelsam.dsu import (DsuError, SamBaMonitor, get_gdb_commands,
+                          get_image_crc, get_jlink_script, get_openocd_script,
+                          parse_gdb_output, parse_jlink_output,
+                          parse_openocd_result)
+from atmelsam.dsu import get_family as get_dsu_family
+from atmelsam.openocd import OpenOcdServers, TclRpcError, program
+from atmelsam.portcache import PortCache, find_port, get_port_identity
+from atmelsam.ports import touch_port
+from atmelsam.portwatch import PortWatcher
+from atmelsam.uf2 import (copy_to_drive, find_uf2_drives, is_uf2_drive,
+                          read_uf2_info, wait_for_uf2_drive)
+
+
+def _get_port_cache(env):
+    return PortCache(
+        join(env.PioPlatform().get_cache_dir(), "upload-ports.json"))
+
+
+def _get_port_cache_key(env):
+    return "%s|%s|%s" % (
+        env.subst("$PROJECT_DIR"), env["PIOENV"], env.get("BOARD", ""))
+
+
+def AutodetectUploadPortCached(target, source, env):  # pylint: disable=W0613
+    if env.subst("$UPLOAD_PORT") or "BOARD" not in env or not is_enabled(
+            env.BoardConfig().get("upload.port_cache", True)):
+        env.AutodetectUploadPort()
+        return
+
+    cache = _get_port_cache(env)
+    key = _get_port_cache_key(env)
+    entry = cache.get(key)
+    port = find_port(entry["identity"], entry["port"]) if entry else None
+    if port:
+        print("Auto-detected (cached): %s" % port)
+        env.Replace(UPLOAD_PORT=port)
+        if port != entry["port"]:
+            cache.set(key, port, entry["identity"])
+        return
+
+    env.AutodetectUploadPort()
+    port = env.subst("$UPLOAD_PORT")
+    identity = get_port_identity(port) if port else None
+    if identity:
+        cache.set(key, port, identity)
+
+
+def BeforeUpload(target, source, env):  # pylint: disable=W0613
+    AutodetectUploadPortCached(target, source, env)
+
+    upload_options = {}
+    if "BOARD" in env:
+        upload_options = env.BoardConfig().get("upload", {})
+
+    if not bool(upload_options.get("disable_flushing", False)):
+        env.FlushSerialBuffer("$UPLOAD_PORT")
+
+    wait_for_upload_port = bool(
+        upload_options.get("wait_for_upload_port", False))
+    watcher = None
+    if wait_for_upload_port:
+        # watch before the touch, the bootloader may enumerate before the
+        # touch returns
+        watcher = PortWatcher(
+            list_serial_ports(),
+            env.BoardConfig().get("build.hwids", []) if "BOARD" in env else [])
+
+    try:
+        if bool(upload_options.get("use_1200bps_touch", False)):
+            if wait_for_upload_port:
+                # no need for a fixed delay, the port watcher returns as
+                # soon as the bootloader is there
+                print("Forcing reset using 1200bps open/close on port %s" %
+                      env.subst("$UPLOAD_PORT"))
+                touch_port(env.subst("$UPLOAD_PORT"), 1200)
+            else:
+                env.TouchSerialPort("$UPLOAD_PORT", 1200)
+
+        if watcher:
+            env.Replace(UPLOAD_PORT=WaitForBootloaderPort(env, watcher))
+    finally:
+        if watcher:
+            watcher.close()
+
+    # use only port name for BOSSA
+    if ("/" in env.subst("$UPLOAD_PORT") and
+            env.subst("$UPLOAD_PROTOCOL") == "sam-ba"):
+        env.Replace(UPLOAD_PORT=basename(env.subst("$UPLOAD_PORT")))
+
+
+def WaitForBootloaderPort(env, watcher):
+    print("Waiting for the new upload port...")
+    prev_port = env.subst("$UPLOAD_PORT")
+    new_port, _ = watcher.wait()
+    if new_port:
+        return new_port
+    if any(item["port"] == prev_port for item in list_serial_ports()):
+        return prev_port
+    sys.stderr.write(
+        "Error: Couldn't find a board on the selected port. "
+        "Check that you have the correct port selected. "
+        "If it is correct, try pressing the board's reset "
+        "button after initiating the upload.\n")
+    env.Exit(1)
+
+
+def _get_openocd_servers(env):
+    return OpenOcdServers(
+        join(env.PioPlatform().get_cache_dir(), "openocd-servers.json"))
+
+
+def get_openocd_command(env):
+    return [join(env.PioPlatform().get_package_dir(
+        "tool-openocd") or "", "bin", "openocd")] + [
+            env.subst(arg) for arg in env["OPENOCD_ARGS"]]
+
+
+def _connect_openocd_server(env):
+    command = get_openocd_command(env)
+    key = make_key(command)[:16]
+    log_path = join(env.PioPlatform().get_cache_dir(), "openocd-%s.log" % key)
+    client, started = _get_openocd_servers(env).connect(key, command, log_path)
+    return key, client, started
+
+
+def release_probe(env):
+    """Stop the persistent servers, a running server keeps its probe busy
+    for any other tool (one-shot OpenOCD, J-Link, a debug session)"""
+    servers = _get_openocd_servers(env)
+    stopped = servers.stop() if servers.items() else 0
+    if stopped:
+        print("Stopped %d OpenOCD server(s) to release the probe" % stopped)
+
+
+def ReleaseProbe(target, source, env):  # pylint: disable=W0613
+    release_probe(env)
+
+
+def release_probe_for(env, actions, targets):
+    """Upload "actions" that first release the probe when they use it
+    through another tool than the persistent servers. A debug session
+    starts its own GDB server, the probe is released right away for it"""
+    if "__debug" in targets:
+        release_probe(env)
+    if actions and not env.get("OPENOCD_SERVER") and (
+            env.subst("$UPLOAD_PROTOCOL").startswith("jlink") or
+            "OPENOCD_ARGS" in env):
+        actions = [env.VerboseAction(
+            ReleaseProbe, "Releasing the probe...")] + actions
+    return actions
+
+
+def UploadViaOpenOcdServer(target, source, env):  # pylint: disable=W0613
+    """Program the firmware through a persistent OpenOCD server, the server
+    is (re)started when needed"""
+    offset = env.BoardConfig().get("upload.offset_address", "")
+    for attempt in range(2):
+        try:
+            key, client, started = _connect_openocd_server(env)
+        except (OSError, TclRpcError) as e:
+            sys.stderr.write(
+                "Warning! Could not start OpenOCD server (%s), "
+                "uploading without it\n" % e)
+            return env.Execute("$UPLOADCMD")
+        print("%s OpenOCD server on TCL port %d" % (
+            "Started" if started else "Reusing", client.sock.getpeername()[1]))
+        with client:
+            try:
+                program(client, source[0].get_abspath(), offset)
+                return 0
+            except (OSError, TclRpcError) as e:
+                error = e
+        # e.g. the probe has been reconnected, start over with a new server
+        _get_openocd_servers(env).stop(key)
+        if started or attempt:
+            break
+    sys.stderr.write("Error: OpenOCD could not program the device: %s\n" % error)
+    return 1
+
+
+def _run_and_capture(env, cmd):
+    result = subprocess.run(
+        cmd, shell=isinstance(cmd, str), env=env["ENV"],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    return result.stdout.decode(errors="replace")
+
+
+def _get_samba_port(env):
+    port = env.subst("$UPLOAD_PORT")
+    if not exists(port) and exists(join("/dev", port)):
+        port = join("/dev", port)  # BOSSA takes only the port name
+    return port
+
+
+def _get_device_crc(env, start, length, crc):
+    """CRC32 of a flash range, computed by the DSU of the device. "crc" is
+    the CRC32 of the image, the SAM-BA bootloader is only left if it
+    matches."""
+    family = get_dsu_family(env.BoardConfig().get("build.mcu", ""))
+    protocol = env.subst("$UPLOAD_PROTOCOL")
+    if protocol.startswith("jlink"):
+        script_path = join(env.subst("$BUILD_DIR"), "dsu-crc.jlink")
+        with open(script_path, "w") as fp:
+            fp.write("\n".join(get_jlink_script(family, start, length)))
+        return parse_jlink_output(_run_and_capture(env, env.subst(
+            '$UPLOADER $UPLOADERFLAGS -CommanderScript "%s"' % script_path)))
+    if protocol.startswith("blackmagic"):
+        flags = env["UPLOADERFLAGS"]
+        commands = flags[flags.index("-ex") + 1:flags.index("attach 1") + 1:2]
+        commands += get_gdb_commands(family, start, length) + ["kill"]
+        return parse_gdb_output(_run_and_capture(env, [
+            env.subst("$GDB"), "-nx", "--batch"] + sum(
+                [["-ex", env.subst(item)] for item in commands], [])))
+    if protocol == "sam-ba":
+        with SamBaMonitor(_get_samba_port(env)) as monitor:
+            return monitor.check_crc(family, start, length, crc)
+    script = get_openocd_script(family, start, length)
+    if env.get("OPENOCD_SERVER"):
+        _, client, _ = _connect_openocd_server(env)
+        with client:
+            client.call(script)
+            return parse_openocd_result(client.call("pio_dsu_crc"))
+    return parse_openocd_result(_run_and_capture(
+        env, get_openocd_command(env) + [
+            "-c", script, "-c", "init",
+            "-c", 'echo "PIO_DSU [pio_dsu_crc]"', "-c", "shutdown"]))
+
+
+def upload_unless_identical(actions, prepare=0):
+    """Upload actions preceded by a comparison of the device CRC32 with the
+    firmware image, "prepare" actions (e.g. the port lookup) run first"""
+
+    def UploadUnlessIdentical(target, source, env):
+        actions_ = [env.Action(action) for action in actions]
+        for action in actions_[:prepare]:
+            status = action(target, source, env)
+            if status:
+                return status
+        with open(source[0].get_abspath(), "rb") as fp:
+            length, crc = get_image_crc(fp.read())
+        offset = int(env.BoardConfig().get(
+            "upload.offset_address", "0") or "0", 0)
+        started = time.time()
+        try:
+            device_crc = _get_device_crc(env, offset, length, crc)
+        except (DsuError, TclRpcError, OSError, ValueError) as e:
+            print("Could not read the flash CRC32 (%s)" % e)
+            device_crc = None
+        if device_crc == crc:
+            print("The device already runs this firmware (CRC32 0x%08X), "
+                  "upload skipped in %.2f s" % (crc, time.time() - started))
+            return 0
+        for action in actions_[prepare:]:
+            status = action(target, source, env)
+            if status:
+                return status
+        return 0
+
+    return UploadUnlessIdentical
+
+
+def _get_speed_cache(env):
+    return SpeedCache(
+        join(env.PioPlatform().get_cache_dir(), "adapter-speeds.json"))
+
+
+def _get_speed_cache_key(env):
+    protocol = env.subst("$UPLOAD_PROTOCOL")
+    arguments = env.get("OPENOCD_ARGS") or env["UPLOADERFLAGS"]
+    serial = find_probe_serial(
+        protocol, [env.subst(arg) for arg in arguments], list_serial_ports())
+    return get_cache_key(protocol, serial, env["BOARD"])
+
+
+def _tune_adapter_speed(env):
+    """Fastest verified adapter speed in kHz, None if the tuning failed"""
+
+    def _run(cmd):
+        return _run_and_capture(env, cmd)
+
+    started = time.time()
+    try:
+        if env.subst("$UPLOAD_PROTOCOL").startswith("jlink"):
+            speed = tune_jlink(
+                [env.subst("$UPLOADER")] + strip_jlink_speed(
+                    [env.subst(arg) for arg in env["UPLOADERFLAGS"]]),
+                _run, join(env.subst("$BUILD_DIR"), "autotune.jlink"))
+        else:
+            command = get_openocd_command(env)
+            release_probe(env)
+            speed = tune_openocd(command, _run)
+    except (AutotuneError, OSError) as e:
+        sys.stderr.write(
+            "Warning! Could not tune the adapter speed (%s), "
+            "using the default one\n" % e)
+        return None
+    print("Adapter speed: %d kHz, tuned in %.2f s" % (
+        speed, time.time() - started))
+    return speed
+
+
+def _apply_adapter_speed(env, speed):
+    if env.subst("$UPLOAD_PROTOCOL").startswith("jlink"):
+        flags = list(env["UPLOADERFLAGS"])
+        flags[flags.index("-speed") + 1] = str(speed)
+        env.Replace(UPLOADERFLAGS=flags)
+        return
+    args = ["-c", "adapter speed %d" % speed]
+    count = len(env["OPENOCD_ARGS"])
+    flags = env["UPLOADERFLAGS"]
+    env.Replace(
+        OPENOCD_ARGS=env["OPENOCD_ARGS"] + args,
+        UPLOADERFLAGS=flags[:count] + args + flags[count:])
+
+
+def upload_with_adapter_speed(actions):
+    """Upload actions preceded by the adapter speed autotuning, a cached
+    speed is forgotten when the upload fails with it"""
+
+    def UploadWithAdapterSpeed(target, source, env):
+        cache = _get_speed_cache(env)
+        key = _get_speed_cache_key(env)
+        speed = cache.get(key)
+        cached = bool(speed)
+        if cached:
+            print("Adapter speed: %d kHz, cached for %s" % (speed, key))
+        else:
+            speed = _tune_adapter_speed(env)
+            if speed:
+                cache.set(key, speed)
+        if speed:
+            _apply_adapter_speed(env, speed)
+        for action in actions:
+            status = env.Action(action)(target, source, env)
+            if status:
+                if cached:
+                    cache.forget(key)
+                    sys.stderr.write(
+                        "Warning! The upload failed at the cached adapter "
+                        "speed, it will be tuned again next time\n")
+                return status
+        return 0
+
+    return UploadWithAdapterSpeed
+
+
+def _get_device_id(env):
+    """Board and USB serial number of the device at the upload port, None
+    when the port has no serial number to tell devices apart"""
+    port = env.subst("$UPLOAD_PORT")
+    for item in list_serial_ports():
+        if basename(item["port"]) != basename(port):
+            continue
+        for token in item.get("hwid", "").split():
+            if token.startswith("SER=") and len(token) > 4:
+                return "%s:%s" % (env["BOARD"], token[4:])
+    return None
+
+
+def _verify_samba_image(env, flags, image_path, image, offset):
+    """Compare the whole flashed image with the device, using the DSU CRC32
+    when the MCU has one and BOSSA otherwise"""
+    family = get_dsu_family(env.BoardConfig().get("build.mcu", ""))
+    if family:
+        length, crc = get_image_crc(image)
+        try:
+            with SamBaMonitor(_get_samba_port(env)) as monitor:
+                return monitor.get_crc(family, int(offset, 0), length) == crc
+        except (DsuError, OSError, ValueError) as e:
+            print("Could not read the flash CRC32 (%s)" % e)
+    return not env.Execute(env.VerboseAction(
+        " ".join(["$UPLOADER"] + flags + ["--verify", '"%s"' % image_path]),
+        "Verifying the whole image"))
+
+
+def UploadSamBaDelta(target, source, env):  # pylint: disable=W0613
+    board = env.BoardConfig()
+    offset = board.get("upload.offset_address")
+    with open(source[0].get_abspath(), "rb") as fp:
+        image = fp.read()
+
+    device_id = _get_device_id(env)
+    if not device_id:
+        print("Delta upload: %s has no USB serial number to tell the "
+              "device apart, full flash" % env.subst("$UPLOAD_PORT"))
+        return env.Execute(
+            env.subst("$UPLOADCMD", target=target, source=source))
+
+    record = FlashRecord(
+        join(env.PioPlatform().get_cache_dir(), "flash-images"), device_id)
+    ranges = plan_upload(
+        record.load(board.id, offset), image,
+        get_erase_size(board.get("build.mcu", "")))
+    record.invalidate()
+
+    if ranges is None:
+        print("Delta upload: no trusted image on the device, full flash")
+    else:
+        print("Delta upload: %d byte(s) in %d range(s) of %d" % (
+            sum(end - start for start, end in ranges), len(ranges),
+            len(image)))
+        flags = [f for f in env["UPLOADERFLAGS"] if f not in (
+            "--write", "--verify", "--reset")]
+        offset_index = flags.index("--offset") + 1
+        chunk_path = join(env.subst("$BUILD_DIR"), "delta.bin")
+        status = 0
+        for start, end in ranges:
+            with open(chunk_path, "wb") as fp:
+                fp.write(image[start:end])
+            flags[offset_index] = hex(int(offset, 0) + start)
+            status = env.Execute(env.VerboseAction(
+                " ".join(["$UPLOADER"] + flags + [
+                    "--write", "--verify", '"%s"' % chunk_path]),
+                "Writing 0x%X-0x%X" % (start, end)))
+            if status:
+                break
+        # the stored image may not match the device, e.g. after flashing
+        # with another tool or from another project
+        flags[offset_index] = offset
+        if not status and not _verify_samba_image(
+                env, flags, source[0].get_abspath(), image, offset):
+            sys.stderr.write(
+                "Warning! The flash does not match the firmware after the "
+                "delta upload\n")
+            status = 1
+        if not status:
+            status = env.Execute(" ".join(
+                ["$UPLOADER"] + flags[:offset_index - 1] +
+                flags[offset_index + 1:] + ["--reset"]))
+        if not status:
+            record.save(board.id, offset, image)
+            return 0
+        sys.stderr.write("Delta upload failed, falling back to full flash\n")
+
+    status = env.Execute(
+        env.subst("$UPLOADCMD", target=target, source=source))
+    if not status:
+        record.save(board.id, offset, image)
+    return status
+
+
+def UploadUf2(target, source, env):  # pylint: disable=W0613
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=C0415
+
+    pattern = env.subst("$UPLOAD_PORT")
+    if pattern and (isdir(pattern) or "*" in pattern or "?" in pattern):
+        # one or more drives given explicitly, e.g. "/media/*/FEATHERBOOT*"
+        drives = find_uf2_drives(pattern)
+    else:
+        before = find_uf2_drives()
+        # a serial port selects the board to reset into its bootloader
+        drives = [] if pattern else before
+        if not drives and env.BoardConfig().get(
+                "upload.use_1200bps_touch", False):
+            AutodetectUploadPortCached(target, source, env)
+            print("Forcing reset using 1200bps open/close on port %s" %
+                  env.subst("$UPLOAD_PORT"))
+            touch_port(env.subst("$UPLOAD_PORT"), 1200)
+            print("Waiting for the UF2 drive...")
+            drives = [d for d in [wait_for_uf2_drive(before)] if d]
+        elif pattern and not drives:
+            sys.stderr.write(
+                "Error: %s is neither a UF2 drive nor a serial port the "
+                "board can be reset through\n" % pattern)
+            return 1
+        elif len(drives) > 1:
+            sys.stderr.write(
+                "Error: Several UF2 drives found (%s), please select them "
+                "using 'upload_port' option\n" % ", ".join(drives))
+            return 1
+    if not drives:
+        sys.stderr.write(
+            "Error: Couldn't find a UF2 drive. Try double-pressing the "
+            "board's reset button to start the bootloader\n")
+        return 1
+
+    def _copy(drive):
+        print("Copying %s to %s (%s)" % (
+            basename(source[0].get_abspath()), drive,
+            read_uf2_info(drive).get("Board-ID", "unknown board")))
+        try:
+            copy_to_drive(source[0].get_abspath(), drive)
+        except OSError as e:
+            # the drive disappears once the bootloader has got the image
+            if is_uf2_drive(drive):
+                sys.stderr.write("Error: %s: %s\n" % (drive, e))
+                return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=len(drives)) as executor:
+        results = list(executor.map(_copy, drives))
+    return 0 if all(results) else 1
+
+
+def PrintPortCache(target, source, env):  # pylint: disable=W0613
+    current = _get_port_cache_key(env)
+    for key, entry in _get_port_cache(env).items():
+        port = find_port(entry["identity"], entry["port"])
+        print("%s %s" % ("*" if key == current else " ", key))
+        print("    port: %s (%s)" % (
+            entry["port"], "available at %s" % port if port else "missing"))
+        print("    identity: %s" % json.dumps(entry["identity"], sort_keys=True))
+
+
+def ClearPortCache(target, source, env):  # pylint: disable=W0613
+    _get_port_cache(env).clear()
+    print("Upload port cache has been cleared")
+
+
+def PrintOpenOcdServers(target, source, env):  # pylint: disable=W0613
+    for key, entry in _get_openocd_servers(env).items():
+        print("%s: TCL port %d, pid %d" % (key, entry["port"], entry["pid"]))
+        print("    %s" % " ".join(entry["command"]))
+
+
+def StopOpenOcdServers(target, source, env):  # pylint: disable=W0613
+    print("Stopped %d OpenOCD server(s)" % _get_openocd_servers(env).stop())
+
+
+def RetuneAdapterSpeed(target, source, env):  # pylint: disable=W0613
+    protocol = env.subst("$UPLOAD_PROTOCOL")
+    if not (protocol.startswith("jlink") or "OPENOCD_ARGS" in env):
+        sys.stderr.write(
+            "Error: The %s upload protocol has no adapter speed\n" % protocol)
+        env.Exit(1)
+    cache = _get_speed_cache(env)
+    key = _get_speed_cache_key(env)
+    cache.forget(key)
+    speed = _tune_adapter_speed(env)
+    if speed:
+        cache.set(key, speed)
+    for entry_key, entry in cache.items():
+        print("%s %s: %d kHz" % (
+            "*" if entry_key == key else " ", entry_key, entry["speed"]))
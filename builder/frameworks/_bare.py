@@ -35,13 +35,11 @@ env.Append(
     ],
 
     CCFLAGS=[
-        "-Os",  # optimize for size
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
         "-Wall",
         "-mthumb",
-        "-nostdlib",
-        "--param", "max-inline-insns-single=500"
+        "-nostdlib"
     ],
 
     CXXFLAGS=[
@@ -57,7 +55,6 @@ env.Append(
     ],
 
     LINKFLAGS=[
-        "-Os",
         "-mthumb",
         # "-Wl,--cref", # don't enable it, it prints Cross Reference Table
         "-Wl,--gc-sections",
@@ -70,6 +67,9 @@ env.Append(
     LIBS=["m"],
 )
 
+# "-Os" unless another "board_build.optimization" profile is selected
+env.Append(**env.GetOptimizationFlags())
+
 if "BOARD" in env:
     env.Append(
         ASFLAGS=[
@@ -58,12 +58,10 @@ env.Append(
     ],
 
     CCFLAGS=machine_flags + [
-        "-Os",  # optimize for size
         "-ffunction-sections",  # place each function in its own section
         "-fdata-sections",
         "-Wall",
-        "-nostdlib",
-        "--param", "max-inline-insns-single=500"
+        "-nostdlib"
     ],
 
     CXXFLAGS=[
@@ -84,7 +82,6 @@ env.Append(
     ],
 
     LINKFLAGS=machine_flags + [
-        "-Os",
         "-Wl,--gc-sections",
         "-Wl,--check-sections",
         "-Wl,--unresolved-symbols=report-all",
@@ -95,6 +92,9 @@ env.Append(
     LIBS=["m"]
 )
 
+# "-Os" unless another "board_build.optimization" profile is selected
+env.Append(**env.GetOptimizationFlags())
+
 variants_dir = os.path.join(
     "$PROJECT_DIR", board.get("build.variants_dir")) if board.get(
         "build.variants_dir", "") else os.path.join(FRAMEWORK_DIR, "variants")
@@ -64,6 +64,12 @@ env.Append(
     LIBS=["sam_sam3x8e_gcc_rel", "gcc"]
 )
 
+#
+# Precompiled "Arduino.h" (board_build.pch = yes)
+#
+
+env.PrecompileHeader(os.path.join(FRAMEWORK_DIR, "cores", "arduino", "Arduino.h"))
+
 #
 # Target: Build Core Library
 #
@@ -83,12 +89,12 @@ if "build.variant" in board:
             os.path.join(variants_dir, board.get("build.variant"))
         ],
     )
-    libs.append(env.BuildLibrary(
+    libs.append(env.BuildCoreLibrary(
         os.path.join("$BUILD_DIR", "FrameworkArduinoVariant"),
         os.path.join(variants_dir, board.get("build.variant"))
     ))
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildCoreLibrary(
     os.path.join("$BUILD_DIR", "FrameworkArduino"),
     os.path.join(FRAMEWORK_DIR, "cores", "arduino")
 ))
@@ -171,6 +171,12 @@ elif VENDOR_CORE == "arduino":
         ]
     )
 
+#
+# Precompiled "Arduino.h" (board_build.pch = yes)
+#
+
+env.PrecompileHeader(os.path.join(FRAMEWORK_DIR, "cores", BUILD_CORE, "Arduino.h"))
+
 #
 # Target: Build Core Library
 #
@@ -185,12 +191,12 @@ if "build.variant" in board:
     env.Append(
         CPPPATH=[os.path.join(variants_dir, board.get("build.variant"))]
     )
-    libs.append(env.BuildLibrary(
+    libs.append(env.BuildCoreLibrary(
         os.path.join("$BUILD_DIR", "FrameworkArduinoVariant"),
         os.path.join(variants_dir, board.get("build.variant"))
     ))
 
-libs.append(env.BuildLibrary(
+libs.append(env.BuildCoreLibrary(
     os.path.join("$BUILD_DIR", "FrameworkArduino"),
     os.path.join(FRAMEWORK_DIR, "cores", BUILD_CORE)
 ))
@@ -12,47 +12,510 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import re
+import shutil
 import sys
+import time
 from platform import system
-from os import makedirs
-from os.path import basename, isdir, join
+from os import getpid, makedirs, remove, replace, walk
+from os.path import (basename, dirname, getmtime, isdir, isfile, join,
+                     realpath)
 
 from SCons.Script import (ARGUMENTS, COMMAND_LINE_TARGETS, AlwaysBuild,
                           Builder, Default, DefaultEnvironment)
 
-from platformio.public import list_serial_ports
+from atmelsam import is_enabled
+from atmelsam.adapterspeed import is_auto
+from atmelsam.corecache import ArchiveCache, describe_path, make_key
+from atmelsam.dsu import get_family as get_dsu_family
+from atmelsam.elf import ElfError, ElfFile, get_section_sizes, to_binary, to_ihex
+from atmelsam.footprint import (FootprintDatabase, check_budgets,
+                                get_library_usage, get_unknown_budgets,
+                                parse_budgets, parse_map)
+from atmelsam.multiupload import (PORT_PLACEHOLDER, resolve_ports,
+                                  upload_to_ports)
+from atmelsam.optimization import get_profile_flags
+from atmelsam.ramfuncs import (find_missing_functions, get_ram_functions,
+                               get_section_renames, parse_profile,
+                               parse_ramfuncs)
+from atmelsam.sizereport import (build_report, compare_reports,
+                                 get_section_usage, load_report, save_report)
+from atmelsam.tracing import CaptureSerialData, CaptureTrace
+from atmelsam.uf2 import convert_to_uf2, get_family_id
+from atmelsam.upload import (AutodetectUploadPortCached, BeforeUpload,
+                             ClearPortCache, PrintOpenOcdServers,
+                             PrintPortCache, RetuneAdapterSpeed,
+                             StopOpenOcdServers, UploadSamBaDelta, UploadUf2,
+                             UploadViaOpenOcdServer, release_probe_for,
+                             upload_unless_identical,
+                             upload_with_adapter_speed)
 
+# targets that only build the firmware and never use the upload tool
+# configured in "Target: Upload" below
+BUILD_TARGETS = ("buildprog", "size", "checkprogsize", "compiledb",
+                 "__idedata", "uf2", "size_report", "footprint",
+                 "footprint_reset", "packages_plan")
 
-def BeforeUpload(target, source, env):  # pylint: disable=W0613,W0621
-    env.AutodetectUploadPort()
 
-    upload_options = {}
+def UploadToPorts(target, source, env):  # pylint: disable=W0613,W0621
+    board = env.BoardConfig()
+    ports = resolve_ports(
+        board.get("upload.ports"), board.get("build.hwids", []))
+    if not ports:
+        sys.stderr.write(
+            "Error: no devices found for 'board_upload.ports = %s'\n" %
+            board.get("upload.ports"))
+        return 1
+
+    env.Replace(UPLOAD_PORT=PORT_PLACEHOLDER)
+    uploads = upload_to_ports(
+        ports,
+        env.subst("$UPLOADCMD", target=target, source=source),
+        {k: str(v) for k, v in env["ENV"].items()},
+        board.get("upload", {}),
+        short_port_name=env.subst("$UPLOAD_PROTOCOL") == "sam-ba",
+        jobs=int(board.get("upload.jobs", 0)) or None,
+        verbose=int(ARGUMENTS.get("PIOVERBOSE", 0)))
+    return int(any(item.returncode for item in uploads))
+
+
+def _convert_elf(target, source, env, converter, fallback_cmd):
+    try:
+        with ElfFile(source[0].get_abspath()) as elf:
+            data = converter(elf)
+    except (ElfError, OSError, ValueError) as e:
+        if not fallback_cmd:
+            sys.stderr.write("Error: %s\n" % e)
+            return 1
+        sys.stderr.write("Warning! %s, falling back to objcopy\n" % e)
+        return env.Execute(
+            env.subst(fallback_cmd, target=target, source=source))
+    with open(target[0].get_abspath(), "wb") as fp:
+        fp.write(data)
+    return 0
+
+
+def ElfToBinAction(target, source, env):
+    return _convert_elf(
+        target, source, env, to_binary, "$OBJCOPY -O binary $SOURCES $TARGET")
+
+
+def ElfToHexAction(target, source, env):
+    # written as bytes, the records already end with CRLF as objcopy's do
+    return _convert_elf(
+        target, source, env,
+        lambda elf: to_ihex(elf, exclude=[".eeprom"]).encode("ascii"),
+        "$OBJCOPY -O ihex -R .eeprom $SOURCES $TARGET")
+
+
+def ElfToUf2Action(target, source, env):
+    board = env.BoardConfig()
+    return _convert_elf(
+        target, source, env, lambda elf: convert_to_uf2(
+            to_binary(elf), int(board.get("upload.offset_address", "0"), 0),
+            get_family_id(board.get("build.mcu", ""))),
+        None)
+
+
+def WriteSizeReport(target, source, env, verbose=True):  # pylint: disable=W0613,W0621
+    board = env.BoardConfig()
+    report_path = join(env.subst("$BUILD_DIR"), "size-report.json")
+    report = build_report(
+        source[0].get_abspath(), env.subst("$BUILD_DIR"),
+        int(board.get("upload.offset_address", "0"), 0),
+        int(board.get("upload.maximum_size", 0)),
+        int(board.get("upload.maximum_ram_size", 0)))
+    previous = load_report(report_path)
+    if previous:
+        report["changes"] = compare_reports(previous, report)
+    save_report(report_path, report)
+
+    if not verbose:
+        return 0
+    print("Flash: %d bytes used, image spans 0x%X-0x%X" % (
+        report["flash"]["used"], report["flash"]["image_start"] or 0,
+        report["flash"]["image_end"] or 0))
+    print("RAM:   %d bytes used" % report["ram"]["used"])
+    print("Largest objects (flash / RAM):")
+    for item in report["objects"][:10]:
+        print("  %8d %8d  %s" % (item["flash"], item["ram"], item["name"]))
+    changes = report.get("changes")
+    if changes and (changes["flash"] or changes["ram"]):
+        print("Changes since previous report: flash %+d, RAM %+d bytes" % (
+            changes["flash"], changes["ram"]))
+        for item in (changes["objects_flash"] + changes["objects_ram"])[:10]:
+            print("  %+8d  %s" % (item["delta"], item["name"]))
+    print("Report: %s" % report_path)
+    return 0
+
+
+def _get_footprint_db(env):
+    return FootprintDatabase(
+        join(env.subst("$PROJECT_WORKSPACE_DIR"), "footprint.db"))
+
+
+def _print_footprint_diff(db, old_id, new_id):
+    diff = db.diff(old_id, new_id)
+    for item in diff["libraries"]:
+        print("  %-32s flash %+7d  RAM %+7d" % (
+            item["name"], item["flash"], item["ram"]))
+    for item in diff["sections"][:10]:
+        print("    %-30s flash %+7d  RAM %+7d  %s" % (
+            item["input"], item["flash"], item["ram"], item["object"]))
+
+
+def RecordFootprint(target, source, env):  # pylint: disable=W0613,W0621
+    """Store the linker map of this build and check footprint budgets.
+
+    Only builds within budget become snapshots, so that the growth is
+    always measured against the last accepted build.
+    """
+    elf_path = target[0].get_abspath()
+    with ElfFile(elf_path) as elf:
+        section_usage = dict(
+            (s.name, get_section_usage(s)) for s in elf.sections)
+    parsed = parse_map(
+        env.subst(join("$BUILD_DIR", "${PROGNAME}.map")),
+        env.subst("$BUILD_DIR"), section_usage)
+    build = dict(
+        flash=sum(p["flash"] for p in parsed["placements"]),
+        ram=sum(p["ram"] for p in parsed["placements"]))
+
+    budgets = parse_budgets(
+        env.BoardConfig().get("build.footprint_budget", ""))
+    libraries = get_library_usage(parsed["placements"])
+    for name in get_unknown_budgets(budgets, libraries):
+        sys.stderr.write(
+            "Warning! Footprint budget `%s` matches no library of the "
+            "build (%s)\n" % (name, ", ".join(sorted(libraries))))
+
+    with _get_footprint_db(env) as db:
+        previous = (db.get_builds(env["PIOENV"], 1) or [None])[0]
+        errors = check_budgets(budgets, build, libraries, previous)
+        if errors:
+            for error in errors:
+                sys.stderr.write("Error: %s\n" % error)
+            # do not leave a firmware behind that would not be relinked
+            # (and checked again) by the next build
+            remove(elf_path)
+            return 1
+        build_id = db.add_snapshot(env["PIOENV"], parsed)
+        print("Footprint: flash %d bytes, RAM %d bytes" % (
+            build["flash"], build["ram"]))
+        if previous and (previous["flash"], previous["ram"]) != (
+                build["flash"], build["ram"]):
+            print("Changes since the previous build: flash %+d, RAM %+d" % (
+                build["flash"] - previous["flash"],
+                build["ram"] - previous["ram"]))
+            _print_footprint_diff(db, previous["id"], build_id)
+    return 0
+
+
+def _format_available_bytes(value, total):
+    percent_raw = float(value) / float(total)
+    blocks_per_progress = 10
+    used_blocks = min(
+        int(round(blocks_per_progress * percent_raw)), blocks_per_progress)
+    return "[{:{}}] {: 6.1%} (used {:d} bytes from {:d} bytes)".format(
+        "=" * used_blocks, blocks_per_progress, percent_raw, value, total)
+
+
+def _calculate_size(output, pattern):
+    size = 0
+    regexp = re.compile(pattern)
+    for line in output.split("\n"):
+        match = regexp.search(line.strip())
+        if match:
+            size += sum(int(value) for value in match.groups())
+    return size
+
+
+def CheckUploadSize(_, target, source, env):  # pylint: disable=W0621
+    """The same check as PlatformIO's, without spawning "$SIZETOOL -A" """
+    if "BOARD" not in env:
+        return None
+    program_max_size = int(env.BoardConfig().get("upload.maximum_size", 0))
+    data_max_size = int(env.BoardConfig().get("upload.maximum_ram_size", 0))
+    if program_max_size == 0:
+        return None
+    if env.get("SIZECHECKCMD") != "$SIZETOOL -A -d $SOURCES":
+        return pio_check_upload_size(target, source, env)
+    try:
+        with ElfFile(source[0].get_abspath()) as elf:
+            sections = get_section_sizes(elf)
+            image_start = min(
+                [s.lma for s in elf.get_loadable_sections()] or [None])
+            ram_functions = get_ram_functions(elf) if env.get(
+                "RAMFUNCS") else None
+    except (ElfError, OSError, ValueError):
+        return pio_check_upload_size(target, source, env)
+
+    output = "\n".join("%-20s %d %d" % row for row in sections)
+    program_size = _calculate_size(output, env.get("SIZEPROGREGEXP"))
+    data_size = _calculate_size(output, env.get("SIZEDATAREGEXP"))
+
+    print('Advanced Memory Usage is available via '
+          '"PlatformIO Home > Project Inspect"')
+    if data_max_size:
+        print("RAM:   %s" % _format_available_bytes(data_size, data_max_size))
+    print("Flash: %s" % _format_available_bytes(program_size, program_max_size))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        print(output)
+
+    offset = int(env.BoardConfig().get("upload.offset_address", "0"), 0)
+    if image_start is not None and image_start < offset:
+        sys.stderr.write(
+            "Warning! The firmware starts at 0x%X, below the application "
+            "offset 0x%X reserved for the bootloader\n" % (image_start, offset))
+    if is_enabled(env.BoardConfig().get("build.size_report", False)):
+        WriteSizeReport(target, source, env, verbose=False)
+    if ram_functions is not None and not _check_ram_functions(
+            env, ram_functions, data_size, data_max_size):
+        env.Exit(1)
+
+    if program_size > program_max_size:
+        sys.stderr.write(
+            "Error: The program size (%d bytes) is greater "
+            "than maximum allowed (%s bytes)\n" % (
+                program_size, program_max_size))
+        env.Exit(1)
+    return None
+
+
+def _get_core_cache_key(env, src_dir):
+    private_dirs = [
+        realpath(env.subst(path)) for path in ("$PROJECT_DIR", "$BUILD_DIR")]
+    source = describe_path(env.subst(src_dir), private_dirs)
+    if source[0] != "package":
+        return None  # e.g. a custom variant in the project
+    flags = env.subst(
+        "$CC $CFLAGS $CCFLAGS $CPPFLAGS $_CPPDEFFLAGS "
+        "$CXX $CXXFLAGS $AS $ASFLAGS $ASPPFLAGS")
+    for index, path in enumerate(private_dirs):
+        flags = flags.replace(path, "${PRIVATE_DIR%d}" % index)
+    toolchain_dir = env.PioPlatform().get_package_dir(
+        "toolchain-gccarmnoneeabi")
+    return make_key(dict(
+        source=source,
+        toolchain=describe_path(toolchain_dir) if toolchain_dir else None,
+        flags=flags,
+        ramfuncs=env.get("RAMFUNCS", []),
+        includes=[
+            describe_path(env.subst(str(path)), private_dirs)
+            for path in env.get("CPPPATH", [])
+        ],
+    ))
+
+
+def BuildCoreLibrary(env, variant_dir, src_dir):
+    """The same as ``env.BuildLibrary``, the archive is taken from or added
+    to the machine-wide cache when "board_build.core_cache" is enabled"""
+    if "BOARD" not in env or not is_enabled(
+            env.BoardConfig().get("build.core_cache", False)):
+        return env.BuildLibrary(variant_dir, src_dir)
+    # debug flags are applied after the frameworks have been configured
+    if "debug" in env.GetBuildType():
+        return env.BuildLibrary(variant_dir, src_dir)
+
+    env.ProcessUnFlags(env.get("BUILD_UNFLAGS"))
+    key = _get_core_cache_key(env, src_dir)
+    if not key:
+        return env.BuildLibrary(variant_dir, src_dir)
+
+    cache = ArchiveCache(
+        join(env.PioPlatform().get_cache_dir(), "core-archives"))
+    name = env.subst("${LIBPREFIX}%s${LIBSUFFIX}" % basename(variant_dir))
+    cached_path = cache.get(key, name)
+
+    def _restore(target, source, env):  # pylint: disable=W0613,W0621
+        # flags may still be changed by "post:" extra scripts
+        if _get_core_cache_key(env, src_dir) != key:
+            sys.stderr.write(
+                "Error: Build flags have been changed after the framework "
+                "was configured, the cached %s can not be used. Disable "
+                "`board_build.core_cache` for this environment.\n" % name)
+            return 1
+        shutil.copyfile(source[0].get_abspath(), target[0].get_abspath())
+        return 0
+
+    def _store(target, source, env):  # pylint: disable=W0613,W0621
+        if _get_core_cache_key(env, src_dir) != key:
+            return 0
+        try:
+            cache.put(key, name, target[0].get_abspath(), dict(
+                source=env.subst(src_dir), created=int(time.time())))
+        except OSError as e:
+            sys.stderr.write("Warning! Could not cache %s: %s\n" % (name, e))
+        return 0
+
+    if cached_path:
+        return env.Command(
+            join(dirname(variant_dir), name), cached_path,
+            env.VerboseAction(_restore, "Using cached %s" % name))
+
+    lib = env.BuildLibrary(variant_dir, src_dir)
+    env.AddPostAction(lib, env.VerboseAction(_store, "Caching %s" % name))
+    return lib
+
+
+def RelocateRamFunctions(target, source, env):  # pylint: disable=W0613,W0621
+    obj_path = target[0].get_abspath()
+    renames = get_section_renames(obj_path, env["RAMFUNCS"])
+    if not renames:
+        return 0
+    cmd = ["$OBJCOPY"] + [
+        '--rename-section "%s=%s"' % (
+            old.replace("$", "$$"), new.replace("$", "$$"))
+        for old, new in renames
+    ] + ['"%s"' % obj_path]
+    return env.Execute(env.VerboseAction(
+        " ".join(cmd), "Moving %s to RAM" % ", ".join(
+            old[len(".text."):] for old, _ in renames)))
+
+
+def PlaceRamFunctions(env, node):
+    """Build middleware for "board_build.ramfuncs" """
+    obj = env.Object(node)
+    env.AddPostAction(obj, RelocateRamFunctions)
+    return obj
+
+
+def _check_ram_functions(env, functions, data_size, data_max_size):
+    used = sum(size for _, size in functions)
+    print("RAM functions: %d bytes in %d functions" % (used, len(functions)))
+    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+        for name, size in functions:
+            print("  %-48s %6d" % (name, size))
+    for pattern in find_missing_functions(env["RAMFUNCS"], functions):
+        sys.stderr.write(
+            "Warning! RAM function '%s' was not found\n" % pattern)
+    if data_max_size and data_size > data_max_size:
+        sys.stderr.write(
+            "Error: The data size (%d bytes, including %d bytes of RAM "
+            "functions) is greater than maximum allowed (%s bytes)\n" % (
+                data_size, used, data_max_size))
+        return False
+    return True
+
+
+def GetOptimizationFlags(env):
+    """Compiler and linker flags of the "board_build.optimization" profile"""
+    profile = None
     if "BOARD" in env:
-        upload_options = env.BoardConfig().get("upload", {})
+        profile = env.BoardConfig().get("build.optimization", "")
+    try:
+        return get_profile_flags(profile)
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        env.Exit(1)
+    return None
+
+
+def _build_pch(target, source, env):  # pylint: disable=W0613,W0621
+    gch_path = target[0].get_abspath()
+    tmp_path = "%s.%d.tmp" % (gch_path, getpid())
+    started = time.time()
+    status = env.Execute(env.VerboseAction(env.subst(
+        "$CXX -x c++-header -o \"%s\" -c $CXXFLAGS $CCFLAGS $_CCCOMCOM "
+        "$SOURCE" % tmp_path, target=target, source=source), ""))
+    if status:
+        if isfile(tmp_path):
+            remove(tmp_path)
+        return status
+    # compilers of other translation units may look at the file meanwhile
+    replace(tmp_path, gch_path)
+    with open(gch_path + ".json", "w", encoding="utf8") as fp:
+        json.dump(dict(seconds=round(time.time() - started, 3)), fp)
+    return 0
+
 
-    if not bool(upload_options.get("disable_flushing", False)):
-        env.FlushSerialBuffer("$UPLOAD_PORT")
+def PrecompileHeader(env, header):
+    """Serve ``#include <header>`` of C++ sources from a precompiled header
+    when "board_build.pch" is enabled.
 
-    before_ports = list_serial_ports()
+    The ".gch" file lives in a directory that comes first in CPPPATH. GCC
+    skips it for C sources or translation units compiled with other flags
+    and takes the original header from the next include directory instead.
+    """
+    if "BOARD" not in env or not is_enabled(
+            env.BoardConfig().get("build.pch", False)):
+        return None
+    if not isfile(header):
+        return None
+    name = basename(header)
+    pch_dir = env.subst(join("$BUILD_DIR", "pch", make_key([
+        header, env.subst("$CXX $CXXFLAGS $CCFLAGS $_CPPDEFFLAGS")])[:16]))
+    if not isdir(pch_dir):
+        makedirs(pch_dir)
+    # the unknown suffix keeps the source scanner away from this file,
+    # otherwise the header would depend on its own precompiled version
+    stub_path = join(pch_dir, name + ".pch")
+    stub = '#include "%s"\n' % header
+    current_stub = None
+    if isfile(stub_path):
+        with open(stub_path, encoding="utf8") as fp:
+            current_stub = fp.read()
+    if current_stub != stub:
+        with open(stub_path, "w", encoding="utf8") as fp:
+            fp.write(stub)
 
-    if bool(upload_options.get("use_1200bps_touch", False)):
-        env.TouchSerialPort("$UPLOAD_PORT", 1200)
+    private_dirs = [
+        realpath(env.subst(path)) for path in ("$PROJECT_DIR", "$BUILD_DIR")]
+    gch = env.Command(
+        join(pch_dir, name + ".gch"),
+        [stub_path, env.Value(json.dumps([
+            describe_path(env.subst(str(path)), private_dirs)
+            for path in env.get("CPPPATH", [])]))],
+        env.Action(_build_pch, "Precompiling %s" % name, varlist=[
+            "CXX", "CXXFLAGS", "CCFLAGS", "CPPDEFINES", "CPPPATH"]))
+    # sources including the header wait until it has been precompiled
+    env.Depends(env.File(header), gch)
+    env.Prepend(CPPPATH=[pch_dir])
+    env.Append(PCH_STATS=[gch[0].get_abspath() + ".json"])
+    return gch
 
-    if bool(upload_options.get("wait_for_upload_port", False)):
-        env.Replace(UPLOAD_PORT=env.WaitForNewSerialPort(before_ports))
 
-    # use only port name for BOSSA
-    if ("/" in env.subst("$UPLOAD_PORT") and
-            env.subst("$UPLOAD_PROTOCOL") == "sam-ba"):
-        env.Replace(UPLOAD_PORT=basename(env.subst("$UPLOAD_PORT")))
+def ReportPrecompiledHeaders(target, source, env):  # pylint: disable=W0613,W0621
+    cxx_objects = 0
+    for root, _, files in walk(env.subst("$BUILD_DIR")):
+        cxx_objects += sum(
+            1 for name in files
+            if name.endswith((".cpp.o", ".cc.o", ".cxx.o"))
+            and getmtime(join(root, name)) >= BUILD_STARTED)
+    for stats_path in env.get("PCH_STATS", []):
+        if not isfile(stats_path):
+            continue
+        with open(stats_path, encoding="utf8") as fp:
+            seconds = json.load(fp)["seconds"]
+        saved = cxx_objects * seconds
+        if getmtime(stats_path) >= BUILD_STARTED:
+            saved -= seconds
+        # not measured: every C++ file is assumed to include the header and
+        # to have spent as long on it as its precompilation took
+        print("Precompiled %s (%.2f s), %d C++ files compiled in this build, "
+              "estimated saving up to %.1f s of header parsing" % (
+                  basename(stats_path)[:-len(".gch.json")], seconds,
+                  cxx_objects, max(saved, 0)))
+    return 0
 
 
+BUILD_STARTED = time.time()
+
 env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 upload_protocol = env.subst("$UPLOAD_PROTOCOL")
 build_mcu = env.get("BOARD_MCU", board.get("build.mcu", ""))
 
+if upload_protocol == "uf2" and "uf2" not in board.get(
+        "upload.protocols", []):
+    # a UF2 image is useless without a bootloader that understands it
+    sys.stderr.write(
+        "Error: %s doesn't come with a UF2 bootloader, please select "
+        "another 'upload_protocol'\n" % board.get("name", env.get("BOARD")))
+    env.Exit(1)
+
 env.Replace(
     AR="arm-none-eabi-gcc-ar",
     AS="arm-none-eabi-as",
@@ -80,30 +543,31 @@ if env.get("PROGNAME", "program") == "program":
 env.Append(
     BUILDERS=dict(
         ElfToBin=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "binary",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(ElfToBinAction, "Building $TARGET"),
             suffix=".bin"
         ),
         ElfToHex=Builder(
-            action=env.VerboseAction(" ".join([
-                "$OBJCOPY",
-                "-O",
-                "ihex",
-                "-R",
-                ".eeprom",
-                "$SOURCES",
-                "$TARGET"
-            ]), "Building $TARGET"),
+            action=env.VerboseAction(ElfToHexAction, "Building $TARGET"),
             suffix=".hex"
+        ),
+        ElfToUf2=Builder(
+            action=env.VerboseAction(ElfToUf2Action, "Building $TARGET"),
+            suffix=".uf2"
         )
     )
 )
 
+# read section sizes of the firmware in-process
+pio_check_upload_size = env.CheckUploadSize
+env.AddMethod(CheckUploadSize)
+env.AddMethod(BuildCoreLibrary)
+env.AddMethod(GetOptimizationFlags)
+env.AddMethod(PrecompileHeader)
+
+# the IDE reads the SVD file of the board from the project metadata
+if "__idedata" in COMMAND_LINE_TARGETS:
+    platform.restore_svd_file(board)
+
 if not env.get("PIOFRAMEWORK"):
     env.SConscript("frameworks/_bare.py")
 
@@ -118,16 +582,54 @@ if "zephyr" in env.get("PIOFRAMEWORK", []):
         exports={"env": env}
     )
 
+# linker map footprint database and budgets
+footprint_budgets = {}
+try:
+    footprint_budgets = parse_budgets(board.get("build.footprint_budget", ""))
+except ValueError as e:
+    sys.stderr.write("Error: `board_build.footprint_budget`: %s\n" % e)
+    env.Exit(1)
+footprint_enabled = is_enabled(board.get("build.footprint", False)) or bool(
+    footprint_budgets)
+if footprint_enabled:
+    env.Append(LINKFLAGS=["-Wl,-Map,%s" % join("$BUILD_DIR", "${PROGNAME}.map")])
+
+# hot functions relocated to RAM
+ramfuncs = parse_ramfuncs(board.get("build.ramfuncs", ""))
+if board.get("build.ramfuncs_profile", ""):
+    profile_path = env.subst(
+        join("$PROJECT_DIR", board.get("build.ramfuncs_profile")))
+    if not isfile(profile_path):
+        sys.stderr.write(
+            "Error: Could not find RAM functions profile %s\n" % profile_path)
+        env.Exit(1)
+    ramfuncs.extend(parse_profile(
+        profile_path, int(board.get("build.ramfuncs_limit", 0))))
+if ramfuncs:
+    env.Replace(RAMFUNCS=ramfuncs)
+    env.AddBuildMiddleware(PlaceRamFunctions)
+
 target_elf = None
-if "nobuild" in COMMAND_LINE_TARGETS:
+# the packages plan is only printed, its packages may not be installed
+if set(COMMAND_LINE_TARGETS) & set(["nobuild", "packages_plan"]):
     target_elf = join("$BUILD_DIR", "${PROGNAME}.elf")
-    target_firm = join("$BUILD_DIR", "${PROGNAME}.%s" %
-                       ("hex" if upload_protocol == "stk500v2" else "bin"))
+    target_firm = join("$BUILD_DIR", "${PROGNAME}.%s" % {
+        "stk500v2": "hex", "uf2": "uf2"}.get(upload_protocol, "bin"))
 else:
     target_elf = env.BuildProgram()
+    if footprint_enabled:
+        env.AddPostAction(target_elf, env.VerboseAction(
+            RecordFootprint, "Recording footprint of $TARGET"))
+    if env.get("PCH_STATS"):
+        env.AddPostAction(target_elf, env.VerboseAction(
+            ReportPrecompiledHeaders, "Checking precompiled headers"))
     if upload_protocol == "stk500v2":
         target_firm = env.ElfToHex(
             join("$BUILD_DIR", "${PROGNAME}"), target_elf)
+    elif upload_protocol == "uf2":
+        target_firm = env.ElfToUf2(
+            join("$BUILD_DIR", "${PROGNAME}"), target_elf)
+        env.Depends(target_firm, "checkprogsize")
     else:
         target_firm = env.ElfToBin(
             join("$BUILD_DIR", "${PROGNAME}"), target_elf)
@@ -145,156 +647,371 @@ target_size = env.Alias(
     env.VerboseAction("$SIZEPRINTCMD", "Calculating size $SOURCE"))
 AlwaysBuild(target_size)
 
+#
+# Target: Build UF2 image for mass-storage bootloaders
+#
+
+if get_family_id(build_mcu) and "nobuild" not in COMMAND_LINE_TARGETS:
+    env.AddPlatformTarget(
+        "uf2",
+        target_firm if upload_protocol == "uf2" else env.ElfToUf2(
+            join("$BUILD_DIR", "${PROGNAME}"), target_elf),
+        None,
+        "Build UF2",
+        "Build firmware image for UF2 mass-storage bootloaders",
+    )
+
+#
+# Target: Write JSON footprint report
+#
+
+env.AddPlatformTarget(
+    "size_report",
+    target_elf,
+    env.VerboseAction(WriteSizeReport, "Analyzing $SOURCE"),
+    "Size Report",
+    "Write flash/RAM usage per section, object file and symbol to JSON",
+)
+
+#
+# Target: Footprint history
+#
+
+
+def _print_footprint_history(*args, **kwargs):  # pylint: disable=W0613
+    with _get_footprint_db(env) as db:
+        builds = db.get_builds(env["PIOENV"], 10)
+        if not builds:
+            print("No footprint snapshots, enable 'board_build.footprint'")
+            return
+        for item in builds:
+            print("  #%-5d %s  flash %8d  RAM %8d" % (
+                item["id"], time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(item["time"])),
+                item["flash"], item["ram"]))
+        if len(builds) > 1:
+            print("Changes in the last build:")
+            _print_footprint_diff(db, builds[1]["id"], builds[0]["id"])
+
+
+env.AddPlatformTarget(
+    "footprint",
+    None,
+    env.VerboseAction(_print_footprint_history, "Reading footprint history..."),
+    "Footprint History",
+    "Print recent footprint snapshots and the changes of the last build",
+)
+
+
+def _reset_footprint_history(*args, **kwargs):  # pylint: disable=W0613
+    with _get_footprint_db(env) as db:
+        print("Dropped %d footprint snapshot(s), the next build is the new "
+              "reference" % db.reset(env["PIOENV"]))
+
+
+env.AddPlatformTarget(
+    "footprint_reset",
+    None,
+    env.VerboseAction(_reset_footprint_history, "Resetting footprint history..."),
+    "Reset Footprint History",
+    "Accept the next build as the reference for the growth budget",
+)
+
+#
+# Target: Print resolved packages plan
+#
+
+
+def _print_packages_plan(*args, **kwargs):  # pylint: disable=W0613
+    print(json.dumps(platform.packages_plan, indent=2, sort_keys=True))
+
+
+env.AddPlatformTarget(
+    "packages_plan",
+    None,
+    env.VerboseAction(_print_packages_plan, "Resolving packages plan..."),
+    "Packages Plan",
+    "Print resolved packages without installing them or building",
+)
+
+#
+# Target: Inspect and clear upload port cache
+#
+
+env.AddPlatformTarget(
+    "openocd_servers",
+    None,
+    env.VerboseAction(PrintOpenOcdServers, "Reading OpenOCD servers..."),
+    "OpenOCD Servers",
+    "Print persistent OpenOCD servers used for uploading",
+)
+env.AddPlatformTarget(
+    "stop_openocd_servers",
+    None,
+    env.VerboseAction(StopOpenOcdServers, "Stopping OpenOCD servers..."),
+    "Stop OpenOCD Servers",
+    "Shut down persistent OpenOCD servers, e.g. before a debug session",
+)
+env.AddPlatformTarget(
+    "upload_port_cache",
+    None,
+    env.VerboseAction(PrintPortCache, "Reading upload port cache..."),
+    "Upload Port Cache",
+    "Print devices remembered for upload port auto-detection",
+)
+env.AddPlatformTarget(
+    "clear_upload_port_cache",
+    None,
+    env.VerboseAction(ClearPortCache, "Clearing upload port cache..."),
+    "Clear Upload Port Cache",
+    "Forget devices remembered for upload port auto-detection",
+)
+
 #
 # Target: Upload by default .bin file
 #
 
-debug_tools = board.get("debug.tools", {})
 upload_actions = []
 
-if upload_protocol.startswith("blackmagic"):
-    env.Replace(
-        UPLOADER="$GDB",
-        UPLOADERFLAGS=[
-            "-nx",
-            "--batch",
-            "-ex", "target extended-remote $UPLOAD_PORT",
-            "-ex", "monitor %s_scan" %
-            ("jtag" if upload_protocol == "blackmagic-jtag" else "swdp"),
-            "-ex", "attach 1",
-            "-ex", "load",
-            "-ex", "compare-sections",
-            "-ex", "kill"
-        ],
-        UPLOADCMD="$UPLOADER $UPLOADERFLAGS $BUILD_DIR/${PROGNAME}.elf"
-    )
-    upload_actions = [
-        env.VerboseAction(env.AutodetectUploadPort, "Looking for BlackMagic port..."),
-        env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
-    ]
-
-elif upload_protocol.startswith("jlink"):
-
-    def _jlink_cmd_script(env, source):
-        build_dir = env.subst("$BUILD_DIR")
-        if not isdir(build_dir):
-            makedirs(build_dir)
-        script_path = join(build_dir, "upload.jlink")
-        commands = [
-            "h",
-            "loadbin %s, %s" % (source, env.BoardConfig().get(
-                "upload.offset_address", "0x0")),
-            "r",
-            "q"
+# the upload tool is set up only when a target may use it, build-only runs
+# such as "build on save" skip the protocol setup
+if not set(COMMAND_LINE_TARGETS) <= set(BUILD_TARGETS):
+    debug_tools = board.get("debug.tools", {})
+    debug_speed = env.GetProjectOption("debug_speed", "")
+
+    if upload_protocol.startswith("blackmagic"):
+        env.Replace(
+            UPLOADER="$GDB",
+            UPLOADERFLAGS=[
+                "-nx",
+                "--batch",
+                "-ex", "target extended-remote $UPLOAD_PORT",
+                "-ex", "monitor %s_scan" %
+                ("jtag" if upload_protocol == "blackmagic-jtag" else "swdp"),
+                "-ex", "attach 1",
+                "-ex", "load",
+                "-ex", "compare-sections",
+                "-ex", "kill"
+            ],
+            UPLOADCMD="$UPLOADER $UPLOADERFLAGS $BUILD_DIR/${PROGNAME}.elf"
+        )
+        upload_actions = [
+            env.VerboseAction(AutodetectUploadPortCached, "Looking for BlackMagic port..."),
+            env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
         ]
-        with open(script_path, "w") as fp:
-            fp.write("\n".join(commands))
-        return script_path
-
-    env.Replace(
-        __jlink_cmd_script=_jlink_cmd_script,
-        UPLOADER="JLink.exe" if system() == "Windows" else "JLinkExe",
-        UPLOADERFLAGS=[
-            "-device", env.BoardConfig().get("debug", {}).get("jlink_device"),
-            "-speed", env.GetProjectOption("debug_speed", "4000"),
-            "-if", ("jtag" if upload_protocol == "jlink-jtag" else "swd"),
-            "-autoconnect", "1",
-            "-NoGui", "1"
-        ],
-        UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "${__jlink_cmd_script(__env__, SOURCE)}"'
-    )
-    upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
-
-elif upload_protocol == "sam-ba":
-    env.Replace(
-        UPLOADER="bossac",
-        UPLOADERFLAGS=[
-            "--port", '"$UPLOAD_PORT"',
-            "--write",
-            "--verify",
-            "--reset"
-        ],
-        UPLOADCMD="$UPLOADER $UPLOADERFLAGS $SOURCES"
-    )
-    if board.get("build.core") in ("adafruit", "seeed", "sparkfun") and board.get(
-            "build.mcu").startswith(("samd51", "same51")):
-        # special flags for the latest bossac tool
-        env.Append(
+
+    elif upload_protocol.startswith("jlink"):
+
+        def _jlink_cmd_script(env, source):
+            build_dir = env.subst("$BUILD_DIR")
+            if not isdir(build_dir):
+                makedirs(build_dir)
+            script_path = join(build_dir, "upload.jlink")
+            commands = [
+                "h",
+                "loadbin %s, %s" % (source, env.BoardConfig().get(
+                    "upload.offset_address", "0x0")),
+                "r",
+                "q"
+            ]
+            with open(script_path, "w") as fp:
+                fp.write("\n".join(commands))
+            return script_path
+
+        env.Replace(
+            __jlink_cmd_script=_jlink_cmd_script,
+            UPLOADER="JLink.exe" if system() == "Windows" else "JLinkExe",
             UPLOADERFLAGS=[
-            "-U", "--offset", board.get("upload.offset_address")])
+                "-device", env.BoardConfig().get("debug", {}).get("jlink_device"),
+                "-speed", debug_speed if debug_speed and not is_auto(
+                    debug_speed) else "4000",
+                "-if", ("jtag" if upload_protocol == "jlink-jtag" else "swd"),
+                "-autoconnect", "1",
+                "-NoGui", "1"
+            ],
+            UPLOADCMD='$UPLOADER $UPLOADERFLAGS -CommanderScript "${__jlink_cmd_script(__env__, SOURCE)}"'
+        )
+        upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
 
-    else:
-        env.Append(UPLOADERFLAGS=[
-            "--erase",
-            "-U", "true"
-            if env.BoardConfig().get("upload.native_usb", False) else "false"
-        ])
-    if "sam3x8e" in build_mcu:
-        env.Append(UPLOADERFLAGS=["--boot"])
-    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
-        env.Prepend(UPLOADERFLAGS=["--info", "--debug"])
-
-    upload_actions = [
-        env.VerboseAction(BeforeUpload, "Looking for upload port..."),
-        env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
-    ]
-
-elif upload_protocol == "stk500v2":
-    env.Replace(
-        UPLOADER="avrdude",
-        UPLOADERFLAGS=[
-            "-p", "atmega2560",  # Arduino M0/Tian upload hook
-            "-C", join(
-                platform.get_package_dir("tool-avrdude") or "",
-                "avrdude.conf"),
-            "-c", "$UPLOAD_PROTOCOL",
-            "-P", '"$UPLOAD_PORT"',
-            "-b", "$UPLOAD_SPEED",
-            "-u"
-        ],
-        UPLOADCMD="$UPLOADER $UPLOADERFLAGS -U flash:w:$SOURCES:i"
-    )
-    if int(ARGUMENTS.get("PIOVERBOSE", 0)):
-        env.Prepend(UPLOADERFLAGS=["-v"])
-    upload_actions = [
-        env.VerboseAction(BeforeUpload, "Looking for upload port..."),
-        env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
-    ]
-
-elif upload_protocol in debug_tools:
-    openocd_args = [
-        "-d%d" % (2 if int(ARGUMENTS.get("PIOVERBOSE", 0)) else 1)
-    ]
-    openocd_args.extend(
-        debug_tools.get(upload_protocol).get("server").get("arguments", []))
-    if env.GetProjectOption("debug_speed"):
-        openocd_args.extend(
-            ["-c", "adapter speed %s" % env.GetProjectOption("debug_speed")]
+    elif upload_protocol == "sam-ba":
+        env.Replace(
+            UPLOADER="bossac",
+            UPLOADERFLAGS=[
+                "--port", '"$UPLOAD_PORT"',
+                "--write",
+                "--verify",
+                "--reset"
+            ],
+            UPLOADCMD="$UPLOADER $UPLOADERFLAGS $SOURCES"
         )
-    openocd_args.extend([
-        "-c", "program {$SOURCE} %s verify reset; shutdown;" %
-        board.get("upload.offset_address", "")
-    ])
-    openocd_args = [
-        f.replace("$PACKAGE_DIR",
-                  platform.get_package_dir("tool-openocd") or "")
-        for f in openocd_args
-    ]
-    env.Replace(
-        UPLOADER="openocd",
-        UPLOADERFLAGS=openocd_args,
-        UPLOADCMD="$UPLOADER $UPLOADERFLAGS")
-    upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
-
-# custom upload tool
-elif upload_protocol == "custom":
-    upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+        if board.get("build.core") in ("adafruit", "seeed", "sparkfun") and board.get(
+                "build.mcu").startswith(("samd51", "same51")):
+            # special flags for the latest bossac tool
+            env.Append(
+                UPLOADERFLAGS=[
+                "-U", "--offset", board.get("upload.offset_address")])
 
-else:
-    sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
+        else:
+            env.Append(UPLOADERFLAGS=[
+                "--erase",
+                "-U", "true"
+                if env.BoardConfig().get("upload.native_usb", False) else "false"
+            ])
+        if "sam3x8e" in build_mcu:
+            env.Append(UPLOADERFLAGS=["--boot"])
+        if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+            env.Prepend(UPLOADERFLAGS=["--info", "--debug"])
+
+        upload_actions = [
+            env.VerboseAction(BeforeUpload, "Looking for upload port..."),
+            env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
+        ]
+
+        # only the latest bossac can write at an arbitrary offset without
+        # erasing the whole application area
+        if is_enabled(board.get("upload.delta", False)) and "--offset" in env[
+                "UPLOADERFLAGS"]:
+            upload_actions[-1] = env.VerboseAction(
+                UploadSamBaDelta, "Uploading $SOURCE")
+
+    elif upload_protocol == "stk500v2":
+        env.Replace(
+            UPLOADER="avrdude",
+            UPLOADERFLAGS=[
+                "-p", "atmega2560",  # Arduino M0/Tian upload hook
+                "-C", join(
+                    platform.get_package_dir("tool-avrdude") or "",
+                    "avrdude.conf"),
+                "-c", "$UPLOAD_PROTOCOL",
+                "-P", '"$UPLOAD_PORT"',
+                "-b", "$UPLOAD_SPEED",
+                "-u"
+            ],
+            UPLOADCMD="$UPLOADER $UPLOADERFLAGS -U flash:w:$SOURCES:i"
+        )
+        if int(ARGUMENTS.get("PIOVERBOSE", 0)):
+            env.Prepend(UPLOADERFLAGS=["-v"])
+        upload_actions = [
+            env.VerboseAction(BeforeUpload, "Looking for upload port..."),
+            env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")
+        ]
+
+    elif upload_protocol in debug_tools:
+        openocd_args = [
+            "-d%d" % (2 if int(ARGUMENTS.get("PIOVERBOSE", 0)) else 1)
+        ]
+        openocd_args.extend(
+            debug_tools.get(upload_protocol).get("server").get("arguments", []))
+        if debug_speed and not is_auto(debug_speed):
+            openocd_args.extend(["-c", "adapter speed %s" % debug_speed])
+        openocd_args = [
+            f.replace("$PACKAGE_DIR",
+                      platform.get_package_dir("tool-openocd") or "")
+            for f in openocd_args
+        ]
+        env.Replace(
+            OPENOCD_ARGS=openocd_args,
+            UPLOADER="openocd",
+            UPLOADERFLAGS=openocd_args + [
+                "-c", "program {$SOURCE} %s verify reset; shutdown;" %
+                board.get("upload.offset_address", "")
+            ],
+            UPLOADCMD="$UPLOADER $UPLOADERFLAGS")
+        upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+        if is_enabled(board.get("upload.openocd_server", False)):
+            env.Replace(OPENOCD_SERVER=True)
+            upload_actions = [
+                env.VerboseAction(UploadViaOpenOcdServer, "Uploading $SOURCE")
+            ]
+
+    elif upload_protocol == "uf2":
+        upload_actions = [env.VerboseAction(UploadUf2, "Uploading $SOURCE")]
+
+    # custom upload tool
+    elif upload_protocol == "custom":
+        upload_actions = [env.VerboseAction("$UPLOADCMD", "Uploading $SOURCE")]
+
+    else:
+        sys.stderr.write("Warning! Unknown upload protocol %s\n" % upload_protocol)
+
+    # compare the flash with the image before programming it
+    if is_enabled(board.get("upload.skip_identical", False)) and upload_actions:
+        if not get_dsu_family(build_mcu):
+            sys.stderr.write(
+                "Warning! %s has no DSU, `board_upload.skip_identical` "
+                "is ignored\n" % build_mcu)
+        elif upload_protocol == "sam-ba" or upload_protocol.startswith(
+                "blackmagic"):
+            upload_actions = [env.VerboseAction(upload_unless_identical(
+                upload_actions, prepare=1), "Uploading $SOURCE")]
+        elif upload_protocol in debug_tools or upload_protocol.startswith(
+                "jlink"):
+            upload_actions = [env.VerboseAction(upload_unless_identical(
+                upload_actions), "Uploading $SOURCE")]
+        else:
+            sys.stderr.write(
+                "Warning! `board_upload.skip_identical` is not supported by "
+                "the %s upload protocol\n" % upload_protocol)
+
+    # flash several boards connected at the same time
+    if board.get("upload.ports", "") and upload_protocol in ("sam-ba", "stk500v2"):
+        upload_actions = [
+            env.VerboseAction(UploadToPorts, "Uploading $SOURCE to multiple ports")
+        ]
+
+    # find and remember the fastest reliable SWD/JTAG clock
+    if is_auto(debug_speed) and upload_actions:
+        if upload_protocol.startswith("jlink") or "OPENOCD_ARGS" in env:
+            upload_actions = [env.VerboseAction(upload_with_adapter_speed(
+                upload_actions), "Uploading $SOURCE")]
+        else:
+            sys.stderr.write(
+                "Warning! `debug_speed = auto` is not supported by the %s "
+                "upload protocol\n" % upload_protocol)
+
+    # the probe may still be held by a persistent OpenOCD server
+    upload_actions = release_probe_for(
+        env, upload_actions, COMMAND_LINE_TARGETS)
 
 AlwaysBuild(env.Alias("upload", target_firm, upload_actions))
 
+
+#
+# Target: Tune the SWD/JTAG adapter speed again
+#
+
+env.AddPlatformTarget(
+    "tune_adapter_speed",
+    None,
+    env.VerboseAction(RetuneAdapterSpeed, "Tuning adapter speed..."),
+    "Tune Adapter Speed",
+    "Find the fastest reliable SWD/JTAG speed for `debug_speed = auto`",
+)
+
+#
+# Target: Capture and decode ITM/DWT trace over SWO
+#
+
+env.AddPlatformTarget(
+    "trace",
+    target_elf,
+    env.VerboseAction(CaptureTrace, "Capturing SWO trace..."),
+    "SWO Trace",
+    "Stream ITM stimulus ports, exception trace and a PC sample histogram",
+)
+
+#
+# Target: Capture serial data at full rate
+#
+
+env.AddPlatformTarget(
+    "capture",
+    None,
+    env.VerboseAction(CaptureSerialData, "Capturing serial data..."),
+    "Capture Serial Data",
+    "Stream the serial port to a binary file at full rate",
+)
+
 #
 # Information about obsolete method of specifying linker scripts
 #
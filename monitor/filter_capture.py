@@ -0,0 +1,78 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import codecs
+import importlib.util
+import os
+import sys
+
+from platformio.public import DeviceMonitorFilterBase
+
+HELPERS_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), "builder", "atmelsam")
+
+
+def _load_helper(name, filename):
+    # loaded by path, the monitor process keeps its own sys.path
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(HELPERS_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+helpers = _load_helper("atmelsam_helpers", "__init__.py")
+capture = _load_helper("atmelsam_capture", "capture.py")
+
+
+class Capture(DeviceMonitorFilterBase):
+    NAME = "capture"
+
+    def __call__(self):
+        section = "env:%s" % self.environment
+
+        def _option(name, default):
+            return self.config.get(section, "board_monitor.%s" % name, default)
+
+        self._encoding = self.options.get("encoding") or "UTF-8"
+        if codecs.lookup(self._encoding).name != "iso8859-1":
+            sys.stderr.write(
+                "Warning! Binary data may be altered by the %s decoder, set "
+                "`monitor_encoding = latin-1` for exact captures\n" %
+                self._encoding)
+        self._echo = helpers.is_enabled(_option("capture_echo", False))
+        self._path = capture.get_capture_path(
+            _option("capture_file", ""),
+            os.path.join(self.config.get("platformio", "build_dir"),
+                         self.environment))
+        self._writer = capture.CaptureWriter(
+            open(self._path, "wb"),  # pylint: disable=consider-using-with
+            buffer_size=capture.parse_size(
+                _option("capture_buffer", ""), capture.DEFAULT_BUFFER_SIZE),
+            timestamps=helpers.is_enabled(
+                _option("capture_timestamps", False)),
+        ).start()
+        atexit.register(self._close)
+        sys.stderr.write("--- Capturing to %s\n" % self._path)
+        return self
+
+    def _close(self):
+        self._writer.close()
+        self._writer.fp.close()
+        sys.stderr.write("--- Capture: %s\n" % self._writer.stats.format())
+
+    def rx(self, text):
+        self._writer.feed(text.encode(self._encoding, errors="replace"))
+        return text if self._echo else ""
@@ -12,22 +12,180 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
 import sys
 
-from platformio.public import PlatformBase
+from platformio.platform.board import PlatformBoardConfig
+from platformio.public import PlatformBase, list_serial_ports
 
 IS_WINDOWS = sys.platform.startswith("win")
+# bumped when the layout of "boards-index.json" changes
+BOARDS_INDEX_VERSION = 3
+
+
+def _load_json(path):
+    try:
+        with open(path, encoding="utf8") as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def _dump_json(path, data):
+    # write to a temporary file first so that concurrent readers never see
+    # a partially written cache
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w", encoding="utf8") as fp:
+        json.dump(data, fp, separators=(",", ":"), sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+_LOADED_JSON = {}
+
+
+def _load_json_cached(path):
+    # platform instances of the same process share read-only caches
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    state = (stat.st_mtime_ns, stat.st_size)
+    if path not in _LOADED_JSON or _LOADED_JSON[path][0] != state:
+        _LOADED_JSON[path] = (state, _load_json(path))
+    return _LOADED_JSON[path][1]
+
+
+def _parse_hwid(value):
+    if isinstance(value, str):
+        value = value.split(":")
+    return tuple(int(item, 16) for item in value)
+
+
+@functools.lru_cache(maxsize=None)
+def _import_file(name, path):
+    # helpers shipped with the platform are not importable packages, load
+    # each of them once per process
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _ReadOnlyDict(dict):
+    """Debug tool definition shared between boards"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Debug tool definitions are shared and read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # copies are regular dictionaries that may be changed
+        return (dict, (dict(self),))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_debug_tool(link, openocd_chipname, openocd_target, jlink_device, onboard):
+    # built read-only right away, argument lists are tuples
+    if link == "blackmagic":
+        return _ReadOnlyDict(
+            {
+                "hwids": (("0x1d50", "0x6018"),),
+                "require_debug_port": True,
+            }
+        )
+
+    if link == "jlink":
+        server = {
+            "package": "tool-jlink",
+            "arguments": (
+                "-singlerun",
+                "-if",
+                "SWD",
+                "-select",
+                "USB",
+                "-device",
+                jlink_device,
+                "-port",
+                "2331",
+            ),
+            "executable": "JLinkGDBServerCL.exe" if IS_WINDOWS else "JLinkGDBServer",
+        }
+        return _ReadOnlyDict({"server": _ReadOnlyDict(server), "onboard": onboard})
+
+    openocd_cmds = ["set CHIPNAME %s" % openocd_chipname]
+    if link == "stlink" and "at91sam3" in openocd_chipname:
+        openocd_cmds.append("set CPUTAPID 0x2ba01477")
+    server = {
+        "package": "tool-openocd",
+        "executable": "bin/openocd",
+        "arguments": (
+            "-s",
+            "$PACKAGE_DIR/openocd/scripts",
+            "-f",
+            "interface/%s.cfg" % ("cmsis-dap" if link == "atmel-ice" else link),
+            "-c",
+            "; ".join(openocd_cmds),
+            "-f",
+            "target/%s.cfg" % openocd_target,
+        ),
+    }
+    tool = {"server": _ReadOnlyDict(server), "onboard": onboard}
+    if link == "stlink":
+        tool["load_cmd"] = "preload"
+    return _ReadOnlyDict(tool)
+
+
+class _IndexedBoardConfig(PlatformBoardConfig):
+    """Board configuration created from a manifest of the board index"""
+
+    def __init__(self, manifest_path, manifest):
+        # pylint: disable=super-init-not-called
+        # the same state PlatformBoardConfig sets up after reading the file
+        self._id = os.path.basename(manifest_path)[:-5]
+        self.manifest_path = manifest_path
+        self._manifest = manifest
 
 
 class AtmelsamPlatform(PlatformBase):
+    # resolved by the last configure_default_packages call
+    packages_plan = None
+
     def configure_default_packages(self, variables, targets):
         if not variables.get("board"):
             return super().configure_default_packages(variables, targets)
+
         board = self.board_config(variables.get("board"))
+        plan = self._resolve_packages_plan(board, variables)
+        if plan["framework_package"]:
+            self.frameworks["arduino"]["package"] = plan["framework_package"]
+        for name, options in plan["packages"].items():
+            self.packages[name].update(options)
+        for name in plan["disabled"]:
+            del self.packages[name]
+        self.packages_plan = plan
+
+        # dry run, the plan is only printed and nothing is installed
+        if "packages_plan" in targets:
+            for options in self.packages.values():
+                options["optional"] = True
+        return super().configure_default_packages(variables, targets)
+
+    def _resolve_packages_plan(self, board, variables):
+        plan = {"framework_package": None, "packages": {}, "disabled": []}
+
+        def _update_package(name, **options):
+            plan["packages"].setdefault(name, {}).update(options)
+
         upload_protocol = variables.get(
             "upload_protocol", board.get("upload.protocol", "")
         )
-        disabled_pkgs = []
         upload_tool = "tool-openocd"
         if upload_protocol == "sam-ba":
             upload_tool = "tool-bossac"
@@ -35,17 +193,21 @@ class AtmelsamPlatform(PlatformBase):
             upload_tool = "tool-avrdude"
         elif upload_protocol == "jlink":
             upload_tool = "tool-jlink"
+        elif upload_protocol == "uf2":
+            # the image is copied to the bootloader drive
+            upload_tool = None
 
-        if upload_tool:
-            for name, opts in self.packages.items():
-                if "type" not in opts or opts["type"] != "uploader":
-                    continue
-                if name != upload_tool:
-                    disabled_pkgs.append(name)
+        for name, opts in self.packages.items():
+            if "type" not in opts or opts["type"] != "uploader":
+                continue
+            # OpenOCD should be available when debugging
+            if name == "tool-openocd" and variables.get("build_type", "") == "debug":
+                continue
+            if name != upload_tool:
+                plan["disabled"].append(name)
 
         build_core = variables.get(
-            "board_build.core",
-            self.board_config(variables.get("board")).get("build.core", "arduino"),
+            "board_build.core", board.get("build.core", "arduino")
         ).lower()
 
         if "arduino" in variables.get("pioframework", []):
@@ -56,43 +218,174 @@ class AtmelsamPlatform(PlatformBase):
             if build_core != "arduino":
                 framework_package += "-" + build_core
 
-            self.frameworks["arduino"]["package"] = framework_package
+            plan["framework_package"] = framework_package
             if not board.get("build.mcu", "").startswith("samd"):
-                self.packages["framework-arduino-sam"]["optional"] = True
+                _update_package("framework-arduino-sam", optional=True)
             if framework_package in self.packages:
-                self.packages[framework_package]["optional"] = False
-            self.packages["framework-cmsis"]["optional"] = False
-            self.packages["framework-cmsis-atmel"]["optional"] = False
+                _update_package(framework_package, optional=False)
+            _update_package("framework-cmsis", optional=False)
+            _update_package("framework-cmsis-atmel", optional=False)
             if build_core in ("tuino0", "reprap"):
-                self.packages["framework-cmsis-atmel"]["version"] = "~1.1.0"
+                _update_package("framework-cmsis-atmel", version="~1.1.0")
             if build_core == "adafruit":
-                self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.90301.0"
+                _update_package("toolchain-gccarmnoneeabi", version="~1.90301.0")
             if build_core in ("adafruit", "seeed"):
-                self.packages["framework-cmsis"]["version"] = "~2.50400.0"
+                _update_package("framework-cmsis", version="~2.50400.0")
 
         if (
             board.get("build.core", "") in ("adafruit", "seeed", "sparkfun")
             and "tool-bossac" in self.packages
             and board.get("build.mcu", "").startswith(("samd51", "same51"))
         ):
-            self.packages["tool-bossac"]["version"] = "~1.10900.0"
+            _update_package("tool-bossac", version="~1.10900.0")
         if "zephyr" in variables.get("pioframework", []):
-            for p in self.packages:
-                if p in ("tool-cmake", "tool-dtc", "tool-ninja"):
-                    self.packages[p]["optional"] = False
-            self.packages["toolchain-gccarmnoneeabi"]["version"] = "~1.80201.0"
+            for name in ("tool-cmake", "tool-dtc", "tool-ninja"):
+                if name in self.packages:
+                    _update_package(name, optional=False)
+            _update_package("toolchain-gccarmnoneeabi", version="~1.80201.0")
             if not IS_WINDOWS:
-                self.packages["tool-gperf"]["optional"] = False
+                _update_package("tool-gperf", optional=False)
 
-        for name in disabled_pkgs:
-            # OpenOCD should be available when debugging
-            if name == "tool-openocd" and variables.get("build_type", "") == "debug":
+        return plan
+
+    def get_cache_dir(self):
+        cache_dir = os.path.join(self.config.get("platformio", "cache_dir"), self.name)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return cache_dir
+
+    def _get_boards_dirs(self):
+        return [
+            d
+            for d in (
+                self.config.get("platformio", "boards_dir"),
+                os.path.join(self.config.get("platformio", "core_dir"), "boards"),
+                os.path.join(self.get_dir(), "boards"),
+            )
+            if d and os.path.isdir(d)
+        ]
+
+    def get_boards_index(self):
+        return self._load_boards_index()["boards"]
+
+    def _load_boards_index(self, shared=True):
+        # a shared index is parsed once per process and must not be changed,
+        # an unshared one is parsed again and its manifests may be handed out
+        boards_dirs = self._get_boards_dirs()
+        manifests = []
+        signature = hashlib.sha1(self.version.encode())
+        for boards_dir in boards_dirs:
+            for item in sorted(os.listdir(boards_dir)):
+                if not item.endswith(".json"):
+                    continue
+                path = os.path.join(boards_dir, item)
+                stat = os.stat(path)
+                signature.update(
+                    ("%s:%d:%d" % (path, stat.st_mtime_ns, stat.st_size)).encode()
+                )
+                manifests.append((item[:-5], path))
+
+        try:
+            index_path = os.path.join(self.get_cache_dir(), "boards-index.json")
+        except OSError:
+            index_path = None
+        index = None
+        if index_path:
+            index = (_load_json_cached if shared else _load_json)(index_path)
+        if (
+            index
+            and index.get("version") == BOARDS_INDEX_VERSION
+            and index.get("signature") == signature.hexdigest()
+        ):
+            return index
+
+        boards = {}
+        board_manifests = {}
+        for board_id, path in manifests:
+            # the first accepted manifest wins, the same as in "get_boards"
+            if board_id in boards:
                 continue
-            del self.packages[name]
-        return super().configure_default_packages(variables, targets)
+            manifest = _load_json(path)
+            if not manifest or manifest.get("platform", self.name) != self.name:
+                continue
+            if self.name not in manifest.get("platforms", [self.name]):
+                continue
+            build = manifest.get("build", {})
+            upload = manifest.get("upload", {})
+            boards[board_id] = {
+                "name": manifest.get("name", board_id),
+                "vendor": manifest.get("vendor", ""),
+                "mcu": build.get("mcu", "").lower(),
+                "cpu": build.get("cpu", ""),
+                "core": build.get("core", "").lower(),
+                "f_cpu": build.get("f_cpu", ""),
+                "hwids": build.get("hwids", []),
+                "frameworks": manifest.get("frameworks", []),
+                "protocol": upload.get("protocol", ""),
+                "protocols": upload.get("protocols", []),
+                "maximum_size": int(upload.get("maximum_size", 0)),
+                "maximum_ram_size": int(upload.get("maximum_ram_size", 0)),
+                "path": path,
+            }
+            board_manifests[board_id] = manifest
+        index = {
+            "version": BOARDS_INDEX_VERSION,
+            "signature": signature.hexdigest(),
+            "boards": boards,
+            "manifests": board_manifests,
+        }
+        if index_path:
+            try:
+                _dump_json(index_path, index)
+            except OSError:
+                # an unwritable cache only costs a rebuild on the next call
+                pass
+        return index
+
+    def find_boards(
+        self,
+        mcu=None,
+        core=None,
+        protocol=None,
+        framework=None,
+        hwid=None,
+        min_flash=None,
+        min_ram=None,
+    ):
+        if hwid:
+            hwid = _parse_hwid(hwid)
+        result = {}
+        for board_id, data in self.get_boards_index().items():
+            if mcu and not data["mcu"].startswith(mcu.lower()):
+                continue
+            if core and data["core"] != core.lower():
+                continue
+            if protocol and protocol not in data["protocols"] + [data["protocol"]]:
+                continue
+            if framework and framework not in data["frameworks"]:
+                continue
+            if hwid and hwid not in [_parse_hwid(item) for item in data["hwids"]]:
+                continue
+            if min_flash and data["maximum_size"] < int(min_flash):
+                continue
+            if min_ram and data["maximum_ram_size"] < int(min_ram):
+                continue
+            result[board_id] = data
+        return result
 
     def get_boards(self, id_=None):
-        result = super().get_boards(id_)
+        if id_:
+            # a single manifest is cheaper to read than the whole index
+            result = super().get_boards(id_)
+        else:
+            result = self._BOARDS_CACHE
+            index = self._load_boards_index(shared=False)
+            for board_id, data in index["boards"].items():
+                if board_id in result:
+                    continue
+                board = _IndexedBoardConfig(data["path"], index["manifests"][board_id])
+                board.manifest["platform"] = self.name
+                result[board_id] = board
         if not result:
             return result
         if id_:
@@ -113,77 +406,126 @@ class AtmelsamPlatform(PlatformBase):
         for link in tools:
             if link not in upload_protocols or link in debug["tools"]:
                 continue
-            if link == "blackmagic":
-                debug["tools"]["blackmagic"] = {
-                    "hwids": [["0x1d50", "0x6018"]],
-                    "require_debug_port": True,
-                }
-
-            elif link == "jlink":
+            if link == "jlink":
                 assert debug.get("jlink_device"), (
                     "Missed J-Link Device ID for %s" % board.id
                 )
-                debug["tools"][link] = {
-                    "server": {
-                        "package": "tool-jlink",
-                        "arguments": [
-                            "-singlerun",
-                            "-if",
-                            "SWD",
-                            "-select",
-                            "USB",
-                            "-device",
-                            debug.get("jlink_device"),
-                            "-port",
-                            "2331",
-                        ],
-                        "executable": (
-                            "JLinkGDBServerCL.exe"
-                            if IS_WINDOWS
-                            else "JLinkGDBServer"
-                        ),
-                    },
-                    "onboard": link in debug.get("onboard_tools", []),
-                }
-
-            else:
-                openocd_chipname = debug.get("openocd_chipname")
-                assert openocd_chipname
-                openocd_cmds = ["set CHIPNAME %s" % openocd_chipname]
-                if link == "stlink" and "at91sam3" in openocd_chipname:
-                    openocd_cmds.append("set CPUTAPID 0x2ba01477")
-                server_args = [
-                    "-s",
-                    "$PACKAGE_DIR/openocd/scripts",
-                    "-f",
-                    "interface/%s.cfg" % ("cmsis-dap" if link == "atmel-ice" else link),
-                    "-c",
-                    "; ".join(openocd_cmds),
-                    "-f",
-                    "target/%s.cfg" % debug.get("openocd_target"),
-                ]
-                debug["tools"][link] = {
-                    "server": {
-                        "package": "tool-openocd",
-                        "executable": "bin/openocd",
-                        "arguments": server_args,
-                    },
-                    "onboard": link in debug.get("onboard_tools", []),
-                }
-                if link == "stlink":
-                    debug["tools"][link]["load_cmd"] = "preload"
+            elif link != "blackmagic":
+                assert debug.get("openocd_chipname")
+            # boards with the same parameters share one definition
+            debug["tools"][link] = _get_debug_tool(
+                link,
+                debug.get("openocd_chipname"),
+                debug.get("openocd_target"),
+                debug.get("jlink_device"),
+                link in debug.get("onboard_tools", []),
+            )
 
         board.manifest["debug"] = debug
         return board
 
+    def restore_svd_file(self, board):
+        svd_path = board.get("debug.svd_path", "")
+        if not svd_path or os.path.isabs(svd_path):
+            return
+        delta_path = os.path.join(self.get_dir(), "misc", "svd", svd_path + ".delta")
+        if not os.path.isfile(delta_path):
+            return
+
+        # near-identical parts are stored as deltas against a family SVD,
+        # the restored file is kept in the cache to leave the platform intact
+        svd_dir = os.path.join(self.get_cache_dir(), "svd")
+        if not os.path.isdir(svd_dir):
+            os.makedirs(svd_dir)
+        svd_path = os.path.join(svd_dir, os.path.basename(svd_path))
+        # a platform update may change the delta
+        stale = not os.path.isfile(svd_path) or (
+            os.path.getmtime(svd_path) < os.path.getmtime(delta_path)
+        )
+        if stale:
+            _import_file(
+                "atmelsam_svd_delta",
+                os.path.join(self.get_dir(), "scripts", "svd_delta.py"),
+            ).apply_delta(delta_path, svd_path)
+        board.manifest["debug"]["svd_path"] = svd_path
+
+    def _get_adapter_speed(self, debug_config):
+        """Cached or freshly tuned speed for `debug_speed = auto`"""
+        adapterspeed = _import_file(
+            "atmelsam_adapterspeed",
+            os.path.join(self.get_dir(), "builder", "atmelsam", "adapterspeed.py"),
+        )
+
+        server = debug_config.server
+        arguments = [
+            arg.replace("$PACKAGE_DIR", server.get("cwd") or "")
+            for arg in server.get("arguments", [])
+        ]
+        protocol = debug_config.tool_name
+        cache = adapterspeed.SpeedCache(
+            os.path.join(self.get_cache_dir(), "adapter-speeds.json")
+        )
+        key = adapterspeed.get_cache_key(
+            protocol,
+            adapterspeed.find_probe_serial(protocol, arguments, list_serial_ports()),
+            debug_config.board_config.id,
+        )
+        speed = cache.get(key)
+        if speed:
+            return speed
+
+        def _run(cmd):
+            return subprocess.run(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False
+            ).stdout.decode(errors="replace")
+
+        executable = os.path.join(server.get("cwd") or "", server["executable"])
+        try:
+            if "jlink" in server["executable"].lower():
+                # J-Link Commander is installed next to the GDB server
+                command = [
+                    os.path.join(
+                        os.path.dirname(executable),
+                        "JLink.exe" if IS_WINDOWS else "JLinkExe",
+                    ),
+                    "-device",
+                    arguments[arguments.index("-device") + 1],
+                    "-if",
+                    arguments[arguments.index("-if") + 1],
+                    "-autoconnect",
+                    "1",
+                    "-NoGui",
+                    "1",
+                ]
+                speed = adapterspeed.tune_jlink(
+                    command, _run, os.path.join(self.get_cache_dir(), "autotune.jlink")
+                )
+            else:
+                speed = adapterspeed.tune_openocd([executable] + arguments, _run)
+        except (adapterspeed.AutotuneError, OSError, ValueError) as e:
+            sys.stderr.write(
+                "Warning! Could not tune the adapter speed (%s), "
+                "using the default one\n" % e
+            )
+            return None
+        cache.set(key, speed)
+        return speed
+
     def configure_debug_session(self, debug_config):
-        if debug_config.speed:
-            server_executable = (debug_config.server or {}).get("executable", "").lower()
+        self.restore_svd_file(debug_config.board_config)
+        speed = debug_config.speed
+        server_executable = (debug_config.server or {}).get("executable", "").lower()
+        if str(speed).strip().lower() == "auto":
+            speed = None
+            if "openocd" in server_executable or "jlink" in server_executable:
+                speed = self._get_adapter_speed(debug_config)
+            if not speed and "jlink" in server_executable:
+                speed = 4000
+        if speed:
+            speed = str(speed)
             if "openocd" in server_executable:
                 debug_config.server["arguments"].extend(
-                    ["-c", "adapter speed %s" % debug_config.speed]
+                    ["-c", "adapter speed %s" % speed]
                 )
             elif "jlink" in server_executable:
-                debug_config.server["arguments"].extend(
-                    ["-speed", debug_config.speed]
-                )
+                debug_config.server["arguments"].extend(["-speed", speed])
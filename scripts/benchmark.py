@@ -0,0 +1,574 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark the Python hot paths of the platform against every board
+
+PlatformIO Core and SCons are replaced by minimal stand-ins, so the numbers
+cover only the code of this repository: the platform class (packages plan,
+boards listing, debug tools and sessions) and the evaluation of
+"builder/main.py" with the framework scripts. Each benchmark runs over all
+boards; timings come from plain runs, allocations from one extra run under
+tracemalloc. The first round starts with empty platform caches. The caches,
+including the SVD files restored from deltas, live in a temporary workspace,
+the checkout itself is never written to.
+
+    python scripts/benchmark.py --json bench.json
+    python scripts/benchmark.py --baseline bench.json --threshold 20
+    python scripts/benchmark.py -k main_build -k main_upload --rounds 10
+"""
+
+import argparse
+import copy
+import functools
+import gc
+import importlib.util
+import json
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILDER_DIR = os.path.join(ROOT_DIR, "builder")
+
+#
+# PlatformIO Core stand-in
+#
+
+
+class BoardConfig(object):
+    def __init__(self, manifest_path):
+        self._id = os.path.basename(manifest_path)[:-5]
+        self.manifest_path = manifest_path
+        with open(manifest_path, encoding="utf8") as fp:
+            self._manifest = json.load(fp)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def manifest(self):
+        return self._manifest
+
+    def get(self, path, default=None):
+        value = self.manifest
+        for key in path.split("."):
+            if not isinstance(value, dict) or key not in value:
+                if default is None:
+                    raise KeyError("Invalid board option '%s'" % path)
+                return default
+            value = value[key]
+        return value
+
+    def __contains__(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+
+class ConfigStandIn(object):
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, section, option, default=None):
+        return self.values.get((section, option), default)
+
+
+class PlatformBase(object):
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        with open(manifest_path, encoding="utf8") as fp:
+            manifest = json.load(fp)
+        self.name = manifest["name"]
+        self.version = manifest["version"]
+        self.packages = copy.deepcopy(manifest["packages"])
+        self.frameworks = copy.deepcopy(manifest["frameworks"])
+        self.config = ConfigStandIn(WORKSPACE["config"])
+        self._BOARDS_CACHE = {}
+
+    def get_dir(self):
+        return os.path.dirname(self.manifest_path)
+
+    def get_package_dir(self, name):
+        return os.path.join(WORKSPACE["packages_dir"], name)
+
+    def get_package_version(self, name):  # pylint: disable=unused-argument
+        return "1.0.0"
+
+    def configure_default_packages(self, variables, targets):
+        # pylint: disable=unused-argument
+        for framework in variables.get("pioframework", []):
+            name = self.frameworks.get(framework, {}).get("package")
+            if name in self.packages:
+                self.packages[name]["optional"] = False
+        return True
+
+    def board_config(self, id_):
+        return self.get_boards(id_)
+
+    def get_boards(self, id_=None):
+        boards_dir = os.path.join(self.get_dir(), "boards")
+        if id_ is None:
+            for item in sorted(os.listdir(boards_dir)):
+                if item.endswith(".json") and item[:-5] not in self._BOARDS_CACHE:
+                    self._BOARDS_CACHE[item[:-5]] = BoardConfig(
+                        os.path.join(boards_dir, item))
+            return dict(self._BOARDS_CACHE)
+        if id_ not in self._BOARDS_CACHE:
+            self._BOARDS_CACHE[id_] = BoardConfig(
+                os.path.join(boards_dir, "%s.json" % id_))
+        return self._BOARDS_CACHE[id_]
+
+
+#
+# SCons stand-in
+#
+
+
+class Node(str):
+    def get_abspath(self):
+        return str(self)
+
+    def get_path(self):
+        return str(self)
+
+
+class Environment(dict):
+    """Accepts every call of the build scripts, builders and unknown methods
+    return a node named after the first argument"""
+
+    VARIABLE_RE = re.compile(r"\$\{?([A-Z_][A-Z0-9_]*)\}?")
+
+    def __init__(self, platform, options, **kwargs):
+        super().__init__(**kwargs)
+        self.__dict__.update(_methods={}, platform=platform, options=options)
+
+    def __getattr__(self, name):
+        if name in self._methods:
+            return functools.partial(self._methods[name], self)
+
+        def _call(*args, **kwargs):  # pylint: disable=unused-argument
+            return [Node(self.subst(args[0]) if args else name)]
+
+        return _call
+
+    def AddMethod(self, function, name=None):
+        self._methods[name or function.__name__] = function
+
+    def Clone(self, **kwargs):
+        env = Environment(self.platform, self.options, **copy.deepcopy(dict(self)))
+        env.__dict__["_methods"] = dict(self._methods)
+        env.update(kwargs)
+        return env
+
+    def Replace(self, **kwargs):
+        self.update(kwargs)
+
+    def _extend(self, kwargs, prepend=False, unique=False):
+        for key, value in kwargs.items():
+            if key == "BUILDERS":
+                self.setdefault(key, {}).update(value)
+                continue
+            current = self.get(key, [])
+            current = current if isinstance(current, list) else [current]
+            value = value if isinstance(value, list) else [value]
+            if unique:
+                value = [item for item in value if item not in current]
+            self[key] = value + current if prepend else current + value
+
+    def Append(self, **kwargs):
+        self._extend(kwargs)
+
+    def AppendUnique(self, **kwargs):
+        self._extend(kwargs, unique=True)
+
+    def Prepend(self, **kwargs):
+        self._extend(kwargs, prepend=True)
+
+    def PrependUnique(self, **kwargs):
+        self._extend(kwargs, prepend=True, unique=True)
+
+    def subst(self, value, **kwargs):  # pylint: disable=unused-argument
+        def _expand(match):
+            item = self.get(match.group(1), "")
+            if isinstance(item, (list, tuple)):
+                return " ".join(str(i) for i in item)
+            return str(item)
+
+        value = str(value)
+        for _ in range(5):
+            expanded = self.VARIABLE_RE.sub(_expand, value)
+            if expanded == value:
+                break
+            value = expanded
+        return value
+
+    def BoardConfig(self):
+        return self.platform.board_config(self["BOARD"])
+
+    def PioPlatform(self):
+        return self.platform
+
+    def GetProjectOption(self, name, default=None):
+        return self.options.get(name, default)
+
+    def GetProjectConfig(self):
+        return ConfigStandIn(dict(WORKSPACE["config"], **{
+            ("env:" + self["PIOENV"], k): v for k, v in self.options.items()}))
+
+    def GetBuildType(self):
+        return self.options.get("build_type", "release")
+
+    def VerboseAction(self, action, message):
+        return (action, message)
+
+    def Action(self, action, *args, **kwargs):  # pylint: disable=unused-argument
+        return action
+
+    def File(self, path):
+        return Node(self.subst(path))
+
+    def Dir(self, path):
+        return Node(self.subst(path))
+
+    def SConscript(self, path, exports=None):  # pylint: disable=unused-argument
+        path = self.subst(path)
+        if not os.path.isabs(path):
+            path = os.path.join(WORKSPACE["script_dirs"][-1], path)
+        WORKSPACE["script_dirs"].append(os.path.dirname(path))
+        sys.path.insert(0, os.path.dirname(path))
+        try:
+            with open(path, encoding="utf8") as fp:
+                code = compile(fp.read(), path, "exec")
+            exec(code, {"__file__": path, "__name__": "SConscript"})  # pylint: disable=exec-used
+        finally:
+            sys.path.remove(os.path.dirname(path))
+            WORKSPACE["script_dirs"].pop()
+
+    def BuildProgram(self):
+        for framework in self.get("PIOFRAMEWORK", []):
+            self.SConscript(os.path.join(
+                ROOT_DIR, self.platform.frameworks[framework]["script"]))
+        return Node(self.subst("$BUILD_DIR/${PROGNAME}.elf"))
+
+
+def _install_stand_ins():
+    public = types.ModuleType("platformio.public")
+    public.PlatformBase = PlatformBase
+    public.list_serial_ports = lambda *args, **kwargs: []
+    public.DeviceMonitorFilterBase = object
+    board = types.ModuleType("platformio.platform.board")
+    board.PlatformBoardConfig = BoardConfig
+    sys.modules["platformio"] = types.ModuleType("platformio")
+    sys.modules["platformio.public"] = public
+    sys.modules["platformio.platform"] = types.ModuleType("platformio.platform")
+    sys.modules["platformio.platform.board"] = board
+
+    script = types.ModuleType("SCons.Script")
+    script.ARGUMENTS = {}
+    script.COMMAND_LINE_TARGETS = []
+    script.AlwaysBuild = lambda *args: args
+    script.Builder = lambda **kwargs: kwargs
+    script.Default = lambda *args: None
+    script.DefaultEnvironment = lambda: WORKSPACE["env"]
+    script.Return = lambda *args: None
+    script.SConscript = lambda path, exports=None: WORKSPACE["env"].SConscript(
+        path, exports)
+
+    def _import(*names):
+        frame = sys._getframe(1)  # pylint: disable=protected-access
+        for name in names:
+            frame.f_globals[name] = WORKSPACE["env"]
+
+    script.Import = _import
+    sys.modules["SCons"] = types.ModuleType("SCons")
+    sys.modules["SCons.Script"] = script
+
+    try:
+        import serial  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        # the build scripts only import names from pyserial
+        module = types.ModuleType("serial")
+        module.Serial = object
+        module.SerialException = OSError
+        sys.modules["serial"] = module
+
+
+WORKSPACE = {}
+
+
+def _prepare_workspace(root):
+    with open(os.path.join(ROOT_DIR, "platform.json"), encoding="utf8") as fp:
+        packages = json.load(fp)["packages"]
+    packages_dir = os.path.join(root, "packages")
+    for name in list(packages) + [
+            "framework-arduino-sam/system", "framework-zephyr/scripts/platformio"]:
+        os.makedirs(os.path.join(packages_dir, name), exist_ok=True)
+    # only the platform side of Zephyr builds is measured
+    with open(os.path.join(packages_dir, "framework-zephyr", "scripts",
+                           "platformio", "platformio-build.py"), "w") as fp:
+        fp.write("")
+    WORKSPACE.update(
+        root=root,
+        packages_dir=packages_dir,
+        script_dirs=[BUILDER_DIR],
+        env=None,
+        config={
+            ("platformio", "boards_dir"): os.path.join(root, "boards"),
+            ("platformio", "core_dir"): os.path.join(root, "core"),
+            ("platformio", "cache_dir"): os.path.join(root, "cache"),
+        },
+    )
+
+
+def _reset_caches():
+    shutil.rmtree(os.path.join(WORKSPACE["root"], "cache"), ignore_errors=True)
+    shutil.rmtree(os.path.join(WORKSPACE["root"], "build"), ignore_errors=True)
+
+
+def _load_platform_class():
+    spec = importlib.util.spec_from_file_location(
+        "platformio.platform.atmelsam", os.path.join(ROOT_DIR, "platform.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.AtmelsamPlatform
+
+
+#
+# Benchmarks: one call per board and round
+#
+
+
+def _new_platform():
+    return PLATFORM_CLASS(os.path.join(ROOT_DIR, "platform.json"))
+
+
+def _get_framework(board):
+    frameworks = board.manifest.get("frameworks", [])
+    return ["arduino"] if "arduino" in frameworks else []
+
+
+def bench_configure_default_packages(board_id):
+    platform = _new_platform()
+    board = platform.board_config(board_id)
+    platform.configure_default_packages(
+        dict(board=board_id, pioframework=_get_framework(board)), [])
+
+
+def bench_get_boards_single(board_id):
+    _new_platform().get_boards(board_id)
+
+
+def bench_get_boards_all(board_id):  # pylint: disable=unused-argument
+    _new_platform().get_boards()
+
+
+def bench_add_default_debug_tools(board_id):
+    platform = _new_platform()
+    board = PlatformBase.get_boards(platform, board_id)
+    platform._add_default_debug_tools(board)  # pylint: disable=protected-access
+
+
+def bench_configure_debug_session(board_id):
+    platform = _new_platform()
+    board = platform.board_config(board_id)
+    for name, tool in board.get("debug.tools", {}).items():
+        # PlatformIO Core hands over a server config of its own
+        server = dict(tool.get("server") or {})
+        server["arguments"] = list(server.get("arguments", []))
+        platform.configure_debug_session(types.SimpleNamespace(
+            speed="4000", tool_name=name, board_config=board, server=server))
+
+
+def _evaluate_main(board_id, targets):
+    platform = _new_platform()
+    board = platform.board_config(board_id)
+    frameworks = _get_framework(board)
+    platform.configure_default_packages(
+        dict(board=board_id, pioframework=frameworks), targets)
+    build_dir = os.path.join(WORKSPACE["root"], "build", board_id)
+    env = Environment(
+        platform, {},
+        BOARD=board_id, PIOENV=board_id, PIOFRAMEWORK=frameworks,
+        PIOPLATFORM=platform.name, PROGNAME="firmware", PROGSUFFIX=".elf",
+        BUILD_DIR=build_dir, PROJECT_DIR=os.path.join(WORKSPACE["root"], "project"),
+        PROJECT_CORE_DIR=os.path.join(WORKSPACE["root"], "core"),
+        PROJECT_BUILD_DIR=os.path.join(WORKSPACE["root"], "build"),
+        UPLOAD_PROTOCOL=board.get("upload.protocol", ""),
+        BOARD_MCU=board.get("build.mcu", ""),
+        BOARD_F_CPU=board.get("build.f_cpu", ""),
+        ENV=dict(os.environ), PYTHONEXE=sys.executable)
+    WORKSPACE["env"] = env
+    sys.modules["SCons.Script"].COMMAND_LINE_TARGETS[:] = targets
+    env.SConscript(os.path.join(BUILDER_DIR, "main.py"))
+
+
+def bench_main_build(board_id):
+    _evaluate_main(board_id, [])
+
+
+def bench_main_upload(board_id):
+    _evaluate_main(board_id, ["upload"])
+
+
+BENCHMARKS = [
+    ("configure_default_packages", bench_configure_default_packages),
+    ("get_boards_single", bench_get_boards_single),
+    ("get_boards_all", bench_get_boards_all),
+    ("add_default_debug_tools", bench_add_default_debug_tools),
+    ("configure_debug_session", bench_configure_debug_session),
+    ("main_build", bench_main_build),
+    ("main_upload", bench_main_upload),
+]
+
+#
+# Runner
+#
+
+
+def run_benchmark(function, board_ids, rounds):
+    """Seconds per board of every round and the allocations of one more"""
+    _reset_caches()
+    timings = []
+    for _ in range(rounds):
+        gc.collect()
+        started = time.perf_counter()
+        for board_id in board_ids:
+            function(board_id)
+        timings.append((time.perf_counter() - started) / len(board_ids))
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for board_id in board_ids:
+        function(board_id)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated = sum(
+        stat.size_diff for stat in after.compare_to(before, "filename")
+        if stat.size_diff > 0)
+    return dict(
+        boards=len(board_ids),
+        rounds=rounds,
+        first_ms=round(timings[0] * 1000, 4),
+        min_ms=round(min(timings) * 1000, 4),
+        median_ms=round(statistics.median(timings) * 1000, 4),
+        max_ms=round(max(timings) * 1000, 4),
+        peak_kib=round(peak / 1024 / len(board_ids), 2),
+        retained_kib=round(allocated / 1024 / len(board_ids), 2),
+    )
+
+
+def compare(results, baseline, threshold):
+    """Lines for the table and whether any median got slower than allowed"""
+    lines = []
+    regressed = False
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            lines.append("%-28s %10.3f ms  (new)" % (name, result["median_ms"]))
+            continue
+        change = 100.0 * (
+            result["median_ms"] - previous["median_ms"]) / previous["median_ms"]
+        flag = ""
+        if change > threshold:
+            regressed = True
+            flag = "  REGRESSION"
+        lines.append("%-28s %10.3f ms  %+7.1f%% (was %.3f ms)%s" % (
+            name, result["median_ms"], change, previous["median_ms"], flag))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", dest="names", action="append",
+                        help="run only the named benchmark(s)")
+    parser.add_argument("-b", "--board", dest="boards", action="append",
+                        help="limit the run to the given board(s)")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--json", help="write the results to a JSON file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=20.0,
+                        help="allowed slowdown of a median in percent")
+    args = parser.parse_args()
+
+    board_ids = args.boards or sorted(
+        item[:-5] for item in os.listdir(os.path.join(ROOT_DIR, "boards"))
+        if item.endswith(".json"))
+    benchmarks = [
+        (name, function) for name, function in BENCHMARKS
+        if not args.names or name in args.names]
+
+    svd_dir = os.path.join(ROOT_DIR, "misc", "svd")
+    svd_files = sorted(os.listdir(svd_dir))
+    results = {}
+    root = tempfile.mkdtemp(prefix="atmelsam-bench-")
+    stdout = sys.stdout
+    try:
+        _prepare_workspace(root)
+        for name, function in benchmarks:
+            # warnings of the build scripts would flood the report
+            sys.stdout = open(os.devnull, "w")  # pylint: disable=consider-using-with
+            try:
+                results[name] = run_benchmark(function, board_ids, args.rounds)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            result = results[name]
+            print("%-28s median %9.3f ms  min %9.3f ms  first %9.3f ms  "
+                  "peak %8.1f KiB  retained %7.1f KiB  (per board)" % (
+                      name, result["median_ms"], result["min_ms"],
+                      result["first_ms"], result["peak_kib"],
+                      result["retained_kib"]))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if sorted(os.listdir(svd_dir)) != svd_files:
+        sys.stderr.write("Error: The benchmark has changed %s\n" % svd_dir)
+        return 1
+
+    report = dict(
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=sys.version.split()[0],
+        host=sys.platform,
+        boards=len(board_ids),
+        results=results,
+    )
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf8") as fp:
+            lines, regressed = compare(results, json.load(fp), args.threshold)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    _install_stand_ins()
+    PLATFORM_CLASS = _load_platform_class()
+    sys.exit(main())
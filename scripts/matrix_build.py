@@ -0,0 +1,161 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Build one project for a matrix of environments, sharing the framework core
+between environments with an identical compiler configuration
+
+Environments are grouped by the fingerprint of their compiler configuration
+(compiler, C/C++ flags, defines and include paths as reported by
+"pio project metadata"). Environments of a group compile identical framework
+translation units, so the first environment of every group is built first
+and fills the shared core archive cache ("board_build.core_cache"). The other
+environments then only compile the project sources and link.
+
+Only environments with an identical configuration share the core: boards
+that differ by variant or by a board "-D" flag form groups of their own,
+because the Arduino core includes "variant.h" and is compiled with the
+board defines. Single translation units are not deduplicated across groups,
+a compiler cache such as ccache is the tool for that.
+
+    python scripts/matrix_build.py -d path/to/project
+    python scripts/matrix_build.py -d path/to/project -e feather_m0 -e zero -j 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CORE_CACHE_OPTION = "board_build.core_cache=yes"
+
+
+def get_project_envs(project_dir):
+    output = subprocess.check_output(
+        ["pio", "project", "config", "-d", project_dir, "--json-output"])
+    return [
+        section[4:] for section, _ in json.loads(output)
+        if section.startswith("env:")
+    ]
+
+
+def get_metadata(project_dir, envs):
+    cmd = ["pio", "project", "metadata", "-d", project_dir, "--json-output"]
+    for name in envs:
+        cmd.extend(["-e", name])
+    return json.loads(subprocess.check_output(cmd))
+
+
+def get_fingerprint(metadata):
+    # the variant include path and the board defines stay in the key, the
+    # core objects of two variants differ even with the same toolchain flags
+    return hashlib.sha1(json.dumps([
+        metadata.get("cc_path"),
+        metadata.get("cxx_path"),
+        metadata.get("cc_flags"),
+        metadata.get("cxx_flags"),
+        metadata.get("defines"),
+        metadata.get("includes", {}).get("build"),
+    ]).encode("utf8")).hexdigest()
+
+
+def group_envs(envs, metadata):
+    groups = {}
+    for name in envs:
+        groups.setdefault(get_fingerprint(metadata[name]), []).append(name)
+    return list(groups.items())
+
+
+def build_env(project_dir, name, jobs, use_cache, verbose):
+    cmd = ["pio", "run", "-d", project_dir, "-e", name, "-j", str(jobs)]
+    if use_cache:
+        cmd.extend(["-O", CORE_CACHE_OPTION])
+    started = time.time()
+    result = subprocess.run(
+        cmd, stdout=None if verbose else subprocess.PIPE,
+        stderr=subprocess.STDOUT, check=False)
+    if result.returncode and not verbose:
+        sys.stdout.write(result.stdout.decode(errors="replace"))
+    return result.returncode, time.time() - started
+
+
+def build_matrix(project_dir, groups, workers, use_cache=True, verbose=False):
+    jobs = max(1, (os.cpu_count() or 1) // workers)
+    results = {}
+
+    def _build(name):
+        results[name] = build_env(project_dir, name, jobs, use_cache, verbose)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # the first environment of each group compiles the framework...
+        list(executor.map(_build, [envs[0] for _, envs in groups]))
+        # ...which the others take from the cache
+        list(executor.map(_build, [
+            name for _, envs in groups for name in envs[1:]
+            if results[envs[0]][0] == 0
+        ]))
+    return results
+
+
+def print_results(groups, results):
+    print("%-32s %-10s %-10s %8s" % ("Environment", "Group", "Status", "Time"))
+    for fingerprint, envs in groups:
+        for name in envs:
+            if name not in results:
+                status, duration = "SKIPPED", "-"
+            else:
+                status = "FAILED" if results[name][0] else "SUCCESS"
+                duration = "%.1fs" % results[name][1]
+            print("%-32s %-10s %-10s %8s" % (
+                name, fingerprint[:8], status, duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-d", "--project-dir", default=os.getcwd())
+    parser.add_argument("-e", "--environment", action="append", default=[])
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="number of environments built at the same time")
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="only group and schedule, do not enable the core archive cache")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    envs = args.environment or get_project_envs(args.project_dir)
+    if not envs:
+        sys.stderr.write("Error: No environments found\n")
+        return 1
+    groups = group_envs(envs, get_metadata(args.project_dir, envs))
+    print("%d environments, %d unique compiler configurations" % (
+        len(envs), len(groups)))
+
+    started = time.time()
+    results = build_matrix(
+        args.project_dir, groups, max(1, args.jobs),
+        use_cache=not args.no_cache, verbose=args.verbose)
+    print_results(groups, results)
+    print("Took %.1f seconds" % (time.time() - started))
+    return 0 if len(results) == len(envs) and not any(
+        status for status, _ in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Stand-in for an OpenOCD server with the TCL RPC port
+
+Understands the subset of OpenOCD options and TCL used by the persistent
+server upload mode ("-c tcl_port", "set", "catch", "program", "shutdown"),
+records every received command and never touches any hardware. It can be
+used in place of the OpenOCD executable:
+
+    python scripts/openocd_standin.py --record commands.log \\
+        -c "set pio_server_key test" -c "tcl_port 6666"
+    python scripts/openocd_standin.py --fail program -c "tcl_port 6666"
+"""
+
+import argparse
+import re
+import socket
+import sys
+
+TERMINATOR = b"\x1a"
+
+
+class StandIn(object):
+
+    def __init__(self, record_path=None, fail_pattern=None):
+        self.variables = {}
+        self.record_path = record_path
+        self.fail_pattern = fail_pattern
+        self.running = True
+
+    def record(self, command):
+        if not self.record_path:
+            print(command)
+            return
+        with open(self.record_path, "a", encoding="utf8") as fp:
+            fp.write(command + "\n")
+
+    def run_config(self, command):
+        for item in command.split(";"):
+            item = item.strip()
+            if item:
+                self.eval(item)
+
+    def eval(self, command):
+        """Returns (status, result) like Tcl_Eval"""
+        self.record(command)
+        match = re.match(r"^catch \{(.*)\} (\S+)$", command, re.S)
+        if match:
+            status, result = self.eval(match.group(1))
+            self.variables[match.group(2)] = result
+            return 0, str(status)
+        words = command.split(None, 2)
+        if not words:
+            return 0, ""
+        if words[0] == "set" and len(words) == 2:
+            if words[1] not in self.variables:
+                return 1, "can't read \"%s\": no such variable" % words[1]
+            return 0, self.variables[words[1]]
+        if words[0] == "set":
+            self.variables[words[1]] = words[2]
+            return 0, words[2]
+        if words[0] in ("tcl_port", "gdb_port", "telnet_port") and len(words) == 2:
+            self.variables[words[0]] = words[1]
+            return 0, ""
+        if words[0] == "shutdown":
+            self.running = False
+            return 0, "shutdown command invoked"
+        if self.fail_pattern and re.search(self.fail_pattern, command):
+            return 1, "** %s failed **" % words[0]
+        return 0, ""
+
+    def serve(self, port):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", port))
+        server.listen(1)
+        while self.running:
+            conn, _ = server.accept()
+            buffer = b""
+            with conn:
+                while self.running:
+                    chunk = conn.recv(4096)
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    while TERMINATOR in buffer:
+                        command, buffer = buffer.split(TERMINATOR, 1)
+                        _, result = self.eval(command.decode("utf8"))
+                        conn.sendall(result.encode("utf8") + TERMINATOR)
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--record", metavar="PATH")
+    parser.add_argument("--fail", metavar="REGEX")
+    parser.add_argument("-c", dest="commands", action="append", default=[])
+    # OpenOCD options that do not matter here ("-d2", "-s <dir>", "-f <cfg>")
+    args, _ = parser.parse_known_args()
+
+    standin = StandIn(args.record, args.fail)
+    for command in args.commands:
+        standin.run_config(command)
+    port = int(standin.variables.get("tcl_port", 6666))
+    standin.serve(port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Compare code size and build time of the "board_build.optimization" profiles
+
+Every environment of the example projects is cleaned and built from scratch
+once per profile with the same number of jobs, then flash/RAM usage of the
+firmware is read from the ELF file. Differences are relative to the default
+"size" profile. Runtime speed is out of scope, it needs the firmware to run
+on the target.
+
+    python scripts/optimization_report.py                  # Arduino examples
+    python scripts/optimization_report.py examples/arduino-blink -e zero
+    python scripts/optimization_report.py --json report.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "builder"))
+
+# pylint: disable=C0413
+from atmelsam.elf import ElfFile  # noqa: E402
+from atmelsam.optimization import DEFAULT_PROFILE, PROFILES  # noqa: E402
+from atmelsam.sizereport import get_section_usage  # noqa: E402
+
+
+def get_project_envs(project_dir):
+    output = subprocess.check_output(
+        ["pio", "project", "config", "-d", project_dir, "--json-output"])
+    return [
+        section[4:] for section, _ in json.loads(output)
+        if section.startswith("env:")
+    ]
+
+
+def get_usage(elf_path):
+    flash = ram = 0
+    with ElfFile(elf_path) as elf:
+        for section in elf.sections:
+            section_flash, section_ram = get_section_usage(section)
+            flash += section_flash
+            ram += section_ram
+    return flash, ram
+
+
+def build(project_dir, env_name, profile, jobs):
+    base_cmd = ["pio", "run", "-d", project_dir, "-e", env_name]
+    subprocess.run(
+        base_cmd + ["-t", "clean"], stdout=subprocess.DEVNULL, check=True)
+    started = time.time()
+    result = subprocess.run(
+        base_cmd + ["-j", str(jobs),
+                    "-O", "board_build.optimization=%s" % profile],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    duration = time.time() - started
+    if result.returncode:
+        return dict(error=result.stdout.decode(errors="replace")[-2000:])
+    flash, ram = get_usage(os.path.join(
+        project_dir, ".pio", "build", env_name, "firmware.elf"))
+    return dict(flash=flash, ram=ram, seconds=round(duration, 2))
+
+
+def print_report(rows):
+    print("%-28s %-28s %-10s %9s %8s %8s %9s" % (
+        "Project", "Environment", "Profile", "Flash", "", "RAM", "Time"))
+    baselines = dict(
+        ((row["project"], row["env"]), row) for row in rows
+        if row["profile"] == DEFAULT_PROFILE and "error" not in row)
+    for row in rows:
+        prefix = "%-28s %-28s %-10s" % (
+            os.path.basename(row["project"]), row["env"], row["profile"])
+        if "error" in row:
+            print("%s FAILED" % prefix)
+            continue
+        baseline = baselines.get((row["project"], row["env"]))
+        flash_delta = ""
+        if baseline and baseline is not row:
+            flash_delta = "%+.1f%%" % (
+                100.0 * (row["flash"] - baseline["flash"]) / baseline["flash"])
+        print("%s %9d %8s %8d %8.1fs" % (
+            prefix, row["flash"], flash_delta, row["ram"], row["seconds"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("projects", nargs="*")
+    parser.add_argument("-e", "--environment", action="append", default=[])
+    parser.add_argument(
+        "-p", "--profile", action="append", default=[],
+        choices=sorted(PROFILES))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--json", metavar="PATH")
+    args = parser.parse_args()
+
+    projects = args.projects or sorted(
+        glob.glob(os.path.join(ROOT_DIR, "examples", "arduino-*")))
+    profiles = args.profile or [DEFAULT_PROFILE] + sorted(
+        name for name in PROFILES if name != DEFAULT_PROFILE)
+
+    rows = []
+    for project_dir in projects:
+        project_dir = os.path.abspath(project_dir)
+        for env_name in args.environment or get_project_envs(project_dir):
+            for profile in profiles:
+                row = dict(project=project_dir, env=env_name, profile=profile)
+                row.update(build(project_dir, env_name, profile, args.jobs))
+                rows.append(row)
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as fp:
+            json.dump(dict(jobs=args.jobs, results=rows), fp, indent=2)
+    return 1 if any("error" in row for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
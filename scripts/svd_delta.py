@@ -0,0 +1,119 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Base + delta storage for near-identical SVD files
+
+Parts of the same family (e.g. ATSAMD21E18A/G18A/J18A) differ only in a few
+pin-count dependent peripherals and memory sizes. The largest part of a family
+is kept as a regular SVD file and the other parts are stored as line-based
+deltas against it ("<name>.svd.delta"). The platform reconstructs a part on
+demand when a board refers to it via "debug.svd_path".
+
+    python scripts/svd_delta.py pack misc/svd/ATSAMD21J18A.svd \\
+        misc/svd/ATSAMD21E18A.svd misc/svd/ATSAMD21G18A.svd
+    python scripts/svd_delta.py unpack misc/svd/ATSAMD21E18A.svd.delta
+"""
+
+import difflib
+import hashlib
+import json
+import os
+import sys
+
+DELTA_SUFFIX = ".delta"
+
+
+def _read_lines(path):
+    with open(path, "rb") as fp:
+        return [line.decode("utf8") for line in fp.read().splitlines(True)]
+
+
+def make_delta(base_path, target_path):
+    base = _read_lines(base_path)
+    target = _read_lines(target_path)
+    ops = [
+        [i1, i2, target[j1:j2]]
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, base, target, autojunk=False
+        ).get_opcodes()
+        if tag != "equal"
+    ]
+    return {
+        "base": os.path.basename(base_path),
+        "base_sha1": hashlib.sha1("".join(base).encode("utf8")).hexdigest(),
+        "sha1": hashlib.sha1("".join(target).encode("utf8")).hexdigest(),
+        "ops": ops,
+    }
+
+
+def apply_delta(delta_path, target_path=None):
+    target_path = target_path or delta_path[: -len(DELTA_SUFFIX)]
+    with open(delta_path, encoding="utf8") as fp:
+        delta = json.load(fp)
+    base = _read_lines(os.path.join(os.path.dirname(delta_path), delta["base"]))
+    if hashlib.sha1("".join(base).encode("utf8")).hexdigest() != delta["base_sha1"]:
+        raise ValueError("Base SVD file %s has been modified" % delta["base"])
+    result = []
+    position = 0
+    for start, end, lines in delta["ops"]:
+        result.extend(base[position:start])
+        result.extend(lines)
+        position = end
+    result.extend(base[position:])
+    data = "".join(result).encode("utf8")
+    if hashlib.sha1(data).hexdigest() != delta["sha1"]:
+        raise ValueError("Could not reconstruct %s" % target_path)
+    tmp_path = "%s.%d.tmp" % (target_path, os.getpid())
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp_path, target_path)
+    return target_path
+
+
+def main(argv):
+    if argv[:1] == ["pack"] and len(argv) > 2:
+        for target_path in argv[2:]:
+            delta = make_delta(argv[1], target_path)
+            with open(target_path + DELTA_SUFFIX, "w", encoding="utf8") as fp:
+                json.dump(delta, fp, indent=1)
+                fp.write("\n")
+            # make sure the part can be restored before removing it
+            with open(target_path, "rb") as fp:
+                original = fp.read()
+            restored_path = apply_delta(
+                target_path + DELTA_SUFFIX, target_path + ".restored"
+            )
+            with open(restored_path, "rb") as fp:
+                assert fp.read() == original
+            os.remove(restored_path)
+            os.remove(target_path)
+            print(
+                "Packed %s (%d changes against %s)"
+                % (target_path, len(delta["ops"]), delta["base"])
+            )
+        return 0
+    if argv[:1] == ["unpack"] and len(argv) > 1:
+        for delta_path in argv[1:]:
+            print("Restored %s" % apply_delta(delta_path))
+        return 0
+    sys.stderr.write(
+        "Usage: svd_delta.py pack <base svd> <target svd>...\n"
+        "       svd_delta.py unpack <delta>...\n"
+    )
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
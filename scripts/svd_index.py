@@ -0,0 +1,500 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pre-parsed index for the CMSIS-SVD files in "misc/svd"
+
+The index is a memory-mappable file with a header, a table of peripherals
+sorted by name, a table of the same peripherals sorted by base address and
+one zlib-compressed JSON blob per peripheral. "derivedFrom" is resolved,
+clusters and register arrays are flattened, so a peripheral is decoded with a
+single "zlib.decompress" when it is actually requested.
+
+    python scripts/svd_index.py build misc/svd
+    python scripts/svd_index.py show misc/svd/ATSAMD21G18A.svd SERCOM0
+    python scripts/svd_index.py show misc/svd/ATSAMD21G18A.svd 0x42000800
+"""
+
+import bisect
+import functools
+import json
+import mmap
+import os
+import struct
+import sys
+import xml.etree.ElementTree as ET
+import zlib
+
+from svd_delta import DELTA_SUFFIX, apply_delta
+
+INDEX_MAGIC = b"SVDI"
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".svdidx"
+
+# magic, version, peripherals count, device blob offset/length,
+# source size and mtime
+HEADER = struct.Struct("<4sHxxIIIQq")
+# name offset/length, base address, address span, blob offset/length
+RECORD = struct.Struct("<IIIIII")
+ADDRESS_ITEM = struct.Struct("<I")
+
+
+def _parse_int(value):
+    value = value.strip().lower()
+    if value.startswith("0x"):
+        return int(value, 16)
+    if value.startswith("#"):
+        # binary with optional "don't care" bits
+        return int(value[1:].replace("x", "0"), 2)
+    if value.startswith("0b"):
+        return int(value[2:].replace("x", "0"), 2)
+    return int(value, 10)
+
+
+def _find_text(element, tag, fallback=None):
+    value = element.findtext(tag)
+    if value is None and fallback is not None:
+        value = fallback.findtext(tag)
+    return " ".join(value.split()) if value is not None else None
+
+
+def _expand_dim(element, fallback, name, offset):
+    dim = _find_text(element, "dim", fallback)
+    if not dim:
+        return [(name, offset)]
+    increment = _parse_int(_find_text(element, "dimIncrement", fallback))
+    indexes = _find_text(element, "dimIndex", fallback)
+    if not indexes:
+        indexes = [str(i) for i in range(_parse_int(dim))]
+    elif "-" in indexes and "," not in indexes:
+        start, end = indexes.split("-")
+        indexes = [str(i) for i in range(int(start), int(end) + 1)]
+    else:
+        indexes = [item.strip() for item in indexes.split(",")]
+    return [
+        (name.replace("%s", index), offset + i * increment)
+        for i, index in enumerate(indexes)
+    ]
+
+
+def _parse_fields(element):
+    result = []
+    if element is None:
+        return result
+    for field in element.findall("field"):
+        if field.findtext("bitOffset") is not None:
+            lsb = _parse_int(field.findtext("bitOffset"))
+            width = _parse_int(field.findtext("bitWidth", "1"))
+        elif field.findtext("lsb") is not None:
+            lsb = _parse_int(field.findtext("lsb"))
+            width = _parse_int(field.findtext("msb")) - lsb + 1
+        else:
+            msb, lsb = field.findtext("bitRange").strip("[] ").split(":")
+            lsb = _parse_int(lsb)
+            width = _parse_int(msb) - lsb + 1
+        values = []
+        for enumerated in field.findall("enumeratedValues/enumeratedValue"):
+            if enumerated.findtext("value") is None:
+                continue
+            values.append(
+                {
+                    "name": _find_text(enumerated, "name"),
+                    "value": _parse_int(enumerated.findtext("value")),
+                    "description": _find_text(enumerated, "description") or "",
+                }
+            )
+        result.append(
+            {
+                "name": _find_text(field, "name"),
+                "lsb": lsb,
+                "width": width,
+                "access": _find_text(field, "access"),
+                "description": _find_text(field, "description") or "",
+                "values": values,
+            }
+        )
+    return result
+
+
+def _inherit_defaults(element, defaults):
+    result = dict(defaults)
+    for tag, name in (("size", "size"), ("access", "access"), ("resetValue", "reset")):
+        value = element.findtext(tag) if element is not None else None
+        if value is not None:
+            result[name] = _parse_int(value) if name != "access" else value.strip()
+    return result
+
+
+def _collect_registers(scope, defaults, base_offset, prefix, result):
+    named = {}
+    for child in scope:
+        if child.tag in ("register", "cluster"):
+            named[_find_text(child, "name")] = child
+    for child in scope:
+        if child.tag not in ("register", "cluster"):
+            continue
+        source = None
+        if child.get("derivedFrom"):
+            source = named.get(child.get("derivedFrom").split(".")[-1])
+        offset = base_offset + _parse_int(
+            _find_text(child, "addressOffset", source)
+        )
+        child_defaults = _inherit_defaults(
+            child, _inherit_defaults(source, defaults)
+        )
+        items = _expand_dim(child, source, _find_text(child, "name"), offset)
+        if child.tag == "cluster":
+            members = child
+            if source is not None and not child.findall("register"):
+                members = source
+            for name, item_offset in items:
+                _collect_registers(
+                    members, child_defaults, item_offset, prefix + name + ".", result
+                )
+            continue
+        fields = child.find("fields")
+        if fields is None and source is not None:
+            fields = source.find("fields")
+        fields = _parse_fields(fields)
+        description = _find_text(child, "description", source) or ""
+        for name, item_offset in items:
+            result.append(
+                {
+                    "name": prefix + name,
+                    "offset": item_offset,
+                    "size": child_defaults.get("size", 32),
+                    "access": child_defaults.get("access"),
+                    "reset": child_defaults.get("reset", 0),
+                    "description": description,
+                    "fields": fields,
+                }
+            )
+    return result
+
+
+def parse_svd(path):
+    root = ET.parse(path).getroot()
+    device_defaults = _inherit_defaults(root, {})
+    device = {
+        "name": _find_text(root, "name"),
+        "series": _find_text(root, "series"),
+        "description": _find_text(root, "description") or "",
+        "cpu": {
+            item.tag: (item.text or "").strip()
+            for item in (root.find("cpu") if root.find("cpu") is not None else [])
+        },
+    }
+
+    elements = {
+        _find_text(item, "name"): item for item in root.findall("peripherals/peripheral")
+    }
+    peripherals = []
+    for name, element in elements.items():
+        source = None
+        if element.get("derivedFrom"):
+            source = elements[element.get("derivedFrom")]
+        defaults = _inherit_defaults(
+            element, _inherit_defaults(source, device_defaults)
+        )
+        registers = element.find("registers")
+        if registers is None and source is not None:
+            registers = source.find("registers")
+        registers = sorted(
+            _collect_registers(
+                registers if registers is not None else [], defaults, 0, "", []
+            ),
+            key=lambda item: (item["offset"], item["name"]),
+        )
+        span = max(
+            [
+                _parse_int(block.findtext("offset")) + _parse_int(block.findtext("size"))
+                for block in (
+                    element.findall("addressBlock")
+                    or (source.findall("addressBlock") if source is not None else [])
+                )
+            ]
+            + [reg["offset"] + reg["size"] // 8 for reg in registers]
+            + [0]
+        )
+        peripherals.append(
+            {
+                "name": name,
+                "base": _parse_int(_find_text(element, "baseAddress", source)),
+                "span": span,
+                "group": _find_text(element, "groupName", source),
+                "description": _find_text(element, "description", source) or "",
+                "derived_from": element.get("derivedFrom"),
+                "interrupts": [
+                    {
+                        "name": _find_text(item, "name"),
+                        "value": _parse_int(item.findtext("value")),
+                    }
+                    for item in element.findall("interrupt")
+                ],
+                "registers": registers,
+            }
+        )
+    return device, peripherals
+
+
+def _encode(data):
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+
+
+def build_index(svd_path, index_path=None):
+    index_path = index_path or svd_path + INDEX_SUFFIX
+    device, peripherals = parse_svd(svd_path)
+    peripherals.sort(key=lambda item: item["name"])
+
+    names = b""
+    blobs = b""
+    records = []
+    for item in peripherals:
+        name = item["name"].encode()
+        blob = _encode(item)
+        records.append((len(names), len(name), item["base"], item["span"], len(blobs), len(blob)))
+        names += name
+        blobs += blob
+    by_address = sorted(range(len(records)), key=lambda i: (records[i][2], i))
+
+    device_blob = _encode(device)
+    names_offset = HEADER.size + RECORD.size * len(records) + ADDRESS_ITEM.size * len(records)
+    blobs_offset = names_offset + len(names) + len(device_blob)
+    stat = os.stat(svd_path)
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    with open(tmp_path, "wb") as fp:
+        fp.write(
+            HEADER.pack(
+                INDEX_MAGIC,
+                INDEX_VERSION,
+                len(records),
+                names_offset + len(names),
+                len(device_blob),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+        )
+        for name_off, name_len, base, span, blob_off, blob_len in records:
+            fp.write(
+                RECORD.pack(
+                    names_offset + name_off,
+                    name_len,
+                    base,
+                    span,
+                    blobs_offset + blob_off,
+                    blob_len,
+                )
+            )
+        for i in by_address:
+            fp.write(ADDRESS_ITEM.pack(i))
+        fp.write(names)
+        fp.write(device_blob)
+        fp.write(blobs)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class SvdIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self._count,
+            self._device_offset,
+            self._device_length,
+            self.source_size,
+            self.source_mtime_ns,
+        ) = HEADER.unpack_from(self._data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise ValueError("Unsupported SVD index %s" % path)
+        self._addresses_offset = HEADER.size + RECORD.size * self._count
+        self._max_span = max(
+            (self._record(i)[3] for i in range(self._count)), default=0
+        )
+        # cache decoded peripherals per index
+        self.get_peripheral = functools.lru_cache(maxsize=32)(self._get_peripheral)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._data.close()
+
+    def _record(self, position):
+        return RECORD.unpack_from(self._data, HEADER.size + RECORD.size * position)
+
+    def _name(self, position):
+        name_off, name_len = self._record(position)[:2]
+        return self._data[name_off : name_off + name_len].decode()
+
+    def _decode(self, offset, length):
+        return json.loads(zlib.decompress(self._data[offset : offset + length]))
+
+    @property
+    def device(self):
+        return self._decode(self._device_offset, self._device_length)
+
+    def get_peripheral_names(self):
+        return [self._name(i) for i in range(self._count)]
+
+    def _get_peripheral(self, name):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count or self._name(lo) != name:
+            return None
+        record = self._record(lo)
+        return self._decode(record[4], record[5])
+
+    def get_register(self, peripheral, register):
+        peripheral = self.get_peripheral(peripheral)
+        for item in (peripheral or {}).get("registers", []):
+            if item["name"] == register:
+                return item
+        return None
+
+    def _address_record(self, position):
+        (index,) = ADDRESS_ITEM.unpack_from(
+            self._data, self._addresses_offset + ADDRESS_ITEM.size * position
+        )
+        return self._record(index)
+
+    def find_by_address(self, address):
+        """Return the peripheral and the registers located at "address".
+
+        Peripherals may overlap or be derived from one another, every block
+        whose range contains the address is checked. The one with a register
+        at the address wins, otherwise the one with the highest base."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._address_record(mid)[2] <= address:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = (None, [])
+        for position in range(lo - 1, -1, -1):
+            name_off, name_len, base, span = self._address_record(position)[:4]
+            if base + self._max_span <= address:
+                break
+            if address >= base + span:
+                continue
+            peripheral = self.get_peripheral(
+                self._data[name_off : name_off + name_len].decode()
+            )
+            registers = peripheral["registers"]
+            offset = address - base
+            end = bisect.bisect_right([reg["offset"] for reg in registers], offset)
+            matches = [
+                reg
+                for reg in registers[:end]
+                if reg["offset"] <= offset < reg["offset"] + reg["size"] // 8
+            ]
+            if matches:
+                return peripheral, matches
+            if not result[0]:
+                result = (peripheral, [])
+        return result
+
+
+def open_index(svd_path, index_path=None):
+    """Open the index of "svd_path", building it when missing or outdated."""
+    index_path = index_path or svd_path + INDEX_SUFFIX
+    if not os.path.isfile(svd_path) and os.path.isfile(svd_path + DELTA_SUFFIX):
+        apply_delta(svd_path + DELTA_SUFFIX)
+    stat = os.stat(svd_path)
+    try:
+        index = SvdIndex(index_path)
+        if (index.source_size, index.source_mtime_ns) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return index
+        index.close()
+    except (IOError, ValueError):
+        pass
+    return SvdIndex(build_index(svd_path, index_path))
+
+
+def main(argv):
+    if len(argv) < 2 or argv[0] not in ("build", "show"):
+        sys.stderr.write(
+            "Usage: svd_index.py build <svd file or dir>...\n"
+            "       svd_index.py show <svd file> <PERIPHERAL[.REGISTER]|ADDRESS>\n"
+        )
+        return 1
+
+    if argv[0] == "build":
+        for path in argv[1:]:
+            paths = (
+                [
+                    os.path.join(path, name)
+                    for name in sorted(os.listdir(path))
+                    if name.endswith((".svd", ".svd" + DELTA_SUFFIX))
+                ]
+                if os.path.isdir(path)
+                else [path]
+            )
+            for svd_path in paths:
+                if svd_path.endswith(DELTA_SUFFIX):
+                    if os.path.isfile(svd_path[: -len(DELTA_SUFFIX)]):
+                        continue
+                    svd_path = apply_delta(svd_path)
+                print("Indexing %s" % svd_path)
+                build_index(svd_path)
+        return 0
+
+    with open_index(argv[1]) as index:
+        query = argv[2] if len(argv) > 2 else ""
+        if not query:
+            print("\n".join(index.get_peripheral_names()))
+        elif query.lower().startswith("0x"):
+            peripheral, registers = index.find_by_address(int(query, 16))
+            if peripheral:
+                for register in registers or [{"name": "", "offset": 0}]:
+                    print(
+                        "%s.%s (0x%08X)"
+                        % (
+                            peripheral["name"],
+                            register["name"],
+                            peripheral["base"] + register["offset"],
+                        )
+                    )
+        else:
+            name, _, register = query.partition(".")
+            result = (
+                index.get_register(name, register)
+                if register
+                else index.get_peripheral(name)
+            )
+            print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
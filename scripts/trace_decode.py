@@ -0,0 +1,67 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Decode a recorded ITM/DWT SWO trace
+
+Reads a raw trace file as written by the "trace" target and prints the
+stimulus port output, the exception counts and the hot functions:
+
+    python scripts/trace_decode.py .pio/build/<env>/trace.swo \\
+        --elf .pio/build/<env>/firmware.elf --profile hot.txt
+    python scripts/trace_decode.py trace.swo --events
+"""
+
+import argparse
+import sys
+from os.path import dirname, join, realpath
+
+ROOT_DIR = dirname(dirname(realpath(__file__)))
+sys.path.insert(0, join(ROOT_DIR, "builder"))
+
+from atmelsam.itm import (Symbolizer, TraceSummary,  # noqa: E402
+                          decode_events, iter_file, iter_packets,
+                          parse_ports, write_profile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="raw SWO trace file")
+    parser.add_argument("--elf", help="firmware to map PC samples to functions")
+    parser.add_argument("--ports", default="",
+                        help="stimulus ports to print, e.g. \"0,1\"")
+    parser.add_argument("--top", type=int, default=20,
+                        help="number of hot functions to print")
+    parser.add_argument("--profile",
+                        help="write the histogram for board_build.ramfuncs_profile")
+    parser.add_argument("--events", action="store_true",
+                        help="print every decoded event")
+    args = parser.parse_args()
+
+    summary = TraceSummary(
+        Symbolizer(args.elf) if args.elf else None, parse_ports(args.ports))
+    for event in decode_events(iter_packets(iter_file(args.trace))):
+        if args.events:
+            print(event)
+        for line in summary.feed(event):
+            print(line)
+    print("\n".join(summary.format(limit=args.top)))
+    if args.profile and summary.histogram.total:
+        write_profile(summary.histogram, args.profile)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
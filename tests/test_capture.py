@@ -0,0 +1,113 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import os
+import struct
+import threading
+
+import pytest
+
+from atmelsam import capture
+
+tty = pytest.importorskip("tty")  # pseudo terminals are POSIX only
+
+STREAM_SIZE = 4 * 1024 * 1024
+BLOCK_WORDS = 4096
+WORD = struct.Struct("<I")
+
+
+def _stream(fd, size):
+    """Write little-endian 32-bit counters, a stand-in for a native USB
+    board streaming at full speed"""
+    counter = 0
+    sent = 0
+    while sent < size:
+        block = struct.pack(
+            "<%dI" % BLOCK_WORDS, *range(counter, counter + BLOCK_WORDS))
+        counter += BLOCK_WORDS
+        view = memoryview(block)[:size - sent]
+        sent += len(view)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _count_gaps(data):
+    words = [item[0] for item in WORD.iter_unpack(data)]
+    assert words[0] == 0
+    return sum(1 for prev, cur in zip(words, words[1:]) if cur != prev + 1)
+
+
+@pytest.mark.parametrize("timestamps", [False, True])
+def test_capture_pty_stream(tmp_path, timestamps):
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = str(tmp_path / "capture.bin")
+    # the ring is smaller than the stream, so it wraps around
+    with open(path, "wb") as fp, os.fdopen(slave, "rb", buffering=0) as port:
+        writer = capture.CaptureWriter(
+            fp, buffer_size=1024 * 1024, batch_size=64 * 1024,
+            timestamps=timestamps).start()
+        producer = threading.Thread(target=_stream, args=(master, STREAM_SIZE))
+        producer.start()
+        scratch = bytearray(capture.READ_SIZE)
+        try:
+            while writer.stats.received < STREAM_SIZE:
+                writer.read_from(port, scratch)
+        finally:
+            producer.join()
+            os.close(master)
+            writer.close()
+
+    stats = writer.stats
+    assert stats.received == STREAM_SIZE
+    assert stats.written + stats.dropped == STREAM_SIZE
+    with open(path, "rb") as fp:
+        if timestamps:
+            chunks = list(capture.iter_chunks(fp))
+            assert len(chunks) == stats.chunks
+            assert [t for t, _ in chunks] == sorted(t for t, _ in chunks)
+            data = b"".join(payload for _, payload in chunks)
+        else:
+            data = fp.read()
+    assert len(data) == stats.written
+    # data is only lost as a whole read at a time, and counted as overrun
+    assert _count_gaps(data) <= stats.overruns
+
+
+def test_full_ring_drops_and_counts():
+    fp = io.BytesIO()
+    writer = capture.CaptureWriter(fp, buffer_size=16, timestamps=False)
+    writer.feed(b"0123456789")
+    writer.feed(b"abcdefghij")
+    writer.feed(b"klm")
+    writer.start()
+    writer.close()
+    assert fp.getvalue() == b"0123456789abcdef"
+    assert (writer.stats.received, writer.stats.dropped) == (23, 7)
+    assert (writer.stats.overruns, writer.stats.chunks) == (2, 2)
+    assert writer.stats.peak == 16
+
+
+def test_ring_buffer_wraps_chunks():
+    ring = capture.RingBuffer(8)
+    assert ring.write(b"abcdef", 1.0) == 0
+    ring.release(len(ring.peek(8)))
+    assert ring.write(b"ghijk", 2.0) == 0
+    assert ring.write(b"lmnop", 3.0) == 2
+    chunks = ring.peek(8)
+    assert [t for t, _ in chunks] == [2.0, 3.0]
+    assert [b"".join(views) for _, views in chunks] == [b"ghijk", b"lmn"]
+    assert not len(ring.reserve(8))
@@ -0,0 +1,146 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+
+import pytest
+
+from atmelsam import delta
+
+ROW = 256
+DEVICE = "adafruit_feather_m0_express:ABC123"
+BOARD = "adafruit_feather_m0_express"
+OFFSET = "0x2000"
+
+
+def _image(rows=64):
+    return bytes(bytearray(i * 7 & 0xFF for i in range(rows * ROW)))
+
+
+def _patch(image, *positions):
+    data = bytearray(image)
+    for position in positions:
+        data[position] ^= 0xFF
+    return bytes(data)
+
+
+@pytest.mark.parametrize("mcu, size", [
+    ("samd21g18a", 256),
+    ("saml21e18b", 256),
+    ("samd51j19a", 8192),
+    ("same54p20a", 8192),
+    ("at91sam3x8e", None),
+])
+def test_erase_size(mcu, size):
+    assert delta.get_erase_size(mcu) == size
+
+
+def test_identical_image_writes_nothing():
+    assert delta.plan_upload(_image(), _image(), ROW) == []
+
+
+def test_changed_rows_are_planned():
+    old = _image()
+    # a byte in row 1, two in row 10 and the rows 11-12 right after it
+    new = _patch(old, ROW + 5, 10 * ROW, 11 * ROW - 1, 11 * ROW, 12 * ROW + 9)
+    assert delta.plan_upload(old, new, ROW) == [
+        (ROW, 2 * ROW), (10 * ROW, 13 * ROW)]
+
+
+def test_grown_image_writes_the_tail():
+    old = _image(60)
+    new = _image(61) + b"\xAA" * 10
+    assert delta.plan_upload(old, new, ROW) == [(60 * ROW, len(new))]
+
+
+def test_closest_ranges_are_merged():
+    old = _image()
+    # ten separate rows, the pairs 2/4 and 40/42 are the closest
+    rows = [2, 4, 10, 17, 24, 31, 40, 42, 50, 60]
+    new = _patch(old, *[row * ROW for row in rows])
+    ranges = delta.plan_upload(old, new, ROW)
+    assert len(ranges) == delta.MAX_RANGES
+    assert (2 * ROW, 5 * ROW) in ranges
+    assert (40 * ROW, 43 * ROW) in ranges
+    assert sum(end - start for start, end in ranges) == 12 * ROW
+
+
+def test_full_flash_without_trusted_image():
+    assert delta.plan_upload(None, _image(), ROW) is None
+    # no known erase size for the MCU
+    assert delta.plan_upload(_image(), _image(), None) is None
+
+
+def test_full_flash_when_most_rows_changed():
+    old = _image()
+    new = _patch(old, *range(0, 40 * ROW, ROW))
+    assert delta.plan_upload(old, new, ROW) is None
+
+
+def test_record_round_trip(tmp_path):
+    record = delta.FlashRecord(str(tmp_path / "flash-images"), DEVICE)
+    assert record.load(BOARD, OFFSET) is None
+    record.save(BOARD, OFFSET, _image())
+    assert delta.FlashRecord(
+        str(tmp_path / "flash-images"), DEVICE).load(BOARD, OFFSET) == _image()
+    # another device has a record of its own
+    assert delta.FlashRecord(
+        str(tmp_path / "flash-images"), BOARD + ":XYZ").load(
+            BOARD, OFFSET) is None
+
+
+@pytest.mark.parametrize("board, offset", [
+    ("adafruit_metro_m0", OFFSET),
+    (BOARD, "0x4000"),
+])
+def test_record_of_other_board_or_offset(tmp_path, board, offset):
+    record = delta.FlashRecord(str(tmp_path), DEVICE)
+    record.save(BOARD, OFFSET, _image())
+    assert record.load(board, offset) is None
+
+
+def test_invalidated_record(tmp_path):
+    # an interrupted upload leaves no record behind
+    record = delta.FlashRecord(str(tmp_path), DEVICE)
+    record.save(BOARD, OFFSET, _image())
+    record.invalidate()
+    assert record.load(BOARD, OFFSET) is None
+    assert os.listdir(str(tmp_path)) == []
+    record.invalidate()
+
+
+def test_corrupted_record(tmp_path):
+    record = delta.FlashRecord(str(tmp_path), DEVICE)
+    record.save(BOARD, OFFSET, _image())
+    with open(record.image_path, "r+b") as fp:
+        fp.write(b"\xFF")
+    assert record.load(BOARD, OFFSET) is None
+
+    record.save(BOARD, OFFSET, _image())
+    with open(record.meta_path, "w", encoding="utf8") as fp:
+        fp.write("{")
+    assert record.load(BOARD, OFFSET) is None
+
+
+def test_record_of_other_device_in_meta(tmp_path):
+    record = delta.FlashRecord(str(tmp_path), DEVICE)
+    record.save(BOARD, OFFSET, _image())
+    with open(record.meta_path, encoding="utf8") as fp:
+        meta = json.load(fp)
+    meta["device"] = BOARD + ":XYZ"
+    with open(record.meta_path, "w", encoding="utf8") as fp:
+        json.dump(meta, fp)
+    assert record.load(BOARD, OFFSET) is None
@@ -0,0 +1,56 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from atmelsam import dsu
+
+RESET = b"WE000ED0C,05FA0004#"  # SCB->AIRCR = VECTKEY | SYSRESETREQ
+DEVICE_CRC = 0x12345678
+
+
+class FakeSamBa(object):
+    """SAM-BA monitor that reports a finished DSU run with DEVICE_CRC"""
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def read(self, size):
+        command = self.written[-1]
+        if command == b"o%08X,1#" % dsu.DSU_STATUSA:
+            return bytes([dsu.STATUSA_DONE])
+        if command == b"w%08X,4#" % dsu.DSU_DATA:
+            return (DEVICE_CRC ^ 0xFFFFFFFF).to_bytes(size, "little")
+        return b""
+
+
+def _monitor():
+    monitor = dsu.SamBaMonitor.__new__(dsu.SamBaMonitor)
+    monitor.serial = FakeSamBa()
+    return monitor
+
+
+def test_check_crc_match_resets_device():
+    monitor = _monitor()
+    assert monitor.check_crc("samd", 0x2000, 1024, DEVICE_CRC) == DEVICE_CRC
+    assert monitor.serial.written[-1] == RESET
+
+
+def test_check_crc_mismatch_keeps_bootloader():
+    # bossac uploads through the same bootloader right after the check
+    monitor = _monitor()
+    assert monitor.check_crc("samd", 0x2000, 1024, 0) == DEVICE_CRC
+    assert RESET not in monitor.serial.written
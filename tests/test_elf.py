@@ -0,0 +1,140 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The in-process ELF converter must match the GNU toolchain byte for byte:
+"objcopy -O binary", "objcopy -O ihex -R .eeprom" and "size -A -d"
+"""
+
+import glob
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from atmelsam import elf as elftools
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREFIX = "arm-none-eabi-"
+
+# a SAMD21 with the bootloader in the first 8 KiB, the initialized data is
+# copied from flash (LMA) to RAM (VMA) like the Arduino core does
+LINKER_SCRIPT = """
+MEMORY
+{
+  FLASH (rx) : ORIGIN = 0x00002000, LENGTH = 0x0003E000
+  RAM (rwx) : ORIGIN = 0x20000000, LENGTH = 0x00008000
+}
+ENTRY(Reset_Handler)
+SECTIONS
+{
+  .text : { KEEP(*(.vectors)) *(.text*) *(.rodata*) } > FLASH
+  .data : { *(.data*) } > RAM AT > FLASH
+  .bss (NOLOAD) : { *(.bss*) *(COMMON) } > RAM
+}
+"""
+
+SOURCE = """
+void Reset_Handler(void);
+__attribute__((section(".vectors"), used))
+const void *vectors[] = {(void *)0x20008000, (void *)Reset_Handler};
+/* spans a 64 KiB boundary, the HEX records must not cross it */
+const unsigned char table[70000] = {1, 2, 3, [69999] = 4};
+volatile unsigned int counter = 0x12345678;
+volatile unsigned char buffer[256];
+void Reset_Handler(void)
+{
+  for (;;) {
+    buffer[counter & 0xFF] = table[counter % sizeof(table)];
+    counter++;
+  }
+}
+"""
+
+
+def find_tool(name):
+    pattern = os.path.expanduser(
+        "~/.platformio/packages/toolchain-gccarmnoneeabi*/bin")
+    for tool_dir in glob.glob(pattern):
+        path = shutil.which(PREFIX + name, path=tool_dir)
+        if path:
+            return path
+    return shutil.which(PREFIX + name)
+
+
+TOOLS = dict((name, find_tool(name)) for name in ("gcc", "objcopy", "size"))
+
+pytestmark = pytest.mark.skipif(
+    not all(TOOLS.values()), reason="the ARM GNU toolchain is not installed")
+
+
+def _build_elf(tmp_dir):
+    with open(os.path.join(tmp_dir, "firmware.c"), "w") as fp:
+        fp.write(SOURCE)
+    with open(os.path.join(tmp_dir, "firmware.ld"), "w") as fp:
+        fp.write(LINKER_SCRIPT)
+    elf_path = os.path.join(tmp_dir, "firmware.elf")
+    subprocess.check_call([
+        TOOLS["gcc"], "-mcpu=cortex-m0plus", "-mthumb", "-Os", "-g",
+        "-nostdlib", "-T", os.path.join(tmp_dir, "firmware.ld"),
+        "-o", elf_path, os.path.join(tmp_dir, "firmware.c")])
+    return elf_path
+
+
+def _example_elfs():
+    """Firmwares of the examples, when they have been built with "pio run" """
+    return sorted(glob.glob(os.path.join(
+        ROOT_DIR, "examples", "*", ".pio", "build", "*", "firmware.elf")))
+
+
+@pytest.fixture(params=["built"] + _example_elfs())
+def elf_path(request, tmp_path):
+    if request.param == "built":
+        return _build_elf(str(tmp_path))
+    return request.param
+
+
+def _objcopy(elf_path, tmp_path, *args):
+    output_path = str(tmp_path / "objcopy.out")
+    subprocess.check_call(
+        [TOOLS["objcopy"]] + list(args) + [elf_path, output_path])
+    with open(output_path, "rb") as fp:
+        return fp.read()
+
+
+def test_binary_matches_objcopy(elf_path, tmp_path):
+    with elftools.ElfFile(elf_path) as elf:
+        assert elftools.to_binary(elf) == _objcopy(
+            elf_path, tmp_path, "-O", "binary")
+
+
+def test_ihex_matches_objcopy(elf_path, tmp_path):
+    with elftools.ElfFile(elf_path) as elf:
+        assert elftools.to_ihex(elf, exclude=[".eeprom"]).encode(
+            "ascii") == _objcopy(
+                elf_path, tmp_path, "-O", "ihex", "-R", ".eeprom")
+
+
+def test_section_sizes_match_size(elf_path):
+    output = subprocess.check_output(
+        [TOOLS["size"], "-A", "-d", elf_path]).decode()
+    expected = [
+        (line.split()[0], int(line.split()[1]), int(line.split()[2]))
+        for line in output.splitlines()[2:]
+        if line.strip() and not line.startswith("Total")
+    ]
+    with elftools.ElfFile(elf_path) as elf:
+        assert elftools.get_section_sizes(elf) == expected
@@ -0,0 +1,79 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from atmelsam import footprint
+
+LIBRARIES = {
+    "FrameworkArduino": dict(flash=30000, ram=2000),
+    "Wire": dict(flash=3000, ram=200),
+}
+
+
+def _placement(library, flash, ram):
+    return dict(output=".text", input=".text.x", address=0, size=flash + ram,
+                object="%s.o" % library, library=library, flash=flash, ram=ram)
+
+
+def _snapshot(db, env, flash, ram=0):
+    return db.add_snapshot(env, dict(
+        placements=[_placement("FrameworkArduino", flash, ram)], symbols=[]))
+
+
+def test_parse_budgets():
+    assert footprint.parse_budgets(
+        "flash: 200K, ram: 28000\nFrameworkArduino: 40k, growth: 512") == {
+            "flash": 200 * 1024, "ram": 28000,
+            "FrameworkArduino": 40 * 1024, "growth": 512}
+    assert footprint.parse_budgets({"Wire": "4K"}) == {"Wire": 4096}
+    with pytest.raises(ValueError):
+        footprint.parse_budgets("flash 200K")
+    with pytest.raises(ValueError):
+        footprint.parse_budgets("flash: lots")
+
+
+def test_check_budgets():
+    build = dict(flash=33000, ram=2200)
+    assert footprint.check_budgets(
+        dict(flash=40000, ram=4096, Wire=4096, growth=100), build, LIBRARIES,
+        dict(flash=32950, ram=2200)) == []
+    errors = footprint.check_budgets(
+        dict(flash=32000, Wire=3000, growth=10), build, LIBRARIES,
+        dict(flash=32950, ram=2200))
+    assert len(errors) == 3
+    assert "footprint_reset" in errors[1]
+
+
+def test_unknown_budgets():
+    budgets = dict(flash=1, growth=1, FrameworkArduino=1, wire=1, SPI=1)
+    assert footprint.get_unknown_budgets(budgets, LIBRARIES) == ["SPI", "wire"]
+
+
+def test_reset_accepts_the_next_build(tmp_path):
+    with footprint.FootprintDatabase(str(tmp_path / "footprint.db")) as db:
+        _snapshot(db, "feather", 30000)
+        _snapshot(db, "feather", 30100)
+        _snapshot(db, "metro", 30000)
+        assert db.reset("feather") == 2
+        assert db.get_builds("feather") == []
+        # the other envs and their placements are left alone
+        metro = db.get_builds("metro")
+        assert len(metro) == 1
+        assert db.get_libraries(metro[0]["id"]) == {
+            "FrameworkArduino": dict(flash=30000, ram=0)}
+        # without a previous build there is no growth to check
+        assert footprint.check_budgets(
+            dict(growth=0), dict(flash=40000, ram=0), {}, None) == []
@@ -0,0 +1,156 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from atmelsam import itm
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Raw SWO stream in the ITM/DWT packet format of ARMv7-M (appendix D4):
+#   04                   reserved header, the capture joined mid-stream
+#   00 00 00 00 00 80    synchronization
+#   03 "hell"            stimulus port 0, word
+#   30                   local timestamp, delta 3
+#   01 "o" 01 "\n"       stimulus port 0, bytes
+#   0e 0f 10             exception 15 (SysTick) entered
+#   17 00 02 00 00       PC sample 0x200
+#   c0 81 01             local timestamp with continuation, delta 129
+#   0e 0f 20             exception 15 exited
+#   15 00                PC sample while sleeping
+#   70                   overflow
+#   08                   extension, stimulus page 0
+#   0e 13 10             exception 19 (IRQ3) entered
+#   00 x 11, 80          periodic synchronization
+#   0a "ok" 09 "\n"      stimulus port 1, halfword and byte
+#   17 00 02 00 00       PC sample 0x200
+#   17 40 03 00 00       PC sample 0x340
+TRACE_PATH = os.path.join(ROOT_DIR, "tests", "data", "itm_trace.swo")
+
+EVENTS = [
+    itm.Stimulus(0, 4, int.from_bytes(b"hell", "little"), 0),
+    itm.Stimulus(0, 1, ord("o"), 3),
+    itm.Stimulus(0, 1, ord("\n"), 3),
+    itm.ExceptionTrace(15, "SysTick", "enter", 3),
+    itm.PcSample(0x200, 3),
+    itm.ExceptionTrace(15, "SysTick", "exit", 132),
+    itm.PcSample(None, 132),
+    itm.TraceOverflow(132),
+    itm.ExceptionTrace(19, "IRQ3", "enter", 132),
+    itm.Stimulus(1, 2, int.from_bytes(b"ok", "little"), 132),
+    itm.Stimulus(1, 1, ord("\n"), 132),
+    itm.PcSample(0x200, 132),
+    itm.PcSample(0x340, 132),
+]
+
+
+class FakeSymbolizer(object):
+    def lookup(self, pc):
+        return {0x200: "loop", 0x340: "SysTick_Handler"}.get(pc)
+
+
+def _read_trace():
+    with open(TRACE_PATH, "rb") as fp:
+        return fp.read()
+
+
+def test_decode_trace():
+    packets = list(itm.iter_packets(itm.iter_file(TRACE_PATH)))
+    kinds = [type(packet) for packet in packets]
+    assert packets[0] == itm.Garbage(0x04)
+    assert kinds[1] is itm.Sync
+    assert kinds.count(itm.Sync) == 2
+    assert kinds.count(itm.Overflow) == 1
+    assert itm.Extension(0, False) in packets
+    assert list(itm.decode_events(packets)) == EVENTS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7])
+def test_packets_span_chunks(chunk_size):
+    data = _read_trace()
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    assert list(itm.decode_events(itm.iter_packets(chunks))) == EVENTS
+
+
+def test_trace_summary():
+    summary = itm.TraceSummary(FakeSymbolizer())
+    lines = []
+    for event in EVENTS:
+        lines.extend(summary.feed(event))
+    assert lines == ["[0] hello", "[1] ok"]
+    assert summary.format() == [
+        "Hot functions (4 PC samples):",
+        "       2   50.0%  loop",
+        "       1   25.0%  <sleep>",
+        "       1   25.0%  SysTick_Handler",
+        "Exceptions entered: SysTick 1, IRQ3 1",
+        "ITM overflows: 1 (lower the sampling rate or raise the SWO frequency)",
+    ]
+
+
+def test_stimulus_port_filter():
+    streams = itm.StimulusStreams(ports=[1])
+    lines = []
+    for event in EVENTS:
+        if isinstance(event, itm.Stimulus):
+            lines.extend(streams.feed(event))
+    assert lines == [(1, "ok")]
+
+
+def test_trace_decode_script(tmp_path):
+    profile_path = str(tmp_path / "hot.txt")
+    output = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT_DIR, "scripts", "trace_decode.py"),
+            TRACE_PATH,
+            "--profile",
+            profile_path,
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode()
+    assert output.splitlines()[:3] == [
+        "[0] hello",
+        "[1] ok",
+        "Hot functions (4 PC samples):",
+    ]
+    # without an ELF file no sample belongs to a function
+    with open(profile_path, encoding="utf8") as fp:
+        assert fp.read().splitlines() == [
+            "# 4 PC samples",
+            "#        2   50.0%  0x00000200",
+            "#        1   25.0%  <sleep>",
+            "#        1   25.0%  0x00000340",
+        ]
+
+
+def test_write_profile(tmp_path):
+    histogram = itm.PcHistogram(FakeSymbolizer())
+    for event in EVENTS:
+        if isinstance(event, itm.PcSample):
+            histogram.feed(event)
+    itm.write_profile(histogram, str(tmp_path / "hot.txt"))
+    with open(str(tmp_path / "hot.txt"), encoding="utf8") as fp:
+        assert fp.read().splitlines() == [
+            "# 4 PC samples",
+            "       2   50.0%  loop",
+            "#        1   25.0%  <sleep>",
+            "       1   25.0%  SysTick_Handler",
+        ]
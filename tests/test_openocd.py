@@ -0,0 +1,143 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import importlib.util
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from atmelsam import openocd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_KEY = "0123456789abcdef"
+
+upload = pytest.importorskip("atmelsam.upload")
+
+
+def _load_standin():
+    spec = importlib.util.spec_from_file_location(
+        "openocd_standin",
+        os.path.join(ROOT_DIR, "scripts", "openocd_standin.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakePlatform(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_cache_dir(self):
+        return self.cache_dir
+
+
+class FakeEnv(dict):
+    """Just enough of an SCons environment for the probe release"""
+
+    def __init__(self, cache_dir, **kwargs):
+        dict.__init__(self, **kwargs)
+        self.platform = FakePlatform(cache_dir)
+
+    def subst(self, value):
+        return self.get(value.lstrip("$"), "")
+
+    def PioPlatform(self):
+        return self.platform
+
+    def VerboseAction(self, action, title):
+        return (action, title)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """A persistent OpenOCD server stand-in, registered in the state file
+    as if an earlier upload had started it"""
+    standin = _load_standin().StandIn(str(tmp_path / "commands.log"))
+    standin.run_config("set %s %s" % (openocd.KEY_VARIABLE, SERVER_KEY))
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    thread = threading.Thread(target=standin.serve, args=(port,), daemon=True)
+    thread.start()
+    # wait until it listens, the stand-in binds the port in its thread
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    with open(str(tmp_path / "openocd-servers.json"), "w") as fp:
+        json.dump({SERVER_KEY: dict(port=port, pid=0, command=[], time=0)}, fp)
+    yield standin
+    if standin.running:
+        openocd.OpenOcdServers(str(tmp_path / "openocd-servers.json")).stop()
+    thread.join(5)
+
+
+def _servers(tmp_path):
+    return openocd.OpenOcdServers(str(tmp_path / "openocd-servers.json"))
+
+
+def _run_actions(actions, env):
+    for action, _ in actions:
+        if callable(action):
+            action(None, None, env)
+
+
+@pytest.mark.parametrize("protocol, options", [
+    ("jlink", {}),
+    ("atmel-ice", {"OPENOCD_ARGS": ["-f", "interface/cmsis-dap.cfg"]}),
+])
+def test_release_before_one_shot_upload(tmp_path, server, protocol, options):
+    env = FakeEnv(str(tmp_path), UPLOAD_PROTOCOL=protocol, **options)
+    actions = upload.release_probe_for(
+        env, [("$UPLOADCMD", "Uploading $SOURCE")], ["upload"])
+    assert actions[0] == (upload.ReleaseProbe, "Releasing the probe...")
+    # nothing is stopped before the upload runs
+    assert server.running
+    _run_actions(actions, env)
+    assert not server.running
+    assert _servers(tmp_path).items() == []
+
+
+def test_server_upload_keeps_server(tmp_path, server):
+    env = FakeEnv(
+        str(tmp_path), UPLOAD_PROTOCOL="atmel-ice", OPENOCD_SERVER=True,
+        OPENOCD_ARGS=["-f", "interface/cmsis-dap.cfg"])
+    actions = [(upload.UploadViaOpenOcdServer, "Uploading $SOURCE")]
+    assert upload.release_probe_for(env, actions, ["upload"]) == actions
+    assert server.running
+
+
+def test_serial_upload_keeps_server(tmp_path, server):
+    env = FakeEnv(str(tmp_path), UPLOAD_PROTOCOL="sam-ba")
+    actions = [("$UPLOADCMD", "Uploading $SOURCE")]
+    assert upload.release_probe_for(env, actions, ["upload"]) == actions
+    assert server.running
+
+
+def test_release_for_debug_session(tmp_path, server):
+    env = FakeEnv(
+        str(tmp_path), UPLOAD_PROTOCOL="atmel-ice", OPENOCD_SERVER=True,
+        OPENOCD_ARGS=["-f", "interface/cmsis-dap.cfg"])
+    # released while the build scripts are read, before any action runs
+    upload.release_probe_for(env, [], ["__debug"])
+    assert not server.running
+    assert _servers(tmp_path).items() == []
@@ -0,0 +1,156 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import sys
+import threading
+
+import pytest
+
+from atmelsam import portwatch
+
+BOOTLOADER = "USB VID:PID=239A:000B SER=ABC LOCATION=1-1:1.0"
+SKETCH = "USB VID:PID=239A:800B SER=ABC LOCATION=1-1:1.0"
+HWIDS = [["0x239A", "0x800B"], ["0x239A", "0x000B"]]
+
+linux_only = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only")
+
+
+def _serve(monkeypatch, passes):
+    passes = iter(passes)
+    last = []
+
+    def _list_serial_ports():
+        last[:] = next(passes, last)
+        return [dict(port=port, hwid=hwid) for port, hwid in last]
+
+    monkeypatch.setattr(portwatch, "list_serial_ports", _list_serial_ports)
+
+
+def test_poll_ports_same_name_reenumeration(monkeypatch):
+    # the sketch port goes away after the 1200bps touch and the bootloader
+    # comes back under the same name
+    _serve(
+        monkeypatch,
+        [
+            [("/dev/ttyACM0", SKETCH)],
+            [],
+            [("/dev/ttyACM0", BOOTLOADER)],
+        ],
+    )
+    assert portwatch.wait_for_new_port(
+        ["/dev/ttyACM0"],
+        [["0x239A", "0x000B"]],
+        timeout=2,
+        interval=0,
+        dev_dir="/nonexistent",
+    ) == ("/dev/ttyACM0", True)
+
+
+def test_poll_ports_unchanged_port_is_not_new(monkeypatch):
+    _serve(monkeypatch, [[("/dev/ttyACM0", SKETCH)]])
+    assert portwatch.wait_for_new_port(
+        ["/dev/ttyACM0"],
+        [["0x239A", "0x000B"]],
+        timeout=0.1,
+        interval=0,
+        dev_dir="/nonexistent",
+    ) == (None, False)
+
+
+class FakeUsbTree(object):
+    """/dev and /sys of USB serial devices, nodes are real ptys"""
+
+    def __init__(self, root):
+        self.dev_dir = str(root / "dev")
+        self.sysfs_root = str(root / "sys")
+        os.makedirs(self.dev_dir)
+        os.makedirs(os.path.join(self.sysfs_root, "class", "tty"))
+        self._ptys = []
+
+    def plug(self, name, pid, location="1-1"):
+        device_dir = os.path.join(self.sysfs_root, "devices", location)
+        interface_dir = os.path.join(device_dir, location + ":1.0")
+        os.makedirs(interface_dir, exist_ok=True)
+        for key, value in (("idVendor", "239a"), ("idProduct", pid)):
+            with open(os.path.join(device_dir, key), "w") as fp:
+                fp.write(value + "\n")
+        # sysfs is populated before udev creates the node
+        tty_dir = os.path.join(self.sysfs_root, "class", "tty", name)
+        os.makedirs(tty_dir, exist_ok=True)
+        if not os.path.islink(os.path.join(tty_dir, "device")):
+            os.symlink(interface_dir, os.path.join(tty_dir, "device"))
+        master, slave = os.openpty()
+        self._ptys.extend([master, slave])
+        os.symlink(os.ttyname(slave), os.path.join(self.dev_dir, name))
+        return os.path.join(self.dev_dir, name)
+
+    def unplug(self, name):
+        os.remove(os.path.join(self.dev_dir, name))
+
+    def close(self):
+        for fd in self._ptys:
+            os.close(fd)
+
+
+@pytest.fixture
+def usb_tree(tmp_path):
+    tree = FakeUsbTree(tmp_path)
+    yield tree
+    tree.close()
+
+
+def _watcher(tree, before):
+    return portwatch.PortWatcher(
+        before, HWIDS, dev_dir=tree.dev_dir, sysfs_root=tree.sysfs_root)
+
+
+@linux_only
+def test_watch_ignores_attribute_change_of_sketch_port(usb_tree):
+    sketch_port = usb_tree.plug("ttyACM0", "800b")
+    with _watcher(usb_tree, [sketch_port]) as watcher:
+        # e.g. the touch or udev updating the old node
+        os.utime(sketch_port, follow_symlinks=False)
+        assert watcher.wait(timeout=0.3) == (None, False)
+
+
+@linux_only
+def test_watch_catches_reenumeration_during_touch(usb_tree):
+    sketch_port = usb_tree.plug("ttyACM0", "800b")
+    with _watcher(usb_tree, [sketch_port]) as watcher:
+        # the bootloader is back under the same name before "wait" is called
+        usb_tree.unplug("ttyACM0")
+        usb_tree.plug("ttyACM0", "000b")
+        assert watcher.wait(timeout=2) == (sketch_port, True)
+
+
+@linux_only
+def test_watch_prefers_bootloader_over_other_new_port(usb_tree):
+    sketch_port = usb_tree.plug("ttyACM0", "800b")
+    with _watcher(usb_tree, [sketch_port]) as watcher:
+
+        def _enumerate():
+            usb_tree.plug("ttyACM1", "800b", location="1-2")
+            usb_tree.unplug("ttyACM0")
+            usb_tree.plug("ttyACM2", "000b")
+
+        timer = threading.Timer(0.05, _enumerate)
+        timer.start()
+        try:
+            assert watcher.wait(timeout=2) == (
+                os.path.join(usb_tree.dev_dir, "ttyACM2"), True)
+        finally:
+            timer.join()
@@ -0,0 +1,145 @@
+# Copyright 2014-present PlatformIO <contact@platformio.org>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import struct
+
+import pytest
+
+from atmelsam import uf2
+
+SAMD21_FAMILY_ID = 0x68ED2B88
+
+
+class FakeNode(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_abspath(self):
+        return self.path
+
+
+class FakeBoard(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+
+class FakeEnv(dict):
+    """Just enough of an SCons environment for the UF2 upload action"""
+
+    def __init__(self, upload_port, touch=True):
+        dict.__init__(self, UPLOAD_PORT=upload_port)
+        self.board = FakeBoard({"upload.use_1200bps_touch": touch})
+
+    def subst(self, value):
+        return self.get(value.lstrip("$"), "")
+
+    def BoardConfig(self):
+        return self.board
+
+    def AutodetectUploadPort(self):
+        pass
+
+
+def _make_drive(path, board_id="SAMD21G18A-Feather-v0"):
+    path.mkdir()
+    (path / uf2.UF2_INFO_FILE).write_text(
+        "UF2 Bootloader v3.14.0\nModel: Feather M0 Express\n"
+        "Board-ID: %s\n" % board_id)
+    return str(path)
+
+
+@pytest.fixture
+def firmware(tmp_path):
+    path = tmp_path / "firmware.uf2"
+    path.write_bytes(uf2.convert_to_uf2(b"\xA5" * 300, 0x2000, SAMD21_FAMILY_ID))
+    return path
+
+
+def test_convert_to_uf2():
+    image = uf2.convert_to_uf2(bytes(range(256)) * 2 + b"\x01", 0x2000,
+                               SAMD21_FAMILY_ID)
+    assert len(image) == 3 * 512
+    for block_no in range(3):
+        block = image[block_no * 512:(block_no + 1) * 512]
+        fields = struct.unpack("<IIIIIIII", block[:32])
+        assert fields == (
+            uf2.UF2_MAGIC_START0, uf2.UF2_MAGIC_START1, uf2.UF2_FLAG_FAMILY_ID,
+            0x2000 + block_no * 256, 256, block_no, 3, SAMD21_FAMILY_ID)
+        assert struct.unpack("<I", block[-4:])[0] == uf2.UF2_MAGIC_END
+    # the last block is padded with zeros
+    assert image[2 * 512 + 32:2 * 512 + 34] == b"\x01\x00"
+
+
+def test_find_drives(tmp_path):
+    first = _make_drive(tmp_path / "FEATHERBOOT")
+    second = _make_drive(tmp_path / "METROM4BOOT", "SAMD51J19A-Metro-v0")
+    (tmp_path / "USBSTICK").mkdir()
+    assert uf2.find_uf2_drives(str(tmp_path / "*")) == [first, second]
+    assert uf2.find_uf2_drives(str(tmp_path / "FEATHER*")) == [first]
+    assert uf2.find_uf2_drives(str(tmp_path / "USBSTICK")) == []
+    assert uf2.read_uf2_info(second)["Board-ID"] == "SAMD51J19A-Metro-v0"
+
+
+def test_copy_to_drive(tmp_path, firmware):
+    drive = _make_drive(tmp_path / "FEATHERBOOT")
+    target = uf2.copy_to_drive(str(firmware), drive)
+    with open(target, "rb") as fp:
+        assert fp.read() == firmware.read_bytes()
+
+
+def test_upload_to_drive_glob(tmp_path, firmware):
+    upload = pytest.importorskip("atmelsam.upload")
+    drives = [_make_drive(tmp_path / name) for name in ("BOOT1", "BOOT2")]
+    env = FakeEnv(str(tmp_path / "BOOT*"))
+    assert upload.UploadUf2(None, [FakeNode(str(firmware))], env) == 0
+    for drive in drives:
+        assert (tmp_path / drive / "NEW.UF2").read_bytes() == \
+            firmware.read_bytes()
+
+
+def test_upload_through_serial_port(tmp_path, firmware, monkeypatch):
+    upload = pytest.importorskip("atmelsam.upload")
+    # another board already waits in its bootloader, it must be left alone
+    _make_drive(tmp_path / "OTHERBOOT")
+    touched = []
+
+    def _touch_port(port, baudrate):
+        touched.append((port, baudrate))
+        _make_drive(tmp_path / "FEATHERBOOT")
+
+    def _wait_for_uf2_drive(before):
+        return [d for d in uf2.find_uf2_drives(str(tmp_path / "*"))
+                if d not in before][0]
+
+    monkeypatch.setattr(upload, "find_uf2_drives", lambda pattern=None: (
+        uf2.find_uf2_drives(pattern or str(tmp_path / "*"))))
+    monkeypatch.setattr(upload, "touch_port", _touch_port)
+    monkeypatch.setattr(upload, "wait_for_uf2_drive", _wait_for_uf2_drive)
+
+    env = FakeEnv("/dev/ttyACM1")
+    assert upload.UploadUf2(None, [FakeNode(str(firmware))], env) == 0
+    assert touched == [("/dev/ttyACM1", 1200)]
+    assert (tmp_path / "FEATHERBOOT" / "NEW.UF2").exists()
+    assert not (tmp_path / "OTHERBOOT" / "NEW.UF2").exists()
+
+
+def test_serial_port_without_touch(tmp_path, firmware, monkeypatch):
+    upload = pytest.importorskip("atmelsam.upload")
+    _make_drive(tmp_path / "OTHERBOOT")
+    monkeypatch.setattr(upload, "find_uf2_drives", lambda pattern=None: (
+        uf2.find_uf2_drives(pattern or str(tmp_path / "*"))))
+    env = FakeEnv("/dev/ttyACM1", touch=False)
+    assert upload.UploadUf2(None, [FakeNode(str(firmware))], env) == 1
+    assert not (tmp_path / "OTHERBOOT" / "NEW.UF2").exists()